@@ -1,24 +1,38 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 from property_scraper import PropertyScraper
+from extraction_cache import ExtractionCache
+from response_cache import ResponseCache
+from chunk_index import ChunkIndex
+import chunk_index
+from document_batches import pack_batches
+import cpu_pool
+import pdf_extraction
+import ocr
+import claude_client
+import rate_limiter
+import token_counting
+from token_counting import count_tokens, chunk_text
+import deal_engine
+import deal_simulation
+import numpy as np
+import math
 import asyncio
 import os
 import json
+import base64
+import hashlib
 import uuid
 import shutil
 import tempfile
+import contextlib
 import logging
-import anthropic
-import tiktoken
 import pytesseract
-from pdf2image import convert_from_path
 import io
 import subprocess
 from docx import Document
-import PyPDF2
 from dotenv import load_dotenv
-from werkzeug.utils import secure_filename
 from werkzeug.serving import WSGIRequestHandler
 import time
 from pathlib import Path
@@ -27,6 +41,8 @@ from google.cloud import documentai_v1 as documentai
 from datetime import timedelta  # Import timedelta for viewing schedule
 import gc  # Import garbage collector
 from threading import Thread
+import threading
+import queue
 import psutil
 import zipfile
 from gevent import monkey; monkey.patch_all()
@@ -100,6 +116,17 @@ try:
 except Exception as e:
     logger.error(f"Error creating storage directory: {str(e)}")
 
+# Bump whenever extraction or OCR output changes so cached text is re-extracted
+EXTRACTOR_VERSION = 4
+extraction_cache = ExtractionCache(STORAGE_DIR / 'extraction_cache', EXTRACTOR_VERSION)
+
+# Claude batch analyses are deterministic (temperature 0), so finished batches are reused
+CLAUDE_CACHE_TTL_DAYS = float(os.environ.get('CLAUDE_CACHE_TTL_DAYS', 30))
+CLAUDE_CACHE_MAX_MB = float(os.environ.get('CLAUDE_CACHE_MAX_MB', 200))
+response_cache = ResponseCache(STORAGE_DIR / 'claude_cache',
+                               ttl_seconds=CLAUDE_CACHE_TTL_DAYS * 86400,
+                               max_bytes=int(CLAUDE_CACHE_MAX_MB * 1024 * 1024))
+
 # Set database file permissions if it doesn't exist
 if not os.path.exists(db_path):
     open(db_path, 'a').close()  # Create file if it doesn't exist
@@ -108,8 +135,31 @@ if not os.path.exists(db_path):
 # Initialize database
 db = SQLAlchemy(app)
 
+def _legal_pack_blob(relationship_name):
+    """Expose a legal pack side-table row as a plain text attribute on Property.
+
+    Reading returns None when there is no row; assigning creates the row on first
+    write so callers can keep treating the blob like a column.
+    """
+    def getter(self):
+        record = getattr(self, relationship_name)
+        return record.content if record is not None else None
+
+    def setter(self, value):
+        record = getattr(self, relationship_name)
+        if record is not None:
+            record.content = value
+        elif value is not None:
+            model = self.__mapper__.relationships[relationship_name].mapper.class_
+            setattr(self, relationship_name, model(content=value))
+
+    return property(getter, setter)
+
 class Property(db.Model):
     __tablename__ = 'property'
+    __table_args__ = (
+        db.Index('ix_property_created_at_id', 'created_at', 'id'),  # Keyset pagination in get_properties
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     rightmove_url = db.Column(db.String(500), nullable=True)
@@ -128,7 +178,7 @@ class Property(db.Model):
     arrangement_rate = db.Column(db.Float)
     broker_rate = db.Column(db.Float)
     management_fee = db.Column(db.Float)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     main_photo = db.Column(db.String(500), nullable=True)
     floorplan = db.Column(db.String(500), nullable=True)
     description = db.Column(db.Text, nullable=True)
@@ -150,10 +200,20 @@ class Property(db.Model):
     extra_fees = db.Column(db.Float, default=0)
     auction_date = db.Column(db.Date, nullable=True)
     
-    # Legal pack fields
-    legal_pack_analysis = db.Column(db.Text, nullable=True)
-    legal_pack_qa_history = db.Column(db.Text, nullable=True)  # Store Q&A history as JSON
-    legal_pack_documents = db.Column(db.Text, nullable=True)  # Store documents content as JSON
+    # Legal pack fields. The large blobs live in side tables (see LegalPackAnalysis etc.)
+    # and are only loaded when the attribute is accessed.
+    legal_pack_analysis = _legal_pack_blob('legal_pack_analysis_record')
+    legal_pack_qa_history = _legal_pack_blob('legal_pack_qa_history_record')  # Store Q&A history as JSON
+    legal_pack_documents = _legal_pack_blob('legal_pack_documents_record')  # Store documents content as JSON
+    legal_pack_analysis_record = db.relationship('LegalPackAnalysis', uselist=False, lazy='select',
+                                                 cascade='all, delete-orphan')
+    legal_pack_qa_history_record = db.relationship('LegalPackQAHistory', uselist=False, lazy='select',
+                                                   cascade='all, delete-orphan')
+    legal_pack_documents_record = db.relationship('LegalPackDocuments', uselist=False, lazy='select',
+                                                  cascade='all, delete-orphan')
+    legal_pack_index = _legal_pack_blob('legal_pack_index_record')  # BM25 passage index for follow-ups
+    legal_pack_index_record = db.relationship('LegalPackIndex', uselist=False, lazy='select',
+                                              cascade='all, delete-orphan')
     legal_pack_summary_pdf = db.Column(db.String(500), nullable=True)  # Path to the PDF summary
     legal_pack_analyzed_at = db.Column(db.DateTime, nullable=True)
     legal_pack_session_id = db.Column(db.String(100), nullable=True)  # To link with legal doc analyzer session
@@ -173,8 +233,10 @@ class Property(db.Model):
     total_roi = db.Column(db.Float, nullable=True)
     total_yield = db.Column(db.Float, nullable=True)
 
-    def to_dict(self):
-        return {
+    def to_dict(self, include_legal_pack=False):
+        """Serialize the property. The legal pack blobs are side-table rows of up to
+        megabytes each, so they are only loaded and included when include_legal_pack is set."""
+        data = {
             'id': self.id,
             'rightmove_url': self.rightmove_url,
             'initial_cash': self.initial_cash,
@@ -218,9 +280,6 @@ class Property(db.Model):
             'annual_profit': self.annual_profit,
             'total_roi': self.total_roi,
             'total_yield': self.total_yield,
-            'legal_pack_analysis': self.legal_pack_analysis,
-            'legal_pack_qa_history': json.loads(self.legal_pack_qa_history) if self.legal_pack_qa_history else [],
-            'legal_pack_documents': json.loads(self.legal_pack_documents) if self.legal_pack_documents else [],
             'legal_pack_summary_pdf': self.legal_pack_summary_pdf,
             'legal_pack_analyzed_at': self.legal_pack_analyzed_at.isoformat() if self.legal_pack_analyzed_at else None,
             'legal_pack_session_id': self.legal_pack_session_id,
@@ -229,6 +288,13 @@ class Property(db.Model):
             'viewing_date_3': self.viewing_date_3.isoformat() if self.viewing_date_3 else None,
             'viewing_date_4': self.viewing_date_4.isoformat() if self.viewing_date_4 else None,
         }
+        if include_legal_pack:
+            data.update({
+                'legal_pack_analysis': self.legal_pack_analysis,
+                'legal_pack_qa_history': json.loads(self.legal_pack_qa_history) if self.legal_pack_qa_history else [],
+                'legal_pack_documents': json.loads(self.legal_pack_documents) if self.legal_pack_documents else [],
+            })
+        return data
 
 class Analysis(db.Model):
     __tablename__ = 'analysis'
@@ -240,6 +306,148 @@ class Analysis(db.Model):
     def __repr__(self):
         return f'<Analysis {self.id} for property {self.property_id}>'
 
+class LegalPackAnalysis(db.Model):
+    """Claude's consolidated legal pack analysis for a property."""
+    __tablename__ = 'legal_pack_analysis'
+    property_id = db.Column(db.Integer, db.ForeignKey('property.id', ondelete='CASCADE'), primary_key=True)
+    content = db.Column(db.Text, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class LegalPackDocuments(db.Model):
+    """Extracted legal pack documents for a property (JSON list of {name, content})."""
+    __tablename__ = 'legal_pack_documents'
+    property_id = db.Column(db.Integer, db.ForeignKey('property.id', ondelete='CASCADE'), primary_key=True)
+    content = db.Column(db.Text, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class LegalPackQAHistory(db.Model):
+    """Follow-up question and answer history for a property (JSON list)."""
+    __tablename__ = 'legal_pack_qa_history'
+    property_id = db.Column(db.Integer, db.ForeignKey('property.id', ondelete='CASCADE'), primary_key=True)
+    content = db.Column(db.Text, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class LegalPackIndex(db.Model):
+    """BM25 passage index over a property's legal pack (ChunkIndex JSON), used to answer follow-ups."""
+    __tablename__ = 'legal_pack_index'
+    property_id = db.Column(db.Integer, db.ForeignKey('property.id', ondelete='CASCADE'), primary_key=True)
+    content = db.Column(db.Text, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# Property attribute -> side table holding it
+LEGAL_PACK_SIDE_TABLES = {
+    'legal_pack_analysis': LegalPackAnalysis,
+    'legal_pack_qa_history': LegalPackQAHistory,
+    'legal_pack_documents': LegalPackDocuments,
+}
+
+def backfill_legal_pack_tables():
+    """Copy legal pack blobs still sitting in old property columns into the side tables.
+
+    Databases created before the side tables existed keep the old columns (SQLite
+    cannot drop them cheaply); the Alembic migration does the same copy and then
+    drops them.
+    """
+    property_columns = {column['name'] for column in db.inspect(db.engine).get_columns('property')}
+    copied = 0
+    for column, model in LEGAL_PACK_SIDE_TABLES.items():
+        if column not in property_columns or model.query.first() is not None:
+            continue
+        result = db.session.execute(db.text(
+            f"INSERT INTO {model.__tablename__} (property_id, content, updated_at) "
+            f"SELECT id, {column}, CURRENT_TIMESTAMP FROM property WHERE {column} IS NOT NULL"
+        ))
+        copied += result.rowcount or 0
+    db.session.commit()
+    return copied
+
+class DealMetrics(db.Model):
+    """Narrow, indexed copy of each property's derived metrics for ranking queries.
+
+    Maintained on write by the Property mapper events below and by
+    recompute_portfolio(), so listing "top N by ROI" never touches the wide
+    property rows.
+    """
+    __tablename__ = 'deal_metrics'
+    __table_args__ = (
+        db.Index('ix_deal_metrics_total_roi', 'total_roi'),
+        db.Index('ix_deal_metrics_total_yield', 'total_yield'),
+        db.Index('ix_deal_metrics_bedrooms_station', 'bedrooms', 'station_distance'),
+    )
+
+    property_id = db.Column(db.Integer, db.ForeignKey('property.id', ondelete='CASCADE'), primary_key=True)
+    total_roi = db.Column(db.Float, nullable=True)
+    total_yield = db.Column(db.Float, nullable=True)
+    annual_profit = db.Column(db.Float, nullable=True)
+    cash_left_in_deal = db.Column(db.Float, nullable=True)
+    purchase_price = db.Column(db.Float, nullable=True)
+    bedrooms = db.Column(db.Integer, nullable=True)
+    station_distance = db.Column(db.Float, nullable=True)
+    is_auction = db.Column(db.Boolean, default=False)
+
+    def to_dict(self):
+        return {column: getattr(self, column) for column in ['property_id'] + list(DEAL_METRIC_COLUMNS)}
+
+# Property columns mirrored into deal_metrics
+DEAL_METRIC_COLUMNS = (
+    'total_roi',
+    'total_yield',
+    'annual_profit',
+    'cash_left_in_deal',
+    'purchase_price',
+    'bedrooms',
+    'station_distance',
+    'is_auction',
+)
+
+def sync_deal_metrics(connection, rows):
+    """Replace the deal_metrics rows for the given properties.
+
+    rows are dicts with 'property_id' plus DEAL_METRIC_COLUMNS. Delete-then-insert
+    keeps this portable between SQLite and PostgreSQL.
+    """
+    if not rows:
+        return
+    table = DealMetrics.__table__
+    connection.execute(table.delete().where(table.c.property_id.in_([row['property_id'] for row in rows])))
+    connection.execute(table.insert(), rows)
+
+def _deal_metrics_row(prop):
+    row = {column: getattr(prop, column) for column in DEAL_METRIC_COLUMNS}
+    row['property_id'] = prop.id
+    return row
+
+@db.event.listens_for(Property, 'after_insert')
+@db.event.listens_for(Property, 'after_update')
+def _refresh_deal_metrics(mapper, connection, target):
+    sync_deal_metrics(connection, [_deal_metrics_row(target)])
+
+@db.event.listens_for(Property, 'after_delete')
+def _delete_deal_metrics(mapper, connection, target):
+    table = DealMetrics.__table__
+    connection.execute(table.delete().where(table.c.property_id == target.id))
+
+def backfill_deal_metrics(chunk_size=500):
+    """Populate deal_metrics from the property table (used after creating the table)."""
+    columns = [getattr(Property, column) for column in DEAL_METRIC_COLUMNS]
+    rows = [dict(row._asdict(), property_id=row.id) for row in db.session.query(Property.id, *columns).all()]
+    for row in rows:
+        del row['id']
+    for start in range(0, len(rows), chunk_size):
+        sync_deal_metrics(db.session.connection(), rows[start:start + chunk_size])
+    db.session.commit()
+    return len(rows)
+
+# Stand-in for rows saved before created_at was NOT NULL; sorts them after every real row
+PROPERTY_CREATED_AT_BACKFILL = datetime(1970, 1, 1)
+
+def backfill_property_created_at():
+    """Give legacy properties with a NULL created_at a fixed timestamp so keyset pagination sees them."""
+    count = Property.query.filter(Property.created_at.is_(None)).update(
+        {Property.created_at: PROPERTY_CREATED_AT_BACKFILL}, synchronize_session=False)
+    db.session.commit()
+    return count
+
 def init_db():
     """Initialize database and create tables."""
     try:
@@ -247,6 +455,17 @@ def init_db():
         with app.app_context():
             db.create_all()
             app.logger.info("Database tables created successfully")
+            # Databases created by create_all() before the NOT NULL constraint can still hold NULLs
+            fixed = backfill_property_created_at()
+            if fixed:
+                app.logger.info(f"Backfilled created_at for {fixed} properties")
+            copied = backfill_legal_pack_tables()
+            if copied:
+                app.logger.info(f"Moved {copied} legal pack blobs into side tables")
+            # deal_metrics is new; populate it once for databases created before it existed
+            if DealMetrics.query.first() is None and Property.query.first() is not None:
+                count = backfill_deal_metrics()
+                app.logger.info(f"Backfilled deal metrics for {count} properties")
     except Exception as e:
         app.logger.error(f"Failed to initialize database: {str(e)}")
         raise
@@ -276,24 +495,47 @@ class Document(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-def count_tokens(text):
-    """Count tokens in text using tiktoken."""
-    try:
-        # Use cl100k_base encoding which is used by Claude
-        encoding = tiktoken.get_encoding("cl100k_base")
-        # Convert text to string if it isn't already
-        text_str = str(text)
-        # Process text in chunks to avoid recursion
-        chunk_size = 100000  # Process 100KB at a time
-        total_tokens = 0
-        for i in range(0, len(text_str), chunk_size):
-            chunk = text_str[i:i + chunk_size]
-            total_tokens += len(encoding.encode(chunk))
-        return total_tokens
-    except Exception as e:
-        logger.error(f"Error counting tokens: {str(e)}")
-        # Return a conservative estimate if tiktoken fails
-        return len(str(text).split()) * 2
+class LegalPackJob(db.Model):
+    """A queued legal-pack analysis and its persisted progress."""
+    __tablename__ = 'legal_pack_jobs'
+    id = db.Column(db.String(36), primary_key=True)
+    property_id = db.Column(db.Integer, db.ForeignKey('property.id', ondelete='CASCADE'), nullable=False, index=True)
+    status = db.Column(db.String(20), default='queued', nullable=False, index=True)  # queued, running, completed, failed
+    stage = db.Column(db.String(50), default='queued')  # queued, extracting, analyzing, done
+    upload_path = db.Column(db.String(500))
+    current_file = db.Column(db.String(255))
+    files_total = db.Column(db.Integer, default=0)
+    files_done = db.Column(db.Integer, default=0)
+    pages_total = db.Column(db.Integer, default=0)
+    pages_done = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text)
+    result = db.Column(db.JSON)
+    analysis_text = db.Column(db.Text)  # Consolidated analysis so far, while it streams
+    attempts = db.Column(db.Integer, default=0, nullable=False)  # Times a worker has claimed the job
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'property_id': self.property_id,
+            'status': self.status,
+            'stage': self.stage,
+            'current_file': self.current_file,
+            'files_total': self.files_total,
+            'files_done': self.files_done,
+            'pages_total': self.pages_total,
+            'pages_done': self.pages_done,
+            'error': self.error,
+            'attempts': self.attempts,
+            'analysis_text': self.analysis_text,
+            'result': self.result if self.status in ('completed', 'failed') else None,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
 
 def save_documents(session_id, processed_files, initial_analysis=None, qa_history=None):
     """Save documents and analysis history to database."""
@@ -333,67 +575,100 @@ def load_documents(session_id):
         logger.error(f"Error loading documents from database: {str(e)}")
         return None, None, None
 
-def extract_text_from_pdf(file_path):
-    """Extract text from PDF file."""
+def ocr_pdf_pages(file_path, page_numbers):
+    """OCR the given 0-based pages of a PDF, yielding (page_num, text) in page order.
+
+    All pages are rasterized in as few pdftoppm passes as possible and OCR'd
+    while later pages are still rendering, by Vision in batches or the local
+    tesseract pool depending on OCR_ENGINE (see ocr.select_engine).
+    """
+    if not vision_client and ocr.OCR_ENGINE != 'tesseract':
+        init_vision_client()
+    try:
+        texts = ocr.ocr_pages(pdf_extraction.render_pages_for_ocr(file_path, page_numbers), vision_client)
+    except Exception as e:
+        app.logger.error(f"Error rendering pages for OCR: {str(e)}")
+        return
+
+    for page_num in page_numbers:
+        if page_num not in texts:
+            app.logger.warning(f"No image rendered for page {page_num+1}")
+            continue
+        app.logger.info(f"OCR completed for page {page_num+1}, extracted {len(texts[page_num])} chars")
+        yield page_num, texts[page_num]
+
+# 0 means no limit; pages are extracted in parallel and OCR runs in windows, so long PDFs stay cheap
+PDF_MAX_PAGES = int(os.environ.get('PDF_MAX_PAGES', 0))
+# Pages extracted before their low-text pages are rendered and OCR'd together
+PDF_OCR_WINDOW = int(os.environ.get('PDF_OCR_WINDOW', 25))
+
+def _finish_pdf_window(file_path, pages):
+    ocr_pages = [page['page'] for page in pages if page['needs_ocr']]
+    for page_num in ocr_pages:
+        page = pages[page_num - pages[0]['page']]
+        app.logger.info(f"Page {page_num+1} routed to OCR ({page['reason']}, {len(page['text'])} chars of text)")
+    ocr_text = dict(ocr_pdf_pages(file_path, ocr_pages)) if ocr_pages else {}
+    for page in pages:
+        text = ocr_text.get(page['page'])
+        # OCR unavailable or empty: keep whatever the text layer gave rather than dropping it
+        yield page['page'], text if text and text.strip() else page['text']
+
+def iter_pdf_text(file_path, max_pages=None):
+    """Yield (page_num, text) for every page of a PDF in order, OCR included.
+
+    Pages are taken from the extraction pool in windows of PDF_OCR_WINDOW; each
+    window's low-text pages are rendered and OCR'd together before its text is
+    yielded, so nothing grows with the length of the document.
+    """
+    window = []
+    for page in pdf_extraction.iter_pdf_pages(file_path, max_pages=max_pages):
+        window.append(page)
+        if len(window) >= PDF_OCR_WINDOW:
+            yield from _finish_pdf_window(file_path, window)
+            window = []
+    if window:
+        yield from _finish_pdf_window(file_path, window)
+
+def extract_text_from_pdf(file_path, on_pages=None):
+    """Extract text from PDF file.
+
+    Page texts from iter_pdf_text() are collected and joined once at the end,
+    since callers need the whole document as one string. on_pages(done, total)
+    is called as pages complete.
+    """
     app.logger.info(f"Starting PDF extraction for: {file_path}")
-    text_content = []
-    
+    started = time.perf_counter()
+
     try:
-        with open(file_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            total_pages = len(pdf_reader.pages)
-            app.logger.info(f"PDF has {total_pages} pages")
-            
-            # Process in batches of 10 pages
-            BATCH_SIZE = 10
-            MAX_PAGES = 50  # Maximum total pages to process
-            
-            for batch_start in range(0, total_pages, BATCH_SIZE):
-                try:
-                    end_page = min(batch_start + BATCH_SIZE, total_pages, MAX_PAGES)
-                    batch_text = []
-                    
-                    for page_num in range(batch_start, end_page):
-                        app.logger.info(f"Processing page {page_num+1}/{total_pages}")
-                        page = pdf_reader.pages[page_num]
-                        page_text = page.extract_text().strip()
-                        
-                        if not page_text or len(page_text) < 100:
-                            app.logger.info(f"Page {page_num+1} has insufficient text ({len(page_text)} chars), attempting OCR")
-                            try:
-                                images = convert_from_path(file_path, first_page=page_num+1, last_page=page_num+1)
-                                if images:
-                                    app.logger.info(f"Successfully converted page {page_num+1} to image, starting OCR")
-                                    page_text = process_scanned_page(images[0])
-                                    app.logger.info(f"OCR completed for page {page_num+1}, extracted {len(page_text)} chars")
-                                    del images
-                                else:
-                                    app.logger.warning(f"No images extracted from page {page_num+1}")
-                            except Exception as e:
-                                app.logger.error(f"Error during OCR for page {page_num+1}: {str(e)}")
-                        else:
-                            app.logger.info(f"Successfully extracted {len(page_text)} chars from page {page_num+1} using PyPDF2")
-                        
-                        batch_text.append(page_text)
-                        gc.collect()
-                        app.logger.info(f"Memory usage after page {page_num+1}: {psutil.Process().memory_info().rss / 1024 / 1024:.2f} MB")
-                    
-                    text_content.extend(batch_text)
-                    gc.collect()
-                    app.logger.info(f"Completed batch {batch_start+1}-{end_page}, total content length: {sum(len(t) for t in batch_text)}")
-                    
-                except Exception as e:
-                    app.logger.error(f"Error processing pages {batch_start+1}-{end_page}: {str(e)}")
-                    continue
-        
-        if total_pages > MAX_PAGES:
-            app.logger.warning(f"PDF has {total_pages} pages, but only processed first {MAX_PAGES} pages")
-            text_content.append(f"\n[Note: Only the first {MAX_PAGES} pages were processed due to size limits]")
-        
-        final_text = "\n".join(text_content)
-        app.logger.info(f"PDF extraction completed. Total content length: {len(final_text)}")
+        total_pages = pdf_extraction.page_count(file_path)
+        app.logger.info(f"PDF has {total_pages} pages")
+        max_pages = PDF_MAX_PAGES or None
+
+        pages_wanted = min(total_pages, max_pages) if max_pages else total_pages
+        if on_pages:
+            on_pages(0, pages_wanted)
+
+        pages_done = 0
+        page_texts = []
+        for page_num, page_text in iter_pdf_text(file_path, max_pages=max_pages):
+            page_texts.append(page_text)
+            pages_done += 1
+            if pages_done % PDF_OCR_WINDOW == 0 or pages_done == pages_wanted:
+                if on_pages:
+                    on_pages(pages_done, pages_wanted)
+            if pages_done % 50 == 0:
+                app.logger.info(f"Extracted {pages_done}/{total_pages} pages")
+
+        if max_pages and total_pages > max_pages:
+            app.logger.warning(f"PDF has {total_pages} pages, but only processed first {max_pages} pages")
+            page_texts.append(f"\n[Note: Only the first {max_pages} pages were processed due to size limits]")
+
+        final_text = "\n".join(page_texts)
+
+        app.logger.info(f"PDF extraction completed in {time.perf_counter() - started:.2f}s "
+                        f"({pages_done} pages). Total content length: {len(final_text)}")
         return final_text
-            
+
     except Exception as e:
         app.logger.error(f"Error in PDF extraction: {str(e)}")
         raise
@@ -411,7 +686,10 @@ def init_vision_client():
         return False
 
 def process_scanned_page(image):
-    """Process a scanned page using OCR."""
+    """Process a scanned page using OCR.
+
+    Accepts a PIL image or an already encoded PNG/JPEG as bytes.
+    """
     global vision_client
     try:
         # Try to initialize Vision client if it's not already initialized
@@ -419,9 +697,12 @@ def process_scanned_page(image):
             raise Exception("Vision client not available")
             
         # Convert PIL image to bytes
-        with io.BytesIO() as bio:
-            image.save(bio, format='PNG')
-            image_bytes = bio.getvalue()
+        if isinstance(image, bytes):
+            image_bytes = image
+        else:
+            with io.BytesIO() as bio:
+                image.save(bio, format='PNG')
+                image_bytes = bio.getvalue()
         
         # Create Vision API image
         vision_image = vision.Image(content=image_bytes)
@@ -512,15 +793,18 @@ def extract_text_from_doc(doc_path):
         logger.error(f"Error in extract_text_from_doc: {str(e)}")
         return None
 
-def process_document(file_path):
-    """Process a single document and return its text content."""
+def process_document(file_path, on_pages=None):
+    """Process a single document and return its text content.
+
+    on_pages(done, total) reports page progress for PDFs.
+    """
     try:
         _, ext = os.path.splitext(file_path.lower())
         logger.info(f"Processing document: {file_path} (type: {ext})")
         
         if ext == '.pdf':
             logger.info(f"Extracting text from PDF: {file_path}")
-            content = extract_text_from_pdf(file_path)
+            content = extract_text_from_pdf(file_path, on_pages=on_pages)
         elif ext in ['.docx', '.doc']:
             logger.info(f"Extracting text from Word document: {file_path}")
             content = extract_text_from_doc(file_path)
@@ -546,61 +830,150 @@ def process_document(file_path):
         logger.error(f"Error processing file {file_path}: {str(e)}")
         return None
 
-def process_zip_file(zip_file_path):
-    """Process a ZIP file and extract its contents."""
-    logger.info(f"Starting to process ZIP file: {zip_file_path}")
+def process_document_cached(file_path, digest=None, on_pages=None):
+    """Extract a document's text and token count, reusing the cached result for identical files.
+
+    Returns (content, tokens, cache_hit). Failed extractions are not cached so
+    they are retried on the next upload.
+    """
+    digest = digest or extraction_cache.file_digest(file_path)
+    entry = extraction_cache.get(digest)
+    if entry is not None:
+        logger.info(f"Extraction cache hit for {os.path.basename(file_path)} ({digest[:12]})")
+        return entry['content'], entry['tokens'], True
+
+    content = process_document(file_path, on_pages=on_pages)
+    if not content or not content.strip():
+        return content, 0, False
+    tokens = cpu_pool.run(count_tokens, content)
+    extraction_cache.put(digest, content, tokens, source_name=os.path.basename(file_path))
+    return content, tokens, False
+
+MAX_ZIP_DEPTH = 3  # Nested archives deeper than this are skipped
+ZIP_SPOOL_CHUNK = 1024 * 1024
+
+def _skip_zip_member(info):
+    name = os.path.basename(info.filename.rstrip('/'))
+    return (info.is_dir() or info.filename.startswith('__MACOSX/') or '/__MACOSX/' in info.filename
+            or name.startswith('.') or name.startswith('~'))
+
+def iter_zip_members(zip_source, depth=0):
+    """Yield (name, temp_path, digest) for each document in a ZIP, one member at a time.
+
+    Each member is streamed out of the archive into a single temporary file
+    (hashed on the way for the extraction cache) and deleted as soon as the
+    caller moves on, so at most one member is on disk at a time. Nested ZIPs
+    are read in place when stored uncompressed, otherwise spooled like any
+    other member. zip_source may be a path or a seekable file object.
+    """
+    with zipfile.ZipFile(zip_source, 'r') as zip_ref:
+        for info in sorted(zip_ref.infolist(), key=lambda i: i.filename):
+            if _skip_zip_member(info):
+                logger.info(f"Skipping hidden/temp entry: {info.filename}")
+                continue
+            name = os.path.basename(info.filename)
+            ext = os.path.splitext(name)[1].lower()
+
+            if ext == '.zip':
+                if depth >= MAX_ZIP_DEPTH:
+                    logger.warning(f"Skipping nested ZIP beyond depth {MAX_ZIP_DEPTH}: {info.filename}")
+                    continue
+                if info.compress_type == zipfile.ZIP_STORED:
+                    with zip_ref.open(info) as nested:
+                        yield from iter_zip_members(nested, depth + 1)
+                    continue
+
+            digest = hashlib.sha256()
+            fd, temp_path = tempfile.mkstemp(suffix=ext)
+            try:
+                with os.fdopen(fd, 'wb') as out, zip_ref.open(info) as member:
+                    for chunk in iter(lambda: member.read(ZIP_SPOOL_CHUNK), b''):
+                        digest.update(chunk)
+                        out.write(chunk)
+                if ext == '.zip':
+                    yield from iter_zip_members(temp_path, depth + 1)
+                else:
+                    yield name, temp_path, digest.hexdigest()
+            finally:
+                os.remove(temp_path)
+
+def count_zip_documents(zip_source, depth=0):
+    """Number of documents iter_zip_members() will yield from an archive, walking nested ZIPs the same way.
+
+    Only the central directories are read: a stored nested ZIP in place, a
+    compressed one after spooling it to a temporary file.
+    """
+    count = 0
+    with zipfile.ZipFile(zip_source, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if _skip_zip_member(info):
+                continue
+            if os.path.splitext(info.filename)[1].lower() != '.zip':
+                count += 1
+                continue
+            if depth >= MAX_ZIP_DEPTH:
+                continue
+            try:
+                if info.compress_type == zipfile.ZIP_STORED:
+                    with zip_ref.open(info) as nested:
+                        count += count_zip_documents(nested, depth + 1)
+                    continue
+                fd, temp_path = tempfile.mkstemp(suffix='.zip')
+                try:
+                    with os.fdopen(fd, 'wb') as out, zip_ref.open(info) as member:
+                        shutil.copyfileobj(member, out, ZIP_SPOOL_CHUNK)
+                    count += count_zip_documents(temp_path, depth + 1)
+                finally:
+                    os.remove(temp_path)
+            except zipfile.BadZipFile as e:
+                logger.warning(f"Cannot count documents in nested ZIP {info.filename}: {str(e)}")
+    return count
+
+def process_zip_file(zip_file_path, progress=None):
+    """Process a ZIP file (path or seekable file object), streaming each member through extraction.
+
+    progress, if given, is called as progress(event, name, **info) with the
+    events 'file_started', 'pages' (done=, total=) and 'file_done' (ok=).
+    """
+    logger.info(f"Starting to process ZIP file: {getattr(zip_file_path, 'name', zip_file_path)}")
     processed_files = []
     failed_files = []
     processing_summary = []
     total_tokens = 0
     
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            logger.info(f"Created temporary directory: {temp_dir}")
-            with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-                # Log ZIP contents
-                files_in_zip = [f for f in zip_ref.namelist() if not f.startswith('__MACOSX/') and not f.startswith('._')]
-                logger.info(f"Files in ZIP: {files_in_zip}")
-                
-                # Extract files while filtering out macOS metadata
-                for file_info in zip_ref.filelist:
-                    if not file_info.filename.startswith('__MACOSX/') and not file_info.filename.startswith('._'):
-                        zip_ref.extract(file_info, temp_dir)
-                        logger.info(f"Extracted: {file_info.filename}")
-                
-                # Process each file in the zip
-                for root, _, files in os.walk(temp_dir):
-                    for file in sorted(files):  # Sort files to ensure consistent processing order
-                        if file.startswith('.') or file.startswith('~'):  # Skip hidden and temporary files
-                            logger.info(f"Skipping hidden/temp file: {file}")
-                            continue
-                            
-                        file_path = os.path.join(root, file)
-                        logger.info(f"Processing file from ZIP: {file}")
-                        try:
-                            content = process_document(file_path)
-                            if content and content.strip():
-                                num_tokens = count_tokens(content)
-                                total_tokens += num_tokens
-                                processed_files.append({
-                                    'name': file,
-                                    'content': content,
-                                    'length': len(content),
-                                    'tokens': num_tokens
-                                })
-                                msg = f"Successfully processed {file} ({num_tokens} tokens)"
-                                logger.info(msg)
-                                processing_summary.append(msg)
-                            else:
-                                msg = f"Failed to extract content from {file}"
-                                logger.warning(msg)
-                                failed_files.append(file)
-                                processing_summary.append(msg)
-                        except Exception as e:
-                            msg = f"Error processing {file}: {str(e)}"
-                            logger.error(msg)
-                            failed_files.append(file)
-                            processing_summary.append(msg)
+        for file, file_path, digest in iter_zip_members(zip_file_path):
+            logger.info(f"Processing file from ZIP: {file}")
+            if progress:
+                progress('file_started', file)
+            on_pages = (lambda done, total, name=file: progress('pages', name, done=done, total=total)) if progress else None
+            ok = False
+            try:
+                content, num_tokens, cache_hit = process_document_cached(file_path, digest, on_pages=on_pages)
+                if content and content.strip():
+                    ok = True
+                    total_tokens += num_tokens
+                    processed_files.append({
+                        'name': file,
+                        'content': content,
+                        'length': len(content),
+                        'tokens': num_tokens
+                    })
+                    msg = f"Successfully processed {file} ({num_tokens} tokens{', cached' if cache_hit else ''})"
+                    logger.info(msg)
+                    processing_summary.append(msg)
+                else:
+                    msg = f"Failed to extract content from {file}"
+                    logger.warning(msg)
+                    failed_files.append(file)
+                    processing_summary.append(msg)
+            except Exception as e:
+                msg = f"Error processing {file}: {str(e)}"
+                logger.error(msg)
+                failed_files.append(file)
+                processing_summary.append(msg)
+            if progress:
+                progress('file_done', file, ok=ok)
 
     except Exception as e:
         logger.error(f"Error processing ZIP file: {str(e)}")
@@ -619,16 +992,19 @@ def process_zip_file(zip_file_path):
     results_filename = f"processing_results_{timestamp}.json"
     results_filepath = STORAGE_DIR / results_filename
     
-    with open(results_filepath, 'w', encoding='utf-8') as f:
-        json.dump(results, f, indent=2, ensure_ascii=False)
+    cpu_pool.run(cpu_pool.write_json, results_filepath, results, indent=2, ensure_ascii=False)
     
     logger.info(f"Processing results saved to {results_filepath}")
     logger.info(f"Total tokens across all documents: {total_tokens}")
     
     return processed_files, failed_files, "\n".join(processing_summary)
 
-def analyze_with_claude(documents_content, processing_summary=None, follow_up_question=None, initial_analysis=None, qa_history=None):
-    """Analyze all documents together using Claude API."""
+def analyze_with_claude(documents_content, processing_summary=None, on_text=None):
+    """Analyze all documents together using Claude API.
+
+    With on_text, the consolidated analysis is streamed and on_text is called
+    with each piece of text as it arrives.
+    """
     try:
         # Initialize the Anthropic client with the API key from environment variables
         api_key = os.getenv('CLAUDE_API_KEY')
@@ -636,98 +1012,59 @@ def analyze_with_claude(documents_content, processing_summary=None, follow_up_qu
             logger.error("CLAUDE_API_KEY environment variable is not set")
             raise ValueError("CLAUDE_API_KEY environment variable is not set")
         
-        logger.info(f"Analyzing documents with Claude (follow_up: {'yes' if follow_up_question else 'no'})")
+        logger.info(f"Analyzing {len(documents_content)} documents with Claude")
         
         try:
-            client = anthropic.Anthropic(api_key=api_key, timeout=300)  # 5 minute timeout
+            client = claude_client.make_client(api_key, timeout=300)  # 5 minute timeout
             logger.info("Successfully initialized Anthropic client")
         except Exception as client_error:
             logger.error(f"Failed to initialize Anthropic client: {str(client_error)}")
             raise
         
-        # Process documents in smaller batches
+        # Pack documents into batches that fit the context window (CPU-bound, so off the gevent hub)
         MAX_BATCH_TOKENS = 12000  # Leave room for prompt and response
-        current_batch = []
-        current_batch_tokens = 0
-        all_responses = []
+        batches = cpu_pool.run(pack_batches, documents_content, MAX_BATCH_TOKENS)
         
-        for doc in documents_content:
-            # Calculate tokens for this document
-            doc_text = f"\n{'='*50}\nDOCUMENT: {doc['name']}\n{'='*50}\n{doc['content']}"
-            doc_tokens = count_tokens(doc_text)
-            
-            if current_batch_tokens + doc_tokens > MAX_BATCH_TOKENS:
-                # Process current batch
-                batch_response = process_document_batch(current_batch, client)
-                if batch_response:
-                    all_responses.append(batch_response)
-                # Clear batch and memory
-                current_batch = []
-                current_batch_tokens = 0
-                
-                # Force garbage collection
-                gc.collect()
-            
-            current_batch.append(doc_text)
-            current_batch_tokens += doc_tokens
-            # Clear individual document text
-            doc_text = None
-            
-        # Process final batch if any
-        if current_batch:
-            batch_response = process_document_batch(current_batch, client)
-            if batch_response:
-                all_responses.append(batch_response)
+        # Batches are independent, so analyse them concurrently; consolidation waits for all of them
+        logger.info(f"Analysing {len(batches)} document batches "
+                    f"({min(len(batches), claude_client.CLAUDE_BATCH_CONCURRENCY)} at a time)")
+        batch_responses = claude_client.map_concurrently(
+            lambda batch: process_document_batch(batch, client), batches)
+        # A consolidation of a partial pack would look complete, so fail the job; a re-run gets finished batches from the cache
+        failed_batches = [number for number, response in enumerate(batch_responses, 1) if not response]
+        if failed_batches:
+            raise ValueError(f"Claude analysis failed for {len(failed_batches)} of {len(batches)} document batches "
+                             f"(batch {', '.join(map(str, failed_batches))}); re-run the analysis to retry them")
+        all_responses = batch_responses
         
         # Combine all responses
         combined_analysis = "\n\n".join(all_responses)
         
         # Final analysis of combined results
-        if not follow_up_question:
-            system_prompt = """You are an expert conveyancer. Review and consolidate the following analyses of legal pack documents into a single, coherent summary. Focus on the most important findings and risks."""
-            
-            try:
-                final_response = client.messages.create(
-                    model="claude-3-sonnet-20240229",
-                    max_tokens=4096,
-                    system=system_prompt,
-                    messages=[{
-                        "role": "user",
-                        "content": f"Previous analyses:\n\n{combined_analysis}\n\nProvide a consolidated summary focusing on:\n1. Most significant risks and findings\n2. Key recommendations\n3. Critical missing information"
-                    }],
-                    temperature=0
-                )
+        system_prompt = """You are an expert conveyancer. Review and consolidate the following analyses of legal pack documents into a single, coherent summary. Focus on the most important findings and risks."""
+        
+        final_request = dict(
+            model="claude-3-sonnet-20240229",
+            max_tokens=4096,
+            system=system_prompt,
+            messages=[{
+                "role": "user",
+                "content": f"Previous analyses:\n\n{combined_analysis}\n\nProvide a consolidated summary focusing on:\n1. Most significant risks and findings\n2. Key recommendations\n3. Critical missing information"
+            }],
+            temperature=0
+        )
+        try:
+            if on_text is None:
+                final_response = claude_client.create_message(client, **final_request)
                 return final_response.content[0].text
-            except Exception as api_error:
-                logger.error(f"Claude API error during final analysis: {str(api_error)}")
-                raise ValueError(f"Failed to get final analysis from Claude API: {str(api_error)}")
-        else:
-            # For follow-up questions, use the original logic
-            system_prompt = """You are an expert conveyancer analyzing a legal pack for an auction property. You have previously provided a comprehensive analysis, and now need to answer a specific follow-up question."""
-            
-            context = "Here is the initial analysis of the legal pack:\n\n"
-            context += initial_analysis + "\n\n"
-            
-            if qa_history:
-                context += "Previous questions and answers:\n\n"
-                for qa in qa_history:
-                    context += f"Q: {qa['question']}\nA: {qa['answer']}\n\n"
-            
-            try:
-                response = client.messages.create(
-                    model="claude-3-sonnet-20240229",
-                    max_tokens=4096,
-                    system=system_prompt,
-                    messages=[{
-                        "role": "user",
-                        "content": f"Context:\n{context}\n\nDocuments analyzed:\n{combined_analysis}\n\nQuestion: {follow_up_question}"
-                    }],
-                    temperature=0
-                )
-                return response.content[0].text
-            except Exception as api_error:
-                logger.error(f"Claude API error during follow-up: {str(api_error)}")
-                raise ValueError(f"Failed to get answer from Claude API: {str(api_error)}")
+            parts = []
+            for text in claude_client.stream_message(client, **final_request):
+                parts.append(text)
+                on_text(text)
+            return ''.join(parts)
+        except Exception as api_error:
+            logger.error(f"Claude API error during final analysis: {str(api_error)}")
+            raise ValueError(f"Failed to get final analysis from Claude API: {str(api_error)}")
                 
     except Exception as e:
         logger.error(f"Error in analyze_with_claude: {str(e)}")
@@ -736,6 +1073,69 @@ def analyze_with_claude(documents_content, processing_summary=None, follow_up_qu
         # Clean up
         gc.collect()
 
+# Follow-ups repeat a long prefix on every question; claude-3-sonnet-20240229 cannot cache it, so they use a
+# model that can. FOLLOWUP_PROMPT_CACHING=0 drops the cache_control markers for models without caching.
+FOLLOWUP_MODEL = os.environ.get('FOLLOWUP_MODEL', 'claude-sonnet-4-5-20250929')
+FOLLOWUP_PROMPT_CACHING = os.environ.get('FOLLOWUP_PROMPT_CACHING', '1').lower() not in ('0', 'false', 'no')
+
+def _followup_block(text, cache=False):
+    if cache and FOLLOWUP_PROMPT_CACHING:
+        return claude_client.cached_block(text)
+    return {'type': 'text', 'text': text}
+
+def followup_request(question, passages, initial_analysis, qa_history=None):
+    """Messages API arguments for a follow-up question, laid out for prompt caching.
+
+    The initial analysis opens the first user turn and each earlier question
+    and answer is replayed as its own user/assistant pair, so the prompt only
+    ever grows at the end. Cache breakpoints sit on the analysis and on the
+    last earlier answer: the next question finds this call's prefix cached
+    and pays for writing just the newest pair. The retrieved excerpts and the
+    question change every time and go last.
+    """
+    system_prompt = """You are an expert conveyancer analyzing a legal pack for an auction property. You have previously provided a comprehensive analysis, and now need to answer a specific follow-up question. Base your answer on the excerpts provided and say so when they do not contain the answer."""
+    
+    messages = []
+    content = [_followup_block(f"Here is the initial analysis of the legal pack:\n\n{initial_analysis}", cache=True)]
+    qa_history = qa_history or []
+    for number, qa in enumerate(qa_history, 1):
+        content.append({'type': 'text', 'text': f"Question: {qa['question']}"})
+        messages.append({'role': 'user', 'content': content})
+        answer = qa.get('answer') or '(no answer)'
+        messages.append({'role': 'assistant', 'content': [_followup_block(answer, cache=number == len(qa_history))]})
+        content = []
+    
+    excerpts = "\n\n".join(
+        f"{'='*50}\nEXCERPT FROM: {passage['document']}\n{'='*50}\n{passage['text']}" for passage in passages
+    ) or "(no matching passages found)"
+    content.append({'type': 'text', 'text': f"Relevant excerpts from the legal pack:\n{excerpts}"})
+    content.append({'type': 'text', 'text': f"Question: {question}"})
+    messages.append({'role': 'user', 'content': content})
+    
+    return dict(
+        model=FOLLOWUP_MODEL,
+        max_tokens=4096,
+        system=system_prompt,
+        messages=messages,
+        temperature=0
+    )
+
+def answer_followup(question, passages, initial_analysis, qa_history=None):
+    """Answer a follow-up question; returns (answer, usage) where usage includes prompt-cache tokens."""
+    api_key = os.getenv('CLAUDE_API_KEY')
+    if not api_key:
+        raise ValueError("CLAUDE_API_KEY environment variable is not set")
+    client = claude_client.make_client(api_key, timeout=300)
+    
+    try:
+        response = claude_client.create_message(
+            client, priority=rate_limiter.INTERACTIVE,
+            **followup_request(question, passages, initial_analysis, qa_history))
+        return response.content[0].text, claude_client.usage_summary(response)
+    except Exception as api_error:
+        logger.error(f"Claude API error during follow-up: {str(api_error)}")
+        raise ValueError(f"Failed to get answer from Claude API: {str(api_error)}")
+
 def process_document_batch(document_batch, client):
     """Process a batch of documents with Claude."""
     try:
@@ -754,7 +1154,7 @@ Format your response in these sections:
 2. KEY FINDINGS AND RISKS
 3. IMPORTANT INFORMATION"""
 
-        response = client.messages.create(
+        request = dict(
             model="claude-3-sonnet-20240229",
             max_tokens=4096,
             system=system_prompt,
@@ -764,8 +1164,18 @@ Format your response in these sections:
             }],
             temperature=0
         )
+        cache_key = ResponseCache.key(**request)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Reusing cached analysis for batch {cache_key[:12]}")
+            return cached
+        
+        response = claude_client.create_message(client, **request)
         
-        return response.content[0].text if response else None
+        text = response.content[0].text if response else None
+        if text:
+            response_cache.put(cache_key, text, model=request['model'])
+        return text
     except Exception as e:
         logger.error(f"Error processing document batch: {str(e)}")
         return None
@@ -787,55 +1197,18 @@ def process_document_async(doc_id):
         # Get file path from document
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], document.filename)
         
-        # Process in chunks of 10 pages
-        CHUNK_SIZE = 10
+        total_pages = pdf_extraction.page_count(file_path)
+        document.total_pages = total_pages
+        db.session.commit()
+
         text_chunks = []
-        
-        with open(file_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            total_pages = len(pdf_reader.pages)
-            document.total_pages = total_pages
-            db.session.commit()
-            
-            for start_page in range(0, total_pages, CHUNK_SIZE):
-                try:
-                    end_page = min(start_page + CHUNK_SIZE, total_pages)
-                    chunk_text = []
-                    
-                    for page_num in range(start_page, end_page):
-                        app.logger.info(f"Processing page {page_num+1}/{total_pages}")
-                        page = pdf_reader.pages[page_num]
-                        page_text = page.extract_text().strip()
-                        
-                        if not page_text or len(page_text) < 100:
-                            app.logger.info(f"Page {page_num+1} has insufficient text ({len(page_text)} chars), attempting OCR")
-                            try:
-                                images = convert_from_path(file_path, first_page=page_num+1, last_page=page_num+1)
-                                if images:
-                                    app.logger.info(f"Successfully converted page {page_num+1} to image, starting OCR")
-                                    page_text = process_scanned_page(images[0])
-                                    app.logger.info(f"OCR completed for page {page_num+1}, extracted {len(page_text)} chars")
-                                    del images
-                                else:
-                                    app.logger.warning(f"No images extracted from page {page_num+1}")
-                            except Exception as e:
-                                app.logger.error(f"Error during OCR for page {page_num+1}: {str(e)}")
-                        else:
-                            app.logger.info(f"Successfully extracted {len(page_text)} chars from page {page_num+1} using PyPDF2")
-                        
-                        chunk_text.append(page_text)
-                        document.processed_pages = page_num + 1
-                        db.session.commit()
-                        gc.collect()
-                    
-                    text_chunks.extend(chunk_text)
-                    gc.collect()
-                    app.logger.info(f"Completed batch {start_page+1}-{end_page}, total content length: {sum(len(t) for t in chunk_text)}")
-                    
-                except Exception as e:
-                    app.logger.error(f"Error processing pages {start_page+1}-{end_page}: {str(e)}")
-                    continue
-        
+        for page_num, page_text in iter_pdf_text(file_path):
+            text_chunks.append(page_text)
+            if (page_num + 1) % PDF_OCR_WINDOW == 0:
+                document.processed_pages = page_num + 1
+                db.session.commit()
+        document.processed_pages = total_pages
+
         document.text_content = "\n".join(text_chunks)
         document.status = 'completed'
         db.session.commit()
@@ -860,7 +1233,7 @@ def process_documents(file_paths, follow_up=False):
         app.logger.info(f"API Key length: {len(api_key)}")
         
         # Initialize Anthropic client
-        client = anthropic.Anthropic(api_key=api_key, timeout=300)
+        client = claude_client.make_client(api_key, timeout=300)
         app.logger.info("Successfully initialized Anthropic client")
         
         # Process documents in smaller chunks
@@ -920,28 +1293,7 @@ def process_documents(file_paths, follow_up=False):
 
 def split_document_into_chunks(content, max_tokens):
     """Split a document into chunks that don't exceed max_tokens."""
-    chunks = []
-    sentences = content.split('. ')
-    current_chunk = []
-    current_chunk_tokens = 0
-    
-    for sentence in sentences:
-        sentence_tokens = count_tokens(sentence)
-        
-        if current_chunk_tokens + sentence_tokens > max_tokens:
-            # Join current chunk and add to chunks
-            chunks.append('. '.join(current_chunk) + '.')
-            current_chunk = [sentence]
-            current_chunk_tokens = sentence_tokens
-        else:
-            current_chunk.append(sentence)
-            current_chunk_tokens += sentence_tokens
-    
-    # Add any remaining content
-    if current_chunk:
-        chunks.append('. '.join(current_chunk) + '.')
-    
-    return chunks
+    return token_counting.chunk_text(content, max_tokens)
 
 def analyze_document_batch(document_batch, client):
     """Analyze a batch of documents."""
@@ -950,7 +1302,8 @@ def analyze_document_batch(document_batch, client):
         try:
             app.logger.info(f"Sending analysis request to Claude for {os.path.basename(file_path)}")
             
-            message = client.messages.create(
+            message = claude_client.create_message(
+                client,
                 model="claude-3-opus-20240229",
                 max_tokens=4000,
                 temperature=0,
@@ -968,9 +1321,6 @@ def analyze_document_batch(document_batch, client):
                 'analysis': message.content
             })
             
-            # Add a small delay between requests to prevent rate limiting
-            time.sleep(1)
-            
         except Exception as e:
             app.logger.error(f"Error analyzing document {os.path.basename(file_path)}: {str(e)}")
             results.append({
@@ -1016,13 +1366,13 @@ def calculator():
     property_id = request.args.get('id')
     if property_id:
         property = Property.query.get_or_404(property_id)
-        return render_template('calculator_test.html', property=property.to_dict())
+        return render_template('calculator_test.html', property=property.to_dict(include_legal_pack=True))
     return render_template('calculator_test.html')
 
 @app.route('/property/<int:property_id>')
 def property_details(property_id):
     property = Property.query.get_or_404(property_id)
-    return render_template('calculator_test.html', property=property.to_dict())
+    return render_template('calculator_test.html', property=property.to_dict(include_legal_pack=True))
 
 @app.route('/api/properties/<int:property_id>', methods=['DELETE'])
 def delete_property(property_id):
@@ -1081,14 +1431,8 @@ def update_property(property_id):
         property.viewing_date_3 = datetime.fromisoformat(data['viewing_date_3'].replace('Z', '+00:00')) if data.get('viewing_date_3') else None
         property.viewing_date_4 = datetime.fromisoformat(data['viewing_date_4'].replace('Z', '+00:00')) if data.get('viewing_date_4') else None
         
-        # Update calculated fields
-        property.stamp_duty = data.get('stamp_duty')
-        property.total_purchase_fees = data.get('total_purchase_fees')
-        property.total_money_needed = data.get('total_money_needed')
-        property.cash_left_in_deal = data.get('cash_left_in_deal')
-        property.annual_profit = data.get('annual_profit')
-        property.total_roi = data.get('total_roi')
-        property.total_yield = data.get('total_yield')
+        # Recalculate derived fields server-side rather than trusting the browser
+        deal_engine.apply_metrics(property)
         
         db.session.commit()
         return jsonify(property.to_dict()), 200
@@ -1169,11 +1513,350 @@ def get_property(property_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Upper bound on grid size for the sensitivity endpoint
+MAX_SENSITIVITY_POINTS = 250000
+
+def _grid_axis(name, centre, spread, steps):
+    """Read a sensitivity axis (low, high, count) from the query string, defaulting around centre.
+
+    The axis is only built with np.linspace once the whole grid's size has been
+    checked, so a huge step count is a 400 rather than a giant allocation.
+    """
+    low = request.args.get(f'{name}_min', type=float)
+    high = request.args.get(f'{name}_max', type=float)
+    count = request.args.get(f'{name}_steps', default=steps, type=int)
+    if low is None:
+        low = centre - spread
+    if high is None:
+        high = centre + spread
+    if not math.isfinite(low) or not math.isfinite(high):
+        raise ValueError(f"{name}_min and {name}_max must be finite numbers")
+    if not 1 <= count <= MAX_SENSITIVITY_POINTS:
+        raise ValueError(f"{name}_steps must be between 1 and {MAX_SENSITIVITY_POINTS}")
+    return low, high, count
+
+def _finite_list(values, decimals=4):
+    """Flatten an array into a JSON-safe list, mapping inf/NaN to None."""
+    flat = np.round(np.ravel(values), decimals)
+    return [v if math.isfinite(v) else None for v in flat.tolist()]
+
+@app.route('/api/properties/<int:property_id>/sensitivity', methods=['GET'])
+def property_sensitivity(property_id):
+    """ROI and yield across a purchase price x mortgage rate x rent grid.
+
+    Defaults to 50 x 50 x 20 points around the property's own values. Results
+    are flattened row-major with the shape given in the payload.
+    """
+    try:
+        property = Property.query.get_or_404(property_id)
+        price = property.purchase_price or 0
+        rate = property.mortgage_rate or 0
+        rent = property.monthly_rent or 0
+
+        specs = {
+            'purchase_price': _grid_axis('price', price, price * 0.2, 50),
+            'mortgage_rate': _grid_axis('rate', rate, 2.0, 50),
+            'monthly_rent': _grid_axis('rent', rent, rent * 0.2, 20)
+        }
+        shape = tuple(count for _, _, count in specs.values())
+        if math.prod(shape) > MAX_SENSITIVITY_POINTS:
+            raise ValueError(f"Grid has {math.prod(shape)} points, maximum is {MAX_SENSITIVITY_POINTS}")
+        axes = {field: np.linspace(low, high, count) for field, (low, high, count) in specs.items()}
+
+        started = time.perf_counter()
+        results = deal_engine.sensitivity_grid(property, axes)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        return jsonify({
+            'property_id': property_id,
+            'axes': {field: np.round(values, 4).tolist() for field, values in axes.items()},
+            'shape': list(shape),
+            'total_roi': _finite_list(results['total_roi']),
+            'total_yield': _finite_list(results['total_yield']),
+            'elapsed_ms': round(elapsed_ms, 2)
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Upper bound on Monte Carlo scenarios per property, and across a whole portfolio run
+MAX_SIMULATION_SCENARIOS = 1000000
+MAX_PORTFOLIO_SIMULATION_SCENARIOS = int(os.environ.get('MAX_PORTFOLIO_SIMULATION_SCENARIOS', 20000000))
+
+def _optional_int(data, name):
+    """An optional integer request field; bools, floats and strings are rejected."""
+    value = data.get(name)
+    if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+        raise ValueError(f"{name} must be an integer")
+    return value
+
+def _simulation_options(data):
+    """Validate the common Monte Carlo request options."""
+    scenarios = int(data.get('scenarios', 100000))
+    if not 1 <= scenarios <= MAX_SIMULATION_SCENARIOS:
+        raise ValueError(f"scenarios must be between 1 and {MAX_SIMULATION_SCENARIOS}")
+    assumptions = data.get('assumptions') or {}
+    unknown = set(assumptions) - set(deal_simulation.DEFAULT_ASSUMPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown assumptions: {', '.join(sorted(unknown))}")
+    seed = _optional_int(data, 'seed')
+    if seed is not None and seed < 0:
+        raise ValueError("seed must be a non-negative integer")
+    return {
+        'scenarios': scenarios,
+        'seed': seed,
+        'assumptions': {name: float(value) for name, value in assumptions.items()}
+    }
+
+@app.route('/api/properties/<int:property_id>/simulate', methods=['POST'])
+def simulate_property(property_id):
+    """Monte Carlo percentile bands for annual profit, cash left in deal and flip profit (run in the CPU pool)."""
+    try:
+        property = Property.query.get_or_404(property_id)
+        options = _simulation_options(request.get_json(silent=True) or {})
+
+        # Plain inputs, not the ORM row, go to the CPU pool
+        inputs = {field: getattr(property, field) for field in deal_engine.INPUT_FIELDS}
+
+        started = time.perf_counter()
+        result = cpu_pool.run(deal_simulation.simulate_deal, inputs, **options)
+        result['elapsed_seconds'] = round(time.perf_counter() - started, 4)
+        result['property_id'] = property_id
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/properties/simulate', methods=['POST'])
+def simulate_properties():
+    """Run the Monte Carlo simulation for every property in the CPU pool, optionally fanned out across `workers` processes."""
+    try:
+        data = request.get_json(silent=True) or {}
+        options = _simulation_options(data)
+        workers = _optional_int(data, 'workers')
+
+        input_columns = [getattr(Property, field) for field in deal_engine.INPUT_FIELDS]
+        rows = [row._asdict() for row in db.session.query(Property.id, *input_columns).all()]
+        if options['scenarios'] * len(rows) > MAX_PORTFOLIO_SIMULATION_SCENARIOS:
+            raise ValueError(f"{options['scenarios']} scenarios x {len(rows)} properties exceeds the "
+                             f"limit of {MAX_PORTFOLIO_SIMULATION_SCENARIOS} scenarios per request")
+
+        started = time.perf_counter()
+        results = cpu_pool.run(deal_simulation.simulate_portfolio, rows, workers=workers, **options)
+        return jsonify({
+            'properties': {str(property_id): result['metrics'] for property_id, result in results.items()},
+            'scenarios_per_property': options['scenarios'],
+            'assumptions': dict(deal_simulation.DEFAULT_ASSUMPTIONS, **options['assumptions']),
+            'elapsed_seconds': round(time.perf_counter() - started, 4)
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def _bid_targets(data):
+    """Read the goal-seek targets (target_roi in %, max_cash_left in £) from a request body."""
+    target_roi = data.get('target_roi')
+    max_cash_left = data.get('max_cash_left')
+    if target_roi is None and max_cash_left is None:
+        raise ValueError("Provide target_roi and/or max_cash_left")
+    return {
+        'target_roi': float(target_roi) if target_roi is not None else None,
+        'max_cash_left': float(max_cash_left) if max_cash_left is not None else None
+    }
+
+def solve_max_bids(properties, target_roi=None, max_cash_left=None):
+    """Maximum purchase price for each property that still meets the targets, in one batched solve."""
+    inputs = deal_engine.deal_inputs_from_properties(properties)
+    max_bids = deal_engine.max_purchase_price(inputs, target_roi=target_roi, max_cash_left=max_cash_left)
+    at_max_bid = deal_engine.calculate_deal(**dict(inputs, purchase_price=np.nan_to_num(max_bids)))
+
+    bids = []
+    for index, prop in enumerate(properties):
+        max_bid = float(max_bids[index]) if math.isfinite(max_bids[index]) else None
+        bids.append({
+            'property_id': prop.id,
+            'address': prop.address,
+            'auction_date': prop.auction_date.isoformat() if prop.auction_date else None,
+            'purchase_price': prop.purchase_price,
+            'max_bid': max_bid,
+            'headroom': max_bid - (prop.purchase_price or 0) if max_bid is not None else None,
+            'metrics_at_max_bid': deal_engine.metrics_for_row(at_max_bid, index) if max_bid is not None else None
+        })
+    return bids
+
+@app.route('/api/properties/<int:property_id>/max-bid', methods=['POST'])
+def property_max_bid(property_id):
+    """Highest purchase price that still hits a target ROI and/or cash left in deal."""
+    try:
+        property = Property.query.get_or_404(property_id)
+        targets = _bid_targets(request.get_json(silent=True) or {})
+        return jsonify(dict(solve_max_bids([property], **targets)[0], **targets))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/auctions/max-bids', methods=['POST'])
+def auction_max_bids():
+    """Maximum bids for every auction lot on a given auction_date in one call."""
+    try:
+        data = request.get_json(silent=True) or {}
+        targets = _bid_targets(data)
+        if not data.get('auction_date'):
+            raise ValueError("auction_date is required (YYYY-MM-DD)")
+        auction_date = datetime.strptime(data['auction_date'], '%Y-%m-%d').date()
+
+        lots = Property.query.filter(
+            Property.is_auction.is_(True),
+            Property.auction_date == auction_date
+        ).order_by(Property.id).all()
+
+        started = time.perf_counter()
+        bids = solve_max_bids(lots, **targets) if lots else []
+        return jsonify({
+            'auction_date': auction_date.isoformat(),
+            'lots': bids,
+            'elapsed_seconds': round(time.perf_counter() - started, 4),
+            **targets
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Columns /api/properties/ranked can sort by
+RANKING_COLUMNS = ('total_roi', 'total_yield', 'annual_profit', 'cash_left_in_deal')
+
+@app.route('/api/properties/ranked', methods=['GET'])
+def ranked_properties():
+    """Top properties by a derived metric, served from the indexed deal_metrics table.
+
+    Query parameters: order_by (default total_roi), direction (desc/asc), limit,
+    min_bedrooms, max_station_distance, max_price, auction_only.
+    """
+    try:
+        order_by = request.args.get('order_by', 'total_roi')
+        if order_by not in RANKING_COLUMNS:
+            raise ValueError(f"order_by must be one of: {', '.join(RANKING_COLUMNS)}")
+        limit = max(1, min(request.args.get('limit', default=50, type=int), 500))
+        sort_column = getattr(DealMetrics, order_by)
+        sort = sort_column.asc() if request.args.get('direction') == 'asc' else sort_column.desc()
+
+        query = db.session.query(DealMetrics, Property.address, Property.main_photo).join(
+            Property, Property.id == DealMetrics.property_id
+        ).filter(sort_column.isnot(None))
+
+        min_bedrooms = request.args.get('min_bedrooms', type=int)
+        if min_bedrooms is not None:
+            query = query.filter(DealMetrics.bedrooms >= min_bedrooms)
+        max_station_distance = request.args.get('max_station_distance', type=float)
+        if max_station_distance is not None:
+            query = query.filter(DealMetrics.station_distance < max_station_distance)
+        max_price = request.args.get('max_price', type=float)
+        if max_price is not None:
+            query = query.filter(DealMetrics.purchase_price <= max_price)
+        if request.args.get('auction_only') == 'true':
+            query = query.filter(DealMetrics.is_auction.is_(True))
+
+        results = query.order_by(sort).limit(limit).all()
+        return jsonify([
+            dict(metrics.to_dict(), address=address, main_photo=main_photo)
+            for metrics, address, main_photo in results
+        ])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Fields left out of /api/properties unless requested with ?fields= (they live in side tables)
+PROPERTY_HEAVY_FIELDS = tuple(LEGAL_PACK_SIDE_TABLES)
+# Text columns holding JSON that the API returns decoded
+PROPERTY_JSON_FIELDS = ('key_features', 'legal_pack_qa_history', 'legal_pack_documents')
+MAX_PROPERTY_PAGE_SIZE = 500
+
+def _property_list_fields(fields_param):
+    """Resolve the ?fields= projection, defaulting to every column except the heavy blobs."""
+    columns = Property.__table__.columns.keys()
+    if not fields_param:
+        return columns
+    all_fields = columns + list(PROPERTY_HEAVY_FIELDS)
+    fields = [field.strip() for field in fields_param.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in all_fields]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+def _property_list_value(field, value):
+    """Serialize a projected column the same way Property.to_dict() does."""
+    if field in PROPERTY_JSON_FIELDS:
+        return json.loads(value) if value else []
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+def _encode_property_cursor(created_at, property_id):
+    payload = json.dumps([(created_at or PROPERTY_CREATED_AT_BACKFILL).isoformat(), property_id])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def _decode_property_cursor(cursor):
+    try:
+        created_at, property_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(property_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
 @app.route('/api/properties', methods=['GET'])
 def get_properties():
+    """List properties newest first.
+
+    ?fields=a,b,c projects the columns returned; the legal pack blobs are only
+    included when named explicitly. ?limit=N enables keyset pagination on
+    (created_at, id): the cursor for the next page comes back in the
+    X-Next-Cursor header and is passed back as ?cursor=.
+    """
     try:
-        properties = Property.query.order_by(Property.created_at.desc()).all()
-        return jsonify([p.to_dict() for p in properties])
+        fields = _property_list_fields(request.args.get('fields'))
+        limit = request.args.get('limit', type=int)
+        cursor = request.args.get('cursor')
+
+        selected = []
+        side_tables = []
+        for field in dict.fromkeys(['id', 'created_at'] + fields):
+            if field in LEGAL_PACK_SIDE_TABLES:
+                model = LEGAL_PACK_SIDE_TABLES[field]
+                selected.append(model.content.label(field))
+                side_tables.append(model)
+            else:
+                selected.append(getattr(Property, field))
+        query = db.session.query(*selected).select_from(Property)
+        for model in side_tables:
+            query = query.outerjoin(model, model.property_id == Property.id)
+        query = query.order_by(Property.created_at.desc(), Property.id.desc())
+        if cursor:
+            created_at, last_id = _decode_property_cursor(cursor)
+            query = query.filter(db.tuple_(Property.created_at, Property.id) < (created_at, last_id))
+        if limit:
+            limit = max(1, min(limit, MAX_PROPERTY_PAGE_SIZE))
+            query = query.limit(limit + 1)
+
+        rows = query.all()
+        next_cursor = None
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = _encode_property_cursor(rows[-1].created_at, rows[-1].id)
+
+        response = jsonify([
+            {field: _property_list_value(field, getattr(row, field)) for field in fields}
+            for row in rows
+        ])
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print("Error fetching properties:", str(e))
         return jsonify({'error': 'Failed to fetch properties', 'details': str(e)}), 500
@@ -1235,13 +1918,6 @@ def create_property():
             key_risks=data.get('key_risks'),
             extra_fees=data.get('extra_fees', 0),
             auction_date=auction_date,
-            stamp_duty=data.get('stamp_duty'),
-            total_purchase_fees=data.get('total_purchase_fees'),
-            total_money_needed=data.get('total_money_needed'),
-            cash_left_in_deal=data.get('cash_left_in_deal'),
-            annual_profit=data.get('annual_profit'),
-            total_roi=data.get('total_roi'),
-            total_yield=data.get('total_yield'),
             legal_pack_analysis=data.get('legal_pack_analysis'),
             legal_pack_qa_history=data.get('legal_pack_qa_history'),
             legal_pack_documents=data.get('legal_pack_documents'),
@@ -1254,6 +1930,9 @@ def create_property():
             viewing_date_4=datetime.fromisoformat(data['viewing_date_4'].replace('Z', '+00:00')) if data.get('viewing_date_4') else None,
         )
         
+        # Calculated fields come from the deal engine, not the request body
+        deal_engine.apply_metrics(property)
+        
         db.session.add(property)
         db.session.commit()
         
@@ -1263,6 +1942,86 @@ def create_property():
         print("Error details:", str(e))
         return jsonify({'error': 'Failed to create property', 'details': str(e)}), 400
 
+MAX_RECOMPUTE_CHUNK_SIZE = 5000
+
+def recompute_portfolio(rate_overrides=None, chunk_size=500):
+    """Re-price every property in one vectorized pass and write the results back in chunks.
+
+    rate_overrides maps rate columns (as stored, i.e. percentages) to the new value
+    applied to every row, e.g. {'mortgage_rate': 6.25}.
+    """
+    rate_overrides = rate_overrides or {}
+    unknown = set(rate_overrides) - set(deal_engine.PERCENT_FIELDS)
+    if unknown:
+        raise ValueError(f"Unsupported rate fields: {', '.join(sorted(unknown))}")
+    if isinstance(chunk_size, bool) or not isinstance(chunk_size, int) or not 1 <= chunk_size <= MAX_RECOMPUTE_CHUNK_SIZE:
+        raise ValueError(f"chunk_size must be an integer between 1 and {MAX_RECOMPUTE_CHUNK_SIZE}")
+    for field, value in rate_overrides.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(f"{field} must be a finite number")
+
+    started = time.perf_counter()
+
+    # Only read the calculator inputs (plus what deal_metrics mirrors), not the wide property rows
+    fields = dict.fromkeys(deal_engine.INPUT_FIELDS + DEAL_METRIC_COLUMNS)
+    input_columns = [getattr(Property, field) for field in fields]
+    rows = [row._asdict() for row in db.session.query(Property.id, *input_columns).all()]
+    for row in rows:
+        row.update(rate_overrides)
+    loaded = time.perf_counter()
+
+    results = deal_engine.calculate_properties(rows)
+    computed = time.perf_counter()
+
+    updates = []
+    metric_rows = []
+    for index, row in enumerate(rows):
+        values = deal_engine.metrics_for_row(results, index)
+        values.update(rate_overrides)
+        values['id'] = row['id']
+        updates.append(values)
+        row.update(values)
+        metric_rows.append(dict({column: row[column] for column in DEAL_METRIC_COLUMNS}, property_id=row['id']))
+
+    # Bulk UPDATEs bypass the mapper events, so deal_metrics is synced alongside each chunk
+    chunks = 0
+    for start in range(0, len(updates), chunk_size):
+        db.session.execute(db.update(Property), updates[start:start + chunk_size])
+        sync_deal_metrics(db.session.connection(), metric_rows[start:start + chunk_size])
+        chunks += 1
+    db.session.commit()
+    finished = time.perf_counter()
+
+    stats = {
+        'properties': len(rows),
+        'chunks': chunks,
+        'rate_overrides': rate_overrides,
+        'load_seconds': round(loaded - started, 4),
+        'compute_seconds': round(computed - loaded, 4),
+        'write_seconds': round(finished - computed, 4),
+        'total_seconds': round(finished - started, 4)
+    }
+    logger.info(f"Recomputed {stats['properties']} properties in {stats['total_seconds']}s ({chunks} chunks)")
+    return stats
+
+@app.route('/api/properties/recompute', methods=['POST'])
+def recompute_properties():
+    """Re-price the whole portfolio, optionally under new rate assumptions."""
+    try:
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            raise ValueError("Request body must be a JSON object")
+        chunk_size = data.pop('chunk_size', 500)
+        stats = recompute_portfolio(rate_overrides=data, chunk_size=chunk_size)
+        return jsonify(stats), 200
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error recomputing portfolio: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/scrape-property', methods=['POST'])
 def scrape_property():
     url = request.json.get('url')
@@ -1297,8 +2056,304 @@ def legal_pack_analyzer(property_id):
     property_data = Property.query.get(property_id)
     return render_template('legal_pack_analyzer.html', property=property_data, property_id=property_id)
 
+def complete_legal_pack_analysis(property_id, processed_files, failed_files, processing_summary, on_text=None):
+    """Store the extracted text, run the Claude analysis and save it on the property.
+
+    Returns the summary that /analyze-legal-pack used to return synchronously.
+    """
+    # Combine all text from processed files
+    all_text = [doc['content'] for doc in processed_files]
+    combined_text = '\n\n'.join(all_text)
+    total_chars = len(combined_text)
+    total_words = len(combined_text.split())
+
+    app.logger.info("Document processing completed:")
+    app.logger.info(f"- Total files processed: {len(processed_files)}")
+    app.logger.info(f"- Total characters: {total_chars}")
+    app.logger.info(f"- Total words: {total_words}")
+
+    # Store the extracted text in Analysis table
+    analysis = Analysis(
+        property_id=property_id,
+        content=combined_text,
+        timestamp=datetime.utcnow()
+    )
+    db.session.add(analysis)
+    db.session.commit()
+    app.logger.info(f"Analysis saved to database with ID: {analysis.id}")
+
+    # Perform Claude analysis
+    app.logger.info("Starting Claude analysis...")
+    session_id = str(uuid.uuid4())
+    analysis_result = analyze_with_claude(
+        documents_content=processed_files,
+        processing_summary=processing_summary,
+        on_text=on_text
+    )
+
+    if analysis_result:
+        # Update property with analysis results
+        property_record = Property.query.get(property_id)
+        if property_record:
+            property_record.legal_pack_analysis = analysis_result
+            property_record.legal_pack_analyzed_at = datetime.utcnow()
+            property_record.legal_pack_session_id = session_id
+            # Follow-up questions retrieve passages from this instead of re-reading the pack
+            property_record.legal_pack_index = cpu_pool.run(chunk_index.build_json, processed_files)
+            db.session.commit()
+            app.logger.info("Analysis results saved to property record")
+
+    # Calculate token usage for each document
+    token_usage = {
+        'total_tokens': sum(doc['tokens'] for doc in processed_files),
+        'documents': [
+            {
+                'name': doc['name'],
+                'tokens': doc['tokens']
+            }
+            for doc in processed_files
+        ]
+    }
+
+    return {
+        'message': 'Analysis completed successfully',
+        'session_id': session_id,
+        'analysis_id': analysis.id,
+        'analysis': analysis_result,
+        'stats': {
+            'total_files': len(processed_files),
+            'total_characters': total_chars,
+            'total_words': total_words,
+            'failed_files': len(failed_files)
+        },
+        'token_usage': token_usage,
+        'processing_summary': processing_summary
+    }
+
+LEGAL_PACK_WORKERS = int(os.environ.get('LEGAL_PACK_WORKERS', 2))
+LEGAL_PACK_POLL_SECONDS = float(os.environ.get('LEGAL_PACK_POLL_SECONDS', 10))
+LEGAL_PACK_UPLOAD_DIR = os.path.join(app.config['UPLOAD_FOLDER'], 'legal_packs')
+# A running job bumps updated_at this often; one silent for LEGAL_PACK_STALE_SECONDS lost its worker
+LEGAL_PACK_HEARTBEAT_SECONDS = float(os.environ.get('LEGAL_PACK_HEARTBEAT_SECONDS', 30))
+LEGAL_PACK_STALE_SECONDS = float(os.environ.get('LEGAL_PACK_STALE_SECONDS', 300))
+LEGAL_PACK_MAX_ATTEMPTS = int(os.environ.get('LEGAL_PACK_MAX_ATTEMPTS', 3))
+os.makedirs(LEGAL_PACK_UPLOAD_DIR, exist_ok=True)
+
+_legal_pack_queue = queue.Queue()
+_legal_pack_workers = []
+_legal_pack_workers_lock = threading.Lock()
+
+class LegalPackJobProgress:
+    """process_zip_file progress callback that persists counters on a LegalPackJob.
+
+    Commits are throttled to one per PROGRESS_COMMIT_SECONDS except when a file
+    finishes, so polling clients see steady progress without a write per page.
+    """
+    PROGRESS_COMMIT_SECONDS = 1.0
+    TEXT_COMMIT_SECONDS = 1.0
+
+    def __init__(self, job):
+        self.job = job
+        self.file_pages = {}
+        self.last_commit = 0.0
+        self.analysis_parts = []
+
+    def __call__(self, event, name, **info):
+        job = self.job
+        if event == 'file_started':
+            job.current_file = name
+        elif event == 'pages':
+            previous_done, previous_total = self.file_pages.get(name, (0, 0))
+            job.pages_total = (job.pages_total or 0) + info['total'] - previous_total
+            job.pages_done = (job.pages_done or 0) + info['done'] - previous_done
+            self.file_pages[name] = (info['done'], info['total'])
+        elif event == 'file_done':
+            job.files_done = (job.files_done or 0) + 1
+            job.files_total = max(job.files_total or 0, job.files_done)
+
+        now = time.monotonic()
+        if event != 'pages' or now - self.last_commit >= self.PROGRESS_COMMIT_SECONDS:
+            db.session.commit()
+            self.last_commit = now
+
+    def analysis_text(self, text):
+        """analyze_with_claude on_text callback: collect streamed text, saving it at most once per TEXT_COMMIT_SECONDS."""
+        self.analysis_parts.append(text)
+        now = time.monotonic()
+        if now - self.last_commit >= self.TEXT_COMMIT_SECONDS:
+            self.flush_analysis_text()
+            db.session.commit()
+            self.last_commit = now
+
+    def flush_analysis_text(self):
+        """Copy the text collected so far onto the job (the caller commits)."""
+        if self.analysis_parts:
+            self.job.analysis_text = ''.join(self.analysis_parts)
+
+@contextlib.contextmanager
+def legal_pack_heartbeat(job_id):
+    """Bump a running job's updated_at every LEGAL_PACK_HEARTBEAT_SECONDS until the block exits.
+
+    Progress commits bump it too, but a long extraction or Claude call can go
+    minutes without one. The beat runs on its own connection so it never
+    commits the job's half-made changes.
+    """
+    stop = threading.Event()
+    table = LegalPackJob.__table__
+
+    def beat():
+        while not stop.wait(LEGAL_PACK_HEARTBEAT_SECONDS):
+            try:
+                with app.app_context(), db.engine.begin() as connection:
+                    connection.execute(table.update()
+                                       .where(table.c.id == job_id, table.c.status == 'running')
+                                       .values(updated_at=datetime.utcnow()))
+            except Exception as e:
+                logger.warning(f"Heartbeat for legal pack job {job_id} failed: {str(e)}")
+
+    Thread(target=beat, name=f'legal-pack-heartbeat-{job_id}', daemon=True).start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+def _stale_legal_pack_job():
+    """Running jobs whose heartbeat stopped: the worker died (recycled, timed out, OOM-killed, deployed over)."""
+    cutoff = datetime.utcnow() - timedelta(seconds=LEGAL_PACK_STALE_SECONDS)
+    return db.and_(LegalPackJob.status == 'running', LegalPackJob.updated_at < cutoff)
+
+def _fail_abandoned_legal_pack_jobs():
+    """Fail stale jobs that have used up LEGAL_PACK_MAX_ATTEMPTS and delete their uploads."""
+    abandoned = db.and_(_stale_legal_pack_job(), LegalPackJob.attempts >= LEGAL_PACK_MAX_ATTEMPTS)
+    for job_id, upload_path in db.session.execute(
+            db.select(LegalPackJob.id, LegalPackJob.upload_path).where(abandoned)).all():
+        failed = db.session.execute(
+            db.update(LegalPackJob)
+            .where(LegalPackJob.id == job_id, abandoned)
+            .values(status='failed', current_file=None, finished_at=datetime.utcnow(),
+                    error=f"The worker running this job stopped {LEGAL_PACK_MAX_ATTEMPTS} times; giving up")
+        ).rowcount
+        db.session.commit()
+        if failed:
+            app.logger.error(f"Legal pack job {job_id} abandoned after {LEGAL_PACK_MAX_ATTEMPTS} attempts")
+            try:
+                os.remove(upload_path)
+            except (OSError, TypeError):
+                pass
+
+def _claim_legal_pack_job(job_id=None):
+    """Atomically move a job (the given one, or the oldest claimable) to running; returns its id or None.
+
+    Queued jobs are claimable, and so are running jobs whose heartbeat has
+    been silent for LEGAL_PACK_STALE_SECONDS, until they have been claimed
+    LEGAL_PACK_MAX_ATTEMPTS times. A reclaimed job starts again from the
+    beginning; finished Claude batches come back from the response cache.
+    """
+    _fail_abandoned_legal_pack_jobs()
+    claimable = db.and_(db.or_(LegalPackJob.status == 'queued', _stale_legal_pack_job()),
+                        LegalPackJob.attempts < LEGAL_PACK_MAX_ATTEMPTS)
+    if job_id is None:
+        job_id = db.session.execute(
+            db.select(LegalPackJob.id).where(claimable)
+            .order_by(LegalPackJob.created_at).limit(1)
+        ).scalar()
+        if job_id is None:
+            return None
+    now = datetime.utcnow()
+    claimed = db.session.execute(
+        db.update(LegalPackJob)
+        .where(LegalPackJob.id == job_id, claimable)
+        .values(status='running', stage='extracting', started_at=now, updated_at=now,
+                attempts=LegalPackJob.attempts + 1, current_file=None, files_done=0,
+                pages_done=0, pages_total=0, analysis_text=None, error=None)
+    ).rowcount
+    db.session.commit()
+    return job_id if claimed else None
+
+def run_legal_pack_job(job_id=None):
+    """Run one queued legal-pack job end to end. Returns the job id it ran, or None.
+
+    The claim is a conditional UPDATE, so a job is run exactly once even when
+    several gunicorn workers poll the same table. While it runs, the job's
+    heartbeat keeps other workers from reclaiming it.
+    """
+    with app.app_context():
+        job_id = _claim_legal_pack_job(job_id)
+        if job_id is None:
+            return None
+        job = db.session.get(LegalPackJob, job_id)
+        app.logger.info(f"Running legal pack job {job_id} for property {job.property_id} (attempt {job.attempts})")
+
+        with legal_pack_heartbeat(job_id):
+            processing_summary = None
+            try:
+                job.files_total = count_zip_documents(job.upload_path)
+                db.session.commit()
+
+                progress = LegalPackJobProgress(job)
+                processed_files, failed_files, processing_summary = process_zip_file(
+                    job.upload_path, progress=progress)
+                job.current_file = None
+                if not processed_files:
+                    raise ValueError('No valid files found in ZIP archive')
+
+                job.stage = 'analyzing'
+                db.session.commit()
+                job.result = complete_legal_pack_analysis(
+                    job.property_id, processed_files, failed_files, processing_summary,
+                    on_text=progress.analysis_text)
+                progress.flush_analysis_text()
+                job.status = 'completed'
+                job.stage = 'done'
+            except Exception as e:
+                app.logger.error(f"Legal pack job {job_id} failed: {str(e)}")
+                db.session.rollback()
+                job.status = 'failed'
+                job.error = str(e)
+                if processing_summary is not None:
+                    job.result = {'processing_summary': processing_summary}
+            finally:
+                job.finished_at = datetime.utcnow()
+                db.session.commit()
+                try:
+                    os.remove(job.upload_path)
+                except OSError:
+                    pass
+        return job_id
+
+def _legal_pack_worker():
+    """Background worker: run jobs handed over by this process, and poll for queued or orphaned jobs left by others."""
+    while True:
+        try:
+            job_id = _legal_pack_queue.get(timeout=LEGAL_PACK_POLL_SECONDS)
+        except queue.Empty:
+            job_id = None
+        try:
+            run_legal_pack_job(job_id)
+        except Exception as e:
+            logger.error(f"Legal pack worker error: {str(e)}")
+
+def start_legal_pack_workers():
+    """Start this process's legal-pack workers on first use."""
+    with _legal_pack_workers_lock:
+        while len(_legal_pack_workers) < LEGAL_PACK_WORKERS:
+            worker = Thread(target=_legal_pack_worker, name=f'legal-pack-worker-{len(_legal_pack_workers)}', daemon=True)
+            worker.start()
+            _legal_pack_workers.append(worker)
+
+def enqueue_legal_pack_job(job_id):
+    start_legal_pack_workers()
+    _legal_pack_queue.put(job_id)
+
 @app.route('/analyze-legal-pack', methods=['POST'])
 def analyze_legal_pack():
+    """Queue a legal pack ZIP for analysis and return the job id at once (202).
+
+    Poll /legal-pack-jobs/<job_id> for progress, or follow
+    /legal-pack-jobs/<job_id>/events to receive it, and the analysis text as it
+    streams, over Server-Sent Events. The finished job's result holds what this
+    endpoint used to return.
+    """
     try:
         app.logger.info("Starting legal pack analysis...")
         
@@ -1317,111 +2372,207 @@ def analyze_legal_pack():
             if not property_id:
                 app.logger.error("Property ID is missing")
                 return jsonify({'error': 'Property ID is required'}), 400
-                
-            app.logger.info(f"Processing ZIP file for property ID: {property_id}")
-            
-            # Create a temporary directory for processing
-            with tempfile.TemporaryDirectory() as temp_dir:
-                app.logger.info(f"Created temporary directory: {temp_dir}")
-                
-                # Save and process the ZIP file
-                zip_path = os.path.join(temp_dir, secure_filename(file.filename))
-                file.save(zip_path)
-                
-                try:
-                    processed_files, failed_files, processing_summary = process_zip_file(zip_path)
-                    if not processed_files:
-                        app.logger.error("No valid files found in ZIP archive")
-                        return jsonify({
-                            'error': 'No valid files found in ZIP archive',
-                            'processing_summary': processing_summary
-                        }), 400
-                        
-                    # Combine all text from processed files
-                    all_text = [doc['content'] for doc in processed_files]
-                    combined_text = '\n\n'.join(all_text)
-                    total_chars = len(combined_text)
-                    total_words = len(combined_text.split())
-                    
-                    app.logger.info("Document processing completed:")
-                    app.logger.info(f"- Total files processed: {len(processed_files)}")
-                    app.logger.info(f"- Total characters: {total_chars}")
-                    app.logger.info(f"- Total words: {total_words}")
-                    
-                    # Create analysis record
-                    try:
-                        # Store the extracted text in Analysis table
-                        analysis = Analysis(
-                            property_id=property_id,
-                            content=combined_text,
-                            timestamp=datetime.utcnow()
-                        )
-                        db.session.add(analysis)
-                        db.session.commit()
-                        app.logger.info(f"Analysis saved to database with ID: {analysis.id}")
-
-                        # Perform Claude analysis
-                        app.logger.info("Starting Claude analysis...")
-                        session_id = str(uuid.uuid4())
-                        analysis_result = analyze_with_claude(
-                            documents_content=processed_files,
-                            processing_summary=processing_summary
-                        )
-
-                        if analysis_result:
-                            # Update property with analysis results
-                            property_record = Property.query.get(property_id)
-                            if property_record:
-                                property_record.legal_pack_analysis = analysis_result
-                                property_record.legal_pack_analyzed_at = datetime.utcnow()
-                                property_record.legal_pack_session_id = session_id
-                                db.session.commit()
-                                app.logger.info("Analysis results saved to property record")
-
-                        # Calculate token usage for each document
-                        token_usage = {
-                            'total_tokens': sum(doc['tokens'] for doc in processed_files),
-                            'documents': [
-                                {
-                                    'name': doc['name'],
-                                    'tokens': doc['tokens']
-                                }
-                                for doc in processed_files
-                            ]
-                        }
-
-                        return jsonify({
-                            'message': 'Analysis completed successfully',
-                            'session_id': session_id,
-                            'analysis_id': analysis.id,
-                            'analysis': analysis_result,
-                            'stats': {
-                                'total_files': len(processed_files),
-                                'total_characters': total_chars,
-                                'total_words': total_words,
-                                'failed_files': len(failed_files)
-                            },
-                            'token_usage': token_usage,
-                            'processing_summary': processing_summary
-                        })
-                    except Exception as e:
-                        app.logger.error(f"Error saving to database: {str(e)}")
-                        return jsonify({
-                            'error': f'Error saving analysis: {str(e)}',
-                            'processing_summary': processing_summary
-                        }), 500
-                except Exception as e:
-                    app.logger.error(f"Error processing ZIP file: {str(e)}")
-                    return jsonify({
-                        'error': f'Error processing ZIP file: {str(e)}'
-                    }), 500
+
+            if not db.session.get(Property, int(property_id)):
+                return jsonify({'error': 'Property not found'}), 404
+
+            job_id = str(uuid.uuid4())
+            upload_path = os.path.join(LEGAL_PACK_UPLOAD_DIR, f"{job_id}.zip")
+            file.save(upload_path)
+
+            job = LegalPackJob(id=job_id, property_id=int(property_id), upload_path=upload_path)
+            db.session.add(job)
+            db.session.commit()
+            enqueue_legal_pack_job(job_id)
+            app.logger.info(f"Queued legal pack job {job_id} for property ID: {property_id}")
+
+            return jsonify(dict(job.to_dict(), status_url=f"/legal-pack-jobs/{job_id}",
+                                events_url=f"/legal-pack-jobs/{job_id}/events")), 202
         else:
             app.logger.error("No file uploaded")
             return jsonify({'error': 'No file uploaded'}), 400
+    except ValueError:
+        return jsonify({'error': 'Property ID must be an integer'}), 400
     except Exception as e:
         app.logger.error(f"Error in analyze_legal_pack: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/legal-pack-jobs/<job_id>', methods=['GET'])
+def legal_pack_job_status(job_id):
+    """Progress of a legal-pack job; includes the analysis result once completed."""
+    try:
+        job = db.session.get(LegalPackJob, job_id)
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+        if job.status in ('queued', 'running'):
+            # After a restart nothing polls the queue until this process has workers again
+            start_legal_pack_workers()
+        return jsonify(job.to_dict())
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+LEGAL_PACK_EVENT_SECONDS = float(os.environ.get('LEGAL_PACK_EVENT_SECONDS', 0.5))
+# An events stream is closed after this long; the page then carries on by polling the status URL
+LEGAL_PACK_EVENTS_MAX_SECONDS = float(os.environ.get('LEGAL_PACK_EVENTS_MAX_SECONDS', 900))
+SSE_KEEPALIVE_SECONDS = 15
+
+def sse_event(event, data):
+    """One Server-Sent Events message with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def sse_response(events):
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/legal-pack-jobs/<job_id>/events', methods=['GET'])
+def legal_pack_job_events(job_id):
+    """Server-Sent Events for a legal-pack job.
+
+    `progress` events carry the job's counters whenever they change, `token`
+    events the consolidated analysis text as it streams, and the stream ends
+    with `done` (the job result) or `failed`. The job may run in another
+    worker process, so this follows the job row rather than the Claude stream.
+    Streams are closed after LEGAL_PACK_EVENTS_MAX_SECONDS; the page then
+    falls back to polling the status URL.
+    """
+    if not db.session.get(LegalPackJob, job_id):
+        return jsonify({'error': 'Job not found'}), 404
+    start_legal_pack_workers()
+
+    def events():
+        sent_progress = None
+        sent_chars = 0
+        last_sent = time.monotonic()
+        deadline = last_sent + LEGAL_PACK_EVENTS_MAX_SECONDS
+        while time.monotonic() < deadline:
+            job = db.session.get(LegalPackJob, job_id)
+            if job is None:
+                yield sse_event('failed', {'error': 'Job not found'})
+                return
+            progress = {key: value for key, value in job.to_dict().items() if key not in ('analysis_text', 'result')}
+            if progress != sent_progress:
+                yield sse_event('progress', progress)
+                sent_progress = progress
+                last_sent = time.monotonic()
+            text = job.analysis_text or ''
+            if len(text) > sent_chars:
+                yield sse_event('token', {'text': text[sent_chars:]})
+                sent_chars = len(text)
+                last_sent = time.monotonic()
+            if job.status == 'completed':
+                yield sse_event('done', job.result)
+                return
+            if job.status == 'failed':
+                yield sse_event('failed', {'error': job.error, 'result': job.result})
+                return
+            if time.monotonic() - last_sent >= SSE_KEEPALIVE_SECONDS:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            # End the read transaction so the next pass sees the worker's commits
+            db.session.rollback()
+            time.sleep(LEGAL_PACK_EVENT_SECONDS)
+        db.session.remove()
+
+    return sse_response(events())
+
+FOLLOWUP_TOP_K = int(os.environ.get('FOLLOWUP_TOP_K', 8))
+
+def load_legal_pack_index(property):
+    """Return the property's ChunkIndex, building it for packs analysed before the index existed."""
+    if property.legal_pack_index:
+        return ChunkIndex.from_json(property.legal_pack_index)
+
+    if property.legal_pack_documents:
+        documents = json.loads(property.legal_pack_documents)
+    else:
+        analysis = Analysis.query.filter_by(property_id=property.id).order_by(Analysis.timestamp.desc()).first()
+        if not analysis or not analysis.content:
+            return None
+        documents = [{'name': 'Legal pack', 'content': analysis.content}]
+
+    index = ChunkIndex.build(documents)
+    property.legal_pack_index = index.to_json()
+    db.session.commit()
+    return index
+
+def save_followup_answer(property, question, answer, usage=None):
+    """Append a question and its answer to the property's Q&A history; returns the updated history."""
+    qa_history = json.loads(property.legal_pack_qa_history) if property.legal_pack_qa_history else []
+    qa_history.append({
+        'question': question,
+        'answer': answer,
+        'timestamp': datetime.utcnow().isoformat(),
+        'usage': usage
+    })
+    property.legal_pack_qa_history = json.dumps(qa_history)
+    db.session.commit()
+    logger.info("Updated QA history")
+    return qa_history
+
+@app.route('/property/ask_followup/stream', methods=['POST'])
+def ask_followup_stream():
+    """Answer a follow-up question over Server-Sent Events.
+
+    Sends `token` events as Claude writes the answer. When the stream ends the
+    answer is saved to the Q&A history and a `done` event carries the new
+    entry; a Claude failure ends the stream with `failed`.
+    """
+    try:
+        data = request.get_json() or {}
+        question = (data.get('question') or '').strip()
+        property_id = data.get('property_id')
+        if not question or not property_id:
+            return jsonify({'error': 'Missing required information: question and property_id'}), 400
+
+        property = db.session.get(Property, int(property_id))
+        if not property or not property.legal_pack_analysis:
+            return jsonify({
+                'error': 'No legal pack analysis found',
+                'suggestion': 'Please analyze the legal pack first'
+            }), 404
+        index = load_legal_pack_index(property)
+        if index is None:
+            return jsonify({
+                'error': 'No legal pack documents found',
+                'suggestion': 'Please analyze the legal pack first'
+            }), 404
+
+        api_key = os.getenv('CLAUDE_API_KEY')
+        if not api_key:
+            return jsonify({'error': 'CLAUDE_API_KEY environment variable is not set'}), 500
+        client = claude_client.make_client(api_key, timeout=300)
+
+        qa_history = json.loads(property.legal_pack_qa_history) if property.legal_pack_qa_history else []
+        passages = [chunk for _, chunk in index.search(question, k=FOLLOWUP_TOP_K)]
+        followup = followup_request(question, passages, property.legal_pack_analysis, qa_history)
+        property_id = property.id
+    except ValueError:
+        return jsonify({'error': 'Property ID must be an integer'}), 400
+    except Exception as e:
+        logger.error(f"Error preparing streamed follow-up: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        # Don't hold a connection and transaction open while Claude streams; events() opens a new session to save
+        db.session.remove()
+
+    def events():
+        parts = []
+        usage = {}
+        try:
+            on_message = lambda message: usage.update(claude_client.usage_summary(message))
+            for text in claude_client.stream_message(client, on_message=on_message,
+                                                     priority=rate_limiter.INTERACTIVE, **followup):
+                parts.append(text)
+                yield sse_event('token', {'text': text})
+            qa_history = save_followup_answer(db.session.get(Property, property_id), question, ''.join(parts), usage)
+            yield sse_event('done', qa_history[-1])
+        except Exception as e:
+            logger.error(f"Streamed follow-up failed: {str(e)}")
+            db.session.rollback()
+            yield sse_event('failed', {'error': f"Failed to get answer from Claude: {str(e)}"})
+
+    return sse_response(events())
+
 @app.route('/property/ask_followup', methods=['POST'])
 def ask_followup():
     """Handle follow-up questions about the legal pack."""
@@ -1454,34 +2605,29 @@ def ask_followup():
                     'suggestion': 'Please check the property ID'
                 }), 404
 
-            if not property.legal_pack_analysis or not property.legal_pack_documents:
+            if not property.legal_pack_analysis:
                 return jsonify({
-                    'error': 'No legal pack analysis or documents found',
+                    'error': 'No legal pack analysis found',
                     'suggestion': 'Please analyze the legal pack first'
                 }), 404
                 
-            # Get QA history and documents from the property
+            # Get QA history from the property
             qa_history = json.loads(property.legal_pack_qa_history) if property.legal_pack_qa_history else []
             
-            # Get the original documents from the Analysis table
-            analysis = Analysis.query.filter_by(property_id=property_id).order_by(Analysis.timestamp.desc()).first()
-            if not analysis:
+            index = load_legal_pack_index(property)
+            if index is None:
                 return jsonify({
-                    'error': 'No analysis record found',
+                    'error': 'No legal pack documents found',
                     'suggestion': 'Please analyze the legal pack first'
                 }), 404
-                
-            # Format the documents for Claude
-            documents = [{
-                'name': f'Document {i+1}',
-                'content': content.strip()
-            } for i, content in enumerate(analysis.content.split('\n\n')) if content.strip()]
+            passages = [chunk for _, chunk in index.search(question, k=FOLLOWUP_TOP_K)]
+            logger.info(f"Retrieved {len(passages)} of {len(index.chunks)} passages for follow-up")
             
             # Get answer from Claude
             try:
-                result = analyze_with_claude(
-                    documents_content=documents,  # Pass the formatted documents
-                    follow_up_question=question,
+                result, usage = answer_followup(
+                    question,
+                    passages,
                     initial_analysis=property.legal_pack_analysis,
                     qa_history=qa_history
                 )
@@ -1499,24 +2645,18 @@ def ask_followup():
                 }), 500
             
             # Update QA history
-            qa_history.append({
-                'question': question,
-                'answer': result,
-                'timestamp': datetime.utcnow().isoformat()
-            })
-            property.legal_pack_qa_history = json.dumps(qa_history)
-            db.session.commit()
-            logger.info("Updated QA history")
+            qa_history = save_followup_answer(property, question, result, usage)
             
-            # Calculate token usage
+            # Calculate token usage of the passages sent
             token_usage = {
-                'total_tokens': sum(count_tokens(doc['content']) for doc in documents),
+                'claude': usage,
+                'total_tokens': sum(count_tokens(passage['text']) for passage in passages),
                 'documents': [
                     {
-                        'name': doc['name'],
-                        'tokens': count_tokens(doc['content'])
+                        'name': passage['document'],
+                        'tokens': count_tokens(passage['text'])
                     }
-                    for doc in documents
+                    for passage in passages
                 ]
             }
             
@@ -1554,12 +2694,24 @@ def system_check():
         status = {
             'tesseract': False,
             'libreoffice': False,
-            'environment': env_vars
+            'environment': env_vars,
+            'extraction_cache': extraction_cache.stats(),
+            'claude_cache': response_cache.stats(),
+            'token_counting': token_counting.stats(),
+            'claude_usage': dict(claude_client.usage_totals),
+            'claude_rate_limit': claude_client.scheduler.stats()
         }
         
         # Check tesseract
         tesseract_path = shutil.which('tesseract')
         status['tesseract'] = bool(tesseract_path)
+        status['ocr'] = {
+            'engine': ocr.OCR_ENGINE,
+            'vision_client': vision_client is not None,
+            'tesseract_workers': ocr.TESSERACT_WORKERS,
+            'tesseract_threads': ocr.TESSERACT_THREADS,
+            'page_routing': dict(pdf_extraction.routing_stats)
+        }
         
         # Check libreoffice
         soffice_path = shutil.which('soffice')
@@ -0,0 +1,90 @@
+"""
+BM25 passage index over a legal pack's extracted text.
+
+The pack is split into overlapping passages of at most CHUNK_TOKENS tokens
+(on paragraph or sentence boundaries where possible) when it is analysed, and
+the index is stored with the property. A follow-up question then only needs
+the few passages that best match it, so its cost does not grow with the size
+of the pack.
+"""
+import os
+import re
+import math
+import json
+from collections import Counter
+
+from token_counting import chunk_text
+
+CHUNK_TOKENS = int(os.environ.get('CHUNK_TOKENS', 384))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get('CHUNK_OVERLAP_TOKENS', 48))
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TOKEN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were "
+    "will with what which who does do there any".split()
+)
+
+
+def tokenize(text):
+    """Lower-cased word tokens without stopwords."""
+    return [token for token in _TOKEN.findall(text.lower()) if token not in _STOPWORDS]
+
+
+class ChunkIndex:
+    """BM25 index of passages, each tagged with the document it came from."""
+
+    def __init__(self, chunks, postings, lengths):
+        self.chunks = chunks  # [{'document': name, 'text': passage}]
+        self.postings = postings  # term -> [[chunk_id, term_frequency], ...]
+        self.lengths = lengths  # token count per chunk
+        self.avg_length = (sum(lengths) / len(lengths)) if lengths else 0.0
+
+    @classmethod
+    def build(cls, documents, max_tokens=None, overlap_tokens=None):
+        """Index a list of {'name', 'content'} documents."""
+        max_tokens = max_tokens or CHUNK_TOKENS
+        overlap_tokens = CHUNK_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+        chunks = []
+        postings = {}
+        lengths = []
+        for doc in documents:
+            for passage in chunk_text(doc.get('content') or '', max_tokens, overlap_tokens):
+                chunk_id = len(chunks)
+                chunks.append({'document': doc.get('name'), 'text': passage})
+                terms = Counter(tokenize(passage))
+                lengths.append(sum(terms.values()))
+                for term, frequency in terms.items():
+                    postings.setdefault(term, []).append([chunk_id, frequency])
+        return cls(chunks, postings, lengths)
+
+    def search(self, query, k=8):
+        """Return up to k (score, chunk) pairs, best first."""
+        total = len(self.chunks)
+        if not total:
+            return []
+        scores = Counter()
+        for term in set(tokenize(query)):
+            matches = self.postings.get(term)
+            if not matches:
+                continue
+            idf = math.log(1 + (total - len(matches) + 0.5) / (len(matches) + 0.5))
+            for chunk_id, frequency in matches:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[chunk_id] / (self.avg_length or 1))
+                scores[chunk_id] += idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return [(score, self.chunks[chunk_id]) for chunk_id, score in scores.most_common(k)]
+
+    def to_json(self):
+        return json.dumps({'chunks': self.chunks, 'postings': self.postings, 'lengths': self.lengths},
+                          ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        return cls(data['chunks'], data['postings'], data['lengths'])
+
+
+def build_json(documents):
+    """ChunkIndex.build(documents).to_json(), as one call that can run in the CPU pool."""
+    return ChunkIndex.build(documents).to_json()
@@ -0,0 +1,300 @@
+"""
+Helpers for calling the Claude Messages API.
+
+create_message() wraps client.messages.create with retries: rate limits (429),
+overload (529), server errors (5xx), timeouts and connection errors are retried
+with exponential backoff and jitter, honouring the retry-after header when the
+API sends one. Clients should be built with max_retries=0 (see make_client) so
+the SDK does not retry underneath us. Each attempt first waits for the shared
+rate limiter (see rate_limiter.py) in its priority lane, and a 429 pauses
+every worker process for the retry-after period. Every successful call's token usage,
+including prompt-cache reads and writes, is logged and added to usage_totals.
+
+stream_message() is the streaming counterpart of create_message(): it yields
+text as Claude produces it, for answers forwarded to the browser over SSE.
+
+cached_block() marks a content block as the end of a cacheable prefix, so
+calls that repeat the same leading blocks (a legal pack's system prompt and
+initial analysis, say) are served from Anthropic's prompt cache.
+
+StubAnthropicClient answers after a fixed latency and can fail the first few
+calls with 429s, so batching and retries can be benchmarked offline:
+
+    python claude_client.py
+"""
+import os
+import time
+import random
+import types
+import contextlib
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import anthropic
+import httpx
+
+import rate_limiter
+from rate_limiter import BULK
+from token_counting import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+CLAUDE_MAX_ATTEMPTS = int(os.environ.get('CLAUDE_MAX_ATTEMPTS', 5))
+CLAUDE_BACKOFF_BASE = float(os.environ.get('CLAUDE_BACKOFF_BASE', 1.0))
+CLAUDE_BACKOFF_MAX = float(os.environ.get('CLAUDE_BACKOFF_MAX', 60.0))
+# Batches of one legal pack analysed at the same time. Concurrency only helps while the rate limiter's
+# bulk budget, (1 - CLAUDE_INTERACTIVE_RESERVE) x CLAUDE_TOKENS_PER_MINUTE, covers that many ~12k-token
+# batches a minute; the default 40k tokens/min (the lowest API tier) admits about 3. Set
+# CLAUDE_TOKENS_PER_MINUTE and CLAUDE_REQUESTS_PER_MINUTE to the account's tier limits.
+CLAUDE_BATCH_CONCURRENCY = int(os.environ.get('CLAUDE_BATCH_CONCURRENCY', 10))
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+usage_totals = Counter()
+_usage_lock = threading.Lock()
+
+scheduler = rate_limiter.TokenBucketScheduler(
+    rate_limiter.CLAUDE_RATE_LIMIT_FILE,
+    requests_per_minute=rate_limiter.CLAUDE_REQUESTS_PER_MINUTE,
+    tokens_per_minute=rate_limiter.CLAUDE_TOKENS_PER_MINUTE,
+)
+
+
+def make_client(api_key, timeout=300):
+    """Anthropic client with SDK retries disabled; create_message() does the retrying."""
+    return anthropic.Anthropic(api_key=api_key, timeout=timeout, max_retries=0)
+
+
+def cached_block(text):
+    """Text content block that ends a prompt-cache prefix."""
+    return {'type': 'text', 'text': text, 'cache_control': {'type': 'ephemeral'}}
+
+
+def usage_summary(response):
+    """Token usage of one response, including prompt-cache reads and writes."""
+    usage = getattr(response, 'usage', None)
+    return {
+        'input_tokens': getattr(usage, 'input_tokens', 0) or 0,
+        'output_tokens': getattr(usage, 'output_tokens', 0) or 0,
+        'cache_read_input_tokens': getattr(usage, 'cache_read_input_tokens', 0) or 0,
+        'cache_creation_input_tokens': getattr(usage, 'cache_creation_input_tokens', 0) or 0,
+    }
+
+
+def record_usage(response, elapsed=None):
+    """Log one call's usage and add it to usage_totals; returns the summary."""
+    summary = usage_summary(response)
+    with _usage_lock:
+        usage_totals['calls'] += 1
+        usage_totals.update(summary)
+    timing = f" in {elapsed:.1f}s" if elapsed is not None else ""
+    logger.info(f"Claude call{timing}: {summary['input_tokens']} input, {summary['output_tokens']} output, "
+                f"{summary['cache_read_input_tokens']} cache read, "
+                f"{summary['cache_creation_input_tokens']} cache write tokens")
+    return summary
+
+
+def _text_of(content):
+    if isinstance(content, str):
+        return content
+    return ''.join(block.get('text', '') for block in content or [] if isinstance(block, dict))
+
+
+def estimate_input_tokens(kwargs):
+    """Rough input token count of a Messages API request, for the rate limiter."""
+    text = _text_of(kwargs.get('system'))
+    text += ''.join(_text_of(message.get('content')) for message in kwargs.get('messages', []))
+    return estimate_tokens(text)
+
+
+def _admit(priority, kwargs):
+    """Wait for the rate limiter; returns the token estimate charged."""
+    estimated = estimate_input_tokens(kwargs)
+    scheduler.acquire(estimated, priority)
+    return estimated
+
+
+def _settle(estimated, summary):
+    """Replace an attempt's estimate with the input tokens it actually used."""
+    scheduler.settle(estimated, summary['input_tokens'] + summary['cache_creation_input_tokens'])
+
+
+def _refund(estimated):
+    """Give back the estimate of an attempt that failed before Claude produced anything."""
+    scheduler.settle(estimated, 0)
+
+
+def _back_off(attempt, error, max_attempts, action):
+    delay = retry_delay(attempt, error)
+    if isinstance(error, anthropic.RateLimitError):
+        scheduler.pause(delay)
+    logger.warning(f"Claude {action} failed ({type(error).__name__}: {str(error)}); "
+                   f"retrying in {delay:.1f}s (attempt {attempt + 1}/{max_attempts})")
+    time.sleep(delay)
+
+
+def is_retryable(error):
+    if isinstance(error, (anthropic.APIConnectionError, anthropic.APITimeoutError)):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    return False
+
+
+def retry_delay(attempt, error=None):
+    """Seconds to wait before retry number `attempt` (1-based)."""
+    response = getattr(error, 'response', None)
+    if response is not None:
+        retry_after = response.headers.get('retry-after')
+        try:
+            if retry_after is not None:
+                return min(float(retry_after), CLAUDE_BACKOFF_MAX)
+        except ValueError:
+            pass
+    delay = CLAUDE_BACKOFF_BASE * (2 ** (attempt - 1))
+    return min(delay, CLAUDE_BACKOFF_MAX) * random.uniform(0.5, 1.0)
+
+
+def create_message(client, max_attempts=None, priority=BULK, **kwargs):
+    """client.messages.create(**kwargs) through the rate limiter, retrying transient failures with backoff."""
+    max_attempts = max_attempts or CLAUDE_MAX_ATTEMPTS
+    for attempt in range(1, max_attempts + 1):
+        estimated = _admit(priority, kwargs)
+        try:
+            start = time.perf_counter()
+            response = client.messages.create(**kwargs)
+        except Exception as e:
+            _refund(estimated)
+            if attempt == max_attempts or not is_retryable(e):
+                raise
+            _back_off(attempt, e, max_attempts, 'call')
+            continue
+        _settle(estimated, record_usage(response, time.perf_counter() - start))
+        return response
+
+
+def stream_message(client, on_message=None, max_attempts=None, priority=BULK, **kwargs):
+    """Yield text deltas from client.messages.stream(**kwargs).
+
+    Transient failures before the first delta are retried as in create_message();
+    after that the error is raised, because the caller has already forwarded part
+    of the answer. The final message's usage is recorded and it is passed to
+    on_message.
+    """
+    max_attempts = max_attempts or CLAUDE_MAX_ATTEMPTS
+    for attempt in range(1, max_attempts + 1):
+        started = False
+        estimated = _admit(priority, kwargs)
+        try:
+            start = time.perf_counter()
+            with client.messages.stream(**kwargs) as stream:
+                for text in stream.text_stream:
+                    started = True
+                    yield text
+                message = stream.get_final_message()
+            _settle(estimated, record_usage(message, time.perf_counter() - start))
+            if on_message is not None:
+                on_message(message)
+            return
+        except Exception as e:
+            if not started:
+                _refund(estimated)
+            if started or attempt == max_attempts or not is_retryable(e):
+                raise
+            _back_off(attempt, e, max_attempts, 'stream')
+
+
+def map_concurrently(func, items, concurrency=None):
+    """[func(item) for item in items] with at most `concurrency` calls in flight, results in order."""
+    items = list(items)
+    if not items:
+        return []
+    concurrency = max(1, min(concurrency or CLAUDE_BATCH_CONCURRENCY, len(items)))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(func, items))
+
+
+class StubAnthropicClient:
+    """Offline stand-in for anthropic.Anthropic: messages.create sleeps `latency` and echoes a summary.
+
+    The first `rate_limited_calls` calls raise a 429 RateLimitError.
+    """
+
+    def __init__(self, latency=2.0, rate_limited_calls=0):
+        self.latency = latency
+        self.rate_limited_calls = rate_limited_calls
+        self.calls = 0
+        self.messages = self
+
+    def _start_call(self):
+        self.calls += 1
+        if self.calls <= self.rate_limited_calls:
+            request = httpx.Request('POST', 'https://api.anthropic.com/v1/messages')
+            response = httpx.Response(429, request=request, headers={'retry-after': '0'})
+            raise anthropic.RateLimitError('rate limited', response=response, body=None)
+
+    def _message(self, kwargs):
+        prompt = kwargs['messages'][-1]['content']
+        text = prompt if isinstance(prompt, str) else str(prompt)
+        return anthropic.types.Message(
+            id=f'msg_stub_{self.calls}', type='message', role='assistant', model=kwargs.get('model', 'stub'),
+            content=[anthropic.types.TextBlock(type='text', text=f"Analysis of {len(text)} characters")],
+            stop_reason='end_turn', stop_sequence=None,
+            usage=anthropic.types.Usage(input_tokens=len(text) // 4, output_tokens=10),
+        )
+
+    def create(self, **kwargs):
+        self._start_call()
+        time.sleep(self.latency)
+        return self._message(kwargs)
+
+    @contextlib.contextmanager
+    def stream(self, **kwargs):
+        """Like messages.stream: the reply arrives word by word, spread over `latency`."""
+        self._start_call()
+        message = self._message(kwargs)
+        words = message.content[0].text.split(' ')
+
+        def text_stream():
+            for index, word in enumerate(words):
+                time.sleep(self.latency / len(words))
+                yield word if index == 0 else ' ' + word
+
+        yield types.SimpleNamespace(text_stream=text_stream(), get_final_message=lambda: message)
+
+
+def benchmark(batches=10, latency=0.5):
+    """Time serial against concurrent batch calls (plus one consolidation call) on the stub."""
+    prompts = [f"batch {n}" for n in range(batches)]
+
+    def call(client, prompt):
+        return create_message(client, model='stub', max_tokens=10, messages=[{'role': 'user', 'content': prompt}])
+
+    client = StubAnthropicClient(latency)
+    start = time.perf_counter()
+    for prompt in prompts:
+        call(client, prompt)
+    call(client, 'consolidate')
+    serial_seconds = time.perf_counter() - start
+
+    client = StubAnthropicClient(latency, rate_limited_calls=2)
+    start = time.perf_counter()
+    map_concurrently(lambda prompt: call(client, prompt), prompts)
+    call(client, 'consolidate')
+    concurrent_seconds = time.perf_counter() - start
+
+    return {
+        'batches': batches,
+        'latency': latency,
+        'serial_seconds': serial_seconds,
+        'concurrent_seconds': concurrent_seconds,
+    }
+
+
+if __name__ == '__main__':
+    stats = benchmark()
+    print(f"{stats['batches']} batches at {stats['latency']:.1f}s each + consolidation: "
+          f"serial {stats['serial_seconds']:.2f} s, concurrent {stats['concurrent_seconds']:.2f} s "
+          f"(with two 429s retried)")
@@ -0,0 +1,68 @@
+"""
+Shared process pool for CPU-bound steps of the web app.
+
+The web workers are gevent processes, so tiktoken counting, index building
+or encoding a large JSON document in a request or a legal-pack worker blocks
+every other greenlet in that process until it finishes. run() hands such a
+call to a spawn-context process pool instead; the calling greenlet waits on
+the result while the hub keeps serving requests. Like the PDF extraction and
+tesseract pools, workers are spawned rather than forked (the parent is
+gevent-patched) and recycled periodically.
+
+The functions passed to run() must be importable without app.py.
+"""
+import os
+import sys
+import json
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# 0 runs everything in the calling process
+CPU_POOL_WORKERS = int(os.environ.get('CPU_POOL_WORKERS', min(2, os.cpu_count() or 1)))
+CPU_POOL_MAX_TASKS = int(os.environ.get('CPU_POOL_MAX_TASKS', 200))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the shared CPU pool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        # A worker killed by the OOM killer breaks the pool; start a new one
+        if _pool is None or getattr(_pool, '_broken', False):
+            options = {
+                'max_workers': CPU_POOL_WORKERS,
+                'mp_context': multiprocessing.get_context('spawn'),
+            }
+            if sys.version_info >= (3, 11):
+                options['max_tasks_per_child'] = CPU_POOL_MAX_TASKS
+            _pool = ProcessPoolExecutor(**options)
+            logger.info(f"Started CPU pool with {CPU_POOL_WORKERS} workers")
+        return _pool
+
+
+def shutdown_pool():
+    """Stop the shared pool (a new one is started on next use)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
+
+
+def run(fn, *args, **kwargs):
+    """Call fn(*args, **kwargs) in the CPU pool and return its result."""
+    if CPU_POOL_WORKERS <= 0:
+        return fn(*args, **kwargs)
+    return get_pool().submit(fn, *args, **kwargs).result()
+
+
+def write_json(path, data, **options):
+    """json.dump data to path (a pool entry point for large documents)."""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, **options)
@@ -0,0 +1,409 @@
+"""
+Vectorized deal engine.
+
+Server-side port of the PropertyCalculator class in static/js/propertyCalculator.js
+(itself taken from "Copy of Property Calculator Revised.xlsx"). Every function
+accepts scalars or NumPy arrays and broadcasts, so a whole portfolio can be
+priced in one call instead of one property at a time.
+
+Rates are fractions (0.055 for 5.5%), exactly as the JS calculator receives them.
+The Property model stores rates as percentages; use deal_inputs_from_properties()
+to convert rows into engine inputs.
+"""
+import time
+
+import numpy as np
+
+# Constants from Excel (mirrors the PropertyCalculator constructor)
+INSURANCE_COST = 300
+UTILITY_COST_PER_ROOM = 1147
+MAINTENANCE_RATE = 0.04
+SELLING_FEE_RATE = 0.04
+CORPORATION_TAX_RATE = 0.19
+
+# Stamp duty bands as (upper bound, rate). Excel formula: AE3
+STAMP_DUTY_BANDS = (
+    (125000, 0.05),
+    (925000, 0.08),
+    (1500000, 0.13),
+    (np.inf, 0.15),
+)
+
+# Property columns holding percentages that the calculator divides by 100
+PERCENT_FIELDS = (
+    'mortgage_ltv',
+    'mortgage_rate',
+    'lender_fee',
+    'bridging_rate',
+    'arrangement_rate',
+    'broker_rate',
+    'management_fee',
+)
+
+# Property columns feeding the calculator (same names as calculate_deal() arguments)
+INPUT_FIELDS = (
+    'initial_cash',
+    'purchase_price',
+    'extra_fees',
+    'rooms',
+    'monthly_rent',
+    'valuation_after',
+    'renovation_cost',
+    'bridging_duration',
+    'mortgage_ltv',
+    'mortgage_rate',
+    'lender_fee',
+    'bridging_rate',
+    'arrangement_rate',
+    'broker_rate',
+    'management_fee',
+)
+
+# Engine outputs that are persisted on the Property row
+STORED_METRICS = (
+    'stamp_duty',
+    'total_purchase_fees',
+    'total_money_needed',
+    'cash_left_in_deal',
+    'annual_profit',
+    'total_roi',
+    'total_yield',
+)
+
+
+def _as_array(value):
+    """Convert a scalar or sequence to a float array, treating None/NaN as 0 like the JS `|| 0`."""
+    arr = np.asarray(value, dtype=float)
+    return np.nan_to_num(arr, nan=0.0, posinf=np.inf, neginf=-np.inf)
+
+
+def calculate_stamp_duty(purchase_price):
+    """Calculate stamp duty based on purchase price. Excel formula: AE3"""
+    price = _as_array(purchase_price)
+    first_upper, first_rate = STAMP_DUTY_BANDS[0]
+    duty = np.minimum(price, first_upper) * first_rate
+    lower = first_upper
+    for upper, rate in STAMP_DUTY_BANDS[1:]:
+        duty = duty + np.clip(price - lower, 0, upper - lower) * rate
+        lower = upper
+    return duty
+
+
+def calculate_bridging_loan(initial_cash, total_money_needed, renovation_cost,
+                            bridging_rate, arrangement_rate, broker_rate, bridging_duration):
+    """Calculate bridging loan details. Excel formulas: AI3 through AW3"""
+    cash_after_purchase = initial_cash - total_money_needed
+    bridging_needed = np.maximum(0, renovation_cost - cash_after_purchase)
+    cash_leftover_after_renovations = np.maximum(0, cash_after_purchase - renovation_cost)
+    arrangement_fees = bridging_needed * arrangement_rate
+    total_bridging = bridging_needed + arrangement_fees
+    bridging_cost = total_bridging * bridging_rate * bridging_duration
+    total_gross_loan = total_bridging + bridging_cost
+    broker_fees = total_gross_loan * broker_rate
+    with np.errstate(divide='ignore', invalid='ignore'):
+        monthly_bridging_cost = bridging_cost / bridging_duration
+
+    return {
+        'cash_after_purchase': cash_after_purchase,
+        'bridging_needed': bridging_needed,
+        'cash_leftover_after_renovations': cash_leftover_after_renovations,
+        'arrangement_fees': arrangement_fees,
+        'total_bridging': total_bridging,
+        'bridging_cost': bridging_cost,
+        'total_gross_loan': total_gross_loan,
+        'broker_fees': broker_fees,
+        'monthly_bridging_cost': monthly_bridging_cost,
+        'amount_to_repay': total_gross_loan,
+    }
+
+
+def calculate_mortgage(mortgage_ltv, valuation_after, lender_fee, mortgage_rate):
+    """Calculate mortgage details. Excel formulas: AY3 through BD3"""
+    mortgage_amount = (mortgage_ltv * valuation_after) + ((mortgage_ltv * valuation_after) * lender_fee)
+    mortgage_fees = mortgage_amount * lender_fee
+    annual_mortgage_interest = (mortgage_amount + mortgage_fees) * mortgage_rate
+
+    return {
+        'mortgage_amount': mortgage_amount,
+        'mortgage_fees': mortgage_fees,
+        'annual_mortgage_interest': annual_mortgage_interest,
+    }
+
+
+def calculate_rental(monthly_rent, rooms, management_fee):
+    """Calculate rental income and expenses. Excel formulas: BE3 through BK3"""
+    annual_rent = monthly_rent * 12
+    utility_bills = rooms * UTILITY_COST_PER_ROOM
+    maintenance = annual_rent * MAINTENANCE_RATE
+    management_fees = annual_rent * management_fee
+    total_rental_fees = management_fees + INSURANCE_COST + maintenance
+    rental_income = annual_rent - utility_bills - total_rental_fees
+
+    return {
+        'annual_rent': annual_rent,
+        'utility_bills': utility_bills,
+        'maintenance': maintenance,
+        'management_fees': management_fees,
+        'total_rental_fees': total_rental_fees,
+        'rental_income': rental_income,
+    }
+
+
+def calculate_profit(rental_income, annual_mortgage_interest, total_money_needed, bridging_cost,
+                     renovation_cost, arrangement_fees, broker_fees, mortgage_amount, valuation_after):
+    """Calculate profit metrics. Excel formulas: R3 through V3"""
+    annual_profit = rental_income - annual_mortgage_interest
+    cash_left_in_deal = (total_money_needed + bridging_cost + renovation_cost +
+                         arrangement_fees + broker_fees - mortgage_amount)
+    annual_profit_after_tax = annual_profit * 0.81
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total_roi = (annual_profit / cash_left_in_deal) * 100
+        total_yield = (annual_profit / valuation_after) * 100
+
+    return {
+        'annual_profit': annual_profit,
+        'cash_left_in_deal': cash_left_in_deal,
+        'annual_profit_after_tax': annual_profit_after_tax,
+        'total_roi': total_roi,
+        'total_yield': total_yield,
+    }
+
+
+def calculate_flip_profit(valuation_after, total_money_needed, renovation_cost,
+                          bridging_cost, arrangement_fees, broker_fees):
+    """Calculate flip profit. Excel formulas: W3 through Z3"""
+    selling_fees = valuation_after * SELLING_FEE_RATE
+    flip_profit_before_tax = valuation_after - (total_money_needed + renovation_cost +
+                                                bridging_cost + arrangement_fees + broker_fees + selling_fees)
+    corporation_tax = flip_profit_before_tax * CORPORATION_TAX_RATE
+    flip_profit_after_tax = flip_profit_before_tax - corporation_tax
+
+    return {
+        'flip_profit_before_tax': flip_profit_before_tax,
+        'corporation_tax': corporation_tax,
+        'flip_profit_after_tax': flip_profit_after_tax,
+    }
+
+
+def calculate_deal(initial_cash=0, purchase_price=0, extra_fees=0, rooms=0, monthly_rent=0,
+                   valuation_after=0, renovation_cost=0, bridging_duration=0, mortgage_ltv=0,
+                   mortgage_rate=0, lender_fee=0, bridging_rate=0, arrangement_rate=0,
+                   broker_rate=0, management_fee=0):
+    """Run the full calculator chain (same order as updateCalculations in calculator_test.html).
+
+    All arguments broadcast against each other; the result is a flat dict of arrays.
+    """
+    initial_cash = _as_array(initial_cash)
+    purchase_price = _as_array(purchase_price)
+    extra_fees = _as_array(extra_fees)
+    rooms = _as_array(rooms)
+    monthly_rent = _as_array(monthly_rent)
+    valuation_after = _as_array(valuation_after)
+    renovation_cost = _as_array(renovation_cost)
+    bridging_duration = _as_array(bridging_duration)
+
+    stamp_duty = calculate_stamp_duty(purchase_price)
+    total_purchase_fees = stamp_duty + extra_fees
+    total_money_needed = total_purchase_fees + purchase_price
+
+    bridging = calculate_bridging_loan(
+        initial_cash, total_money_needed, renovation_cost,
+        _as_array(bridging_rate), _as_array(arrangement_rate), _as_array(broker_rate),
+        bridging_duration
+    )
+    mortgage = calculate_mortgage(
+        _as_array(mortgage_ltv), valuation_after, _as_array(lender_fee), _as_array(mortgage_rate)
+    )
+    rental = calculate_rental(monthly_rent, rooms, _as_array(management_fee))
+    profit = calculate_profit(
+        rental['rental_income'], mortgage['annual_mortgage_interest'], total_money_needed,
+        bridging['bridging_cost'], renovation_cost, bridging['arrangement_fees'],
+        bridging['broker_fees'], mortgage['mortgage_amount'], valuation_after
+    )
+    flip = calculate_flip_profit(
+        valuation_after, total_money_needed, renovation_cost, bridging['bridging_cost'],
+        bridging['arrangement_fees'], bridging['broker_fees']
+    )
+
+    result = {
+        'stamp_duty': stamp_duty,
+        'total_purchase_fees': total_purchase_fees,
+        'total_money_needed': total_money_needed,
+    }
+    result.update(bridging)
+    result.update(mortgage)
+    result.update(rental)
+    result.update(profit)
+    result.update(flip)
+    return result
+
+
+def deal_inputs_from_properties(properties):
+    """Build calculate_deal() keyword arrays from Property rows (or dicts with the same keys).
+
+    Percentage columns are divided by 100 and missing values become 0,
+    matching how calculator_test.html reads its inputs.
+    """
+    columns = {field: [] for field in INPUT_FIELDS}
+    for prop in properties:
+        getter = prop.get if isinstance(prop, dict) else lambda name, p=prop: getattr(p, name, None)
+        for field in INPUT_FIELDS:
+            value = getter(field)
+            columns[field].append(np.nan if value is None else value)
+
+    inputs = {}
+    for field in INPUT_FIELDS:
+        values = _as_array(columns[field])
+        if field in PERCENT_FIELDS:
+            values = values / 100
+        inputs[field] = values
+    return inputs
+
+
+def calculate_properties(properties):
+    """Price a list of Property rows in one vectorized call."""
+    return calculate_deal(**deal_inputs_from_properties(properties))
+
+
+def metrics_for_row(results, index):
+    """Pull the STORED_METRICS for one row out of a calculate_deal() result.
+
+    Non-finite values (e.g. ROI when no cash is left in the deal) become None,
+    which is what the browser ends up saving for them.
+    """
+    metrics = {}
+    for name in STORED_METRICS:
+        value = float(results[name][index])
+        metrics[name] = value if np.isfinite(value) else None
+    return metrics
+
+
+def apply_metrics(prop):
+    """Recompute and set the calculated columns on a single Property."""
+    results = calculate_properties([prop])
+    for name, value in metrics_for_row(results, 0).items():
+        setattr(prop, name, value)
+    return prop
+
+
+def sensitivity_grid(prop, axes):
+    """Evaluate one property over a grid of inputs in a single broadcast pass.
+
+    axes is an ordered dict of input field -> 1-D values in Property units
+    (percentages for rates). Each axis gets its own array dimension, so the
+    outputs all have shape (len(axis_1), len(axis_2), ...).
+    """
+    inputs = {field: values[0] for field, values in deal_inputs_from_properties([prop]).items()}
+    for dim, (field, values) in enumerate(axes.items()):
+        if field not in INPUT_FIELDS:
+            raise ValueError(f"Unknown input field: {field}")
+        values = _as_array(values)
+        if field in PERCENT_FIELDS:
+            values = values / 100
+        shape = [1] * len(axes)
+        shape[dim] = -1
+        inputs[field] = values.reshape(shape)
+    grid_shape = tuple(len(values) for values in axes.values())
+    # Outputs that don't depend on every axis are broadcast (as views) to the full grid
+    return {name: np.broadcast_to(values, grid_shape) for name, values in calculate_deal(**inputs).items()}
+
+
+def _meets_targets(results, target_roi, max_cash_left):
+    """Row mask of deals satisfying the goal-seek targets.
+
+    An ROI target needs a positive annual profit: a loss divided by a negative
+    cash left in the deal gives a large positive raw ROI. A deal with no cash
+    left in it and a positive profit has an unbounded return, so it always meets
+    the target (the raw ROI formula goes negative there).
+    """
+    ok = np.ones(np.shape(results['cash_left_in_deal']), dtype=bool)
+    if target_roi is not None:
+        money_out = results['cash_left_in_deal'] <= 0
+        with np.errstate(invalid='ignore'):
+            ok &= (results['annual_profit'] > 0) & ((results['total_roi'] >= target_roi) | money_out)
+    if max_cash_left is not None:
+        ok &= results['cash_left_in_deal'] <= max_cash_left
+    return ok
+
+
+def max_purchase_price(inputs, target_roi=None, max_cash_left=None, tolerance=1.0, max_expansions=40):
+    """Goal-seek the highest purchase price per row that still meets the targets.
+
+    inputs are calculate_deal() keyword arrays (see deal_inputs_from_properties);
+    purchase_price is ignored. target_roi is in percent, max_cash_left in pounds.
+    Every row is solved at once by bracketing then bisecting, which copes with the
+    kinks in the stamp duty bands and bridging formulas. That relies on feasibility
+    only ever getting worse as the price rises: annual profit does not depend on
+    the price and cash left in the deal only grows with it, so once a target
+    requires a positive profit, ROI can only fall. Rows that miss the targets even
+    at a price of zero (including every loss-making row) come back as NaN.
+    """
+    if target_roi is None and max_cash_left is None:
+        raise ValueError("At least one of target_roi or max_cash_left is required")
+
+    inputs = {field: _as_array(values) for field, values in inputs.items()}
+    rows = np.broadcast_shapes(*(values.shape for values in inputs.values()))
+
+    def feasible(price):
+        return _meets_targets(calculate_deal(**dict(inputs, purchase_price=price)), target_roi, max_cash_left)
+
+    low = np.zeros(rows)
+    solvable = feasible(low)
+
+    # Grow the upper bracket until every solvable row is infeasible there
+    high = np.maximum(inputs.get('valuation_after', np.zeros(rows)), 100000) * np.ones(rows)
+    for _ in range(max_expansions):
+        still_ok = solvable & feasible(high)
+        if not still_ok.any():
+            break
+        low = np.where(still_ok, high, low)
+        high = np.where(still_ok, high * 2, high)
+
+    while np.any(solvable & (high - low > tolerance)):
+        mid = (low + high) / 2
+        ok = feasible(mid)
+        low = np.where(ok, mid, low)
+        high = np.where(ok, high, mid)
+
+    return np.where(solvable, np.floor(low), np.nan)
+
+
+def benchmark(rows=100000, repeats=5, seed=0):
+    """Measure rows/second of calculate_deal() on a synthetic portfolio."""
+    rng = np.random.default_rng(seed)
+    inputs = {
+        'initial_cash': rng.uniform(50000, 500000, rows),
+        'purchase_price': rng.uniform(50000, 2000000, rows),
+        'extra_fees': rng.uniform(0, 5000, rows),
+        'rooms': rng.integers(0, 8, rows),
+        'monthly_rent': rng.uniform(500, 8000, rows),
+        'valuation_after': rng.uniform(60000, 2500000, rows),
+        'renovation_cost': rng.uniform(0, 150000, rows),
+        'bridging_duration': rng.integers(1, 18, rows),
+        'mortgage_ltv': rng.uniform(0.5, 0.85, rows),
+        'mortgage_rate': rng.uniform(0.02, 0.09, rows),
+        'lender_fee': rng.uniform(0, 0.03, rows),
+        'bridging_rate': rng.uniform(0.005, 0.015, rows),
+        'arrangement_rate': rng.uniform(0.01, 0.03, rows),
+        'broker_rate': rng.uniform(0, 0.02, rows),
+        'management_fee': rng.uniform(0.08, 0.15, rows),
+    }
+
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        calculate_deal(**inputs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return {
+        'rows': rows,
+        'seconds': best,
+        'rows_per_second': rows / best if best else float('inf'),
+    }
+
+
+if __name__ == '__main__':
+    stats = benchmark()
+    print(f"calculate_deal: {stats['rows']} rows in {stats['seconds'] * 1000:.2f} ms "
+          f"({stats['rows_per_second']:,.0f} rows/s)")
@@ -0,0 +1,154 @@
+"""
+Monte Carlo risk simulation for deals.
+
+Samples the uncertain inputs of a deal (rent, letting voids, refurb overruns,
+valuation after works and rate shocks), prices every scenario in one
+deal_engine.calculate_deal() call and reduces the results to percentile bands.
+A portfolio run can optionally be spread over a process pool.
+"""
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import deal_engine
+
+# Default distribution parameters. Rate shocks are in percentage points.
+DEFAULT_ASSUMPTIONS = {
+    'rent_sd': 0.075,                 # Relative s.d. of achieved monthly rent
+    'void_months_mean': 0.5,          # Mean letting void (months per year, Poisson)
+    'refurb_overrun_low': 0.95,       # Triangular multiplier on renovation_cost
+    'refurb_overrun_mode': 1.05,
+    'refurb_overrun_high': 1.5,
+    'valuation_sd': 0.075,            # Relative s.d. of valuation after works
+    'mortgage_rate_shock_sd': 1.0,    # Additive shock to mortgage_rate
+    'bridging_rate_shock_sd': 0.1,    # Additive shock to bridging_rate
+}
+
+SIMULATED_METRICS = ('annual_profit', 'cash_left_in_deal', 'flip_profit_before_tax')
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+
+# Scenarios priced per calculate_deal() call, to bound peak memory
+SIMULATION_CHUNK = 50000
+
+
+def sample_scenarios(base, count, rng, assumptions):
+    """Draw `count` scenarios around a single deal's inputs (engine units, i.e. fractional rates)."""
+    scenario = dict(base)
+
+    rent = base['monthly_rent'] * rng.normal(1.0, assumptions['rent_sd'], count)
+    void_months = np.minimum(rng.poisson(assumptions['void_months_mean'], count), 12)
+    scenario['monthly_rent'] = np.maximum(rent, 0) * (12 - void_months) / 12
+
+    low, high = assumptions['refurb_overrun_low'], assumptions['refurb_overrun_high']
+    if high > low:
+        overrun = rng.triangular(low, assumptions['refurb_overrun_mode'], high, count)
+    else:
+        overrun = np.full(count, low)
+    scenario['renovation_cost'] = base['renovation_cost'] * overrun
+
+    valuation = base['valuation_after'] * rng.normal(1.0, assumptions['valuation_sd'], count)
+    scenario['valuation_after'] = np.maximum(valuation, 0)
+
+    mortgage_shock = rng.normal(0.0, assumptions['mortgage_rate_shock_sd'], count) / 100
+    scenario['mortgage_rate'] = np.maximum(base['mortgage_rate'] + mortgage_shock, 0)
+    bridging_shock = rng.normal(0.0, assumptions['bridging_rate_shock_sd'], count) / 100
+    scenario['bridging_rate'] = np.maximum(base['bridging_rate'] + bridging_shock, 0)
+
+    return scenario
+
+
+def simulate_deal(prop, scenarios=100000, seed=None, assumptions=None, percentiles=DEFAULT_PERCENTILES):
+    """Run a Monte Carlo simulation for one property (Property row or dict of its columns).
+
+    Returns percentile bands, mean and share of negative outcomes for each metric
+    in SIMULATED_METRICS.
+    """
+    assumptions = dict(DEFAULT_ASSUMPTIONS, **(assumptions or {}))
+    rng = np.random.default_rng(seed)
+    base = {field: values[0] for field, values in deal_engine.deal_inputs_from_properties([prop]).items()}
+
+    collected = {metric: [] for metric in SIMULATED_METRICS}
+    for start in range(0, scenarios, SIMULATION_CHUNK):
+        count = min(SIMULATION_CHUNK, scenarios - start)
+        results = deal_engine.calculate_deal(**sample_scenarios(base, count, rng, assumptions))
+        for metric in SIMULATED_METRICS:
+            collected[metric].append(np.broadcast_to(results[metric], (count,)))
+
+    summary = {}
+    for metric, chunks in collected.items():
+        values = np.concatenate(chunks)
+        bands = np.percentile(values, percentiles)
+        summary[metric] = {
+            'percentiles': {f'p{p}': round(float(v), 2) for p, v in zip(percentiles, bands)},
+            'mean': round(float(values.mean()), 2),
+            'probability_negative': round(float((values < 0).mean()), 4),
+        }
+
+    return {
+        'scenarios': scenarios,
+        'assumptions': assumptions,
+        'metrics': summary,
+    }
+
+
+def _simulate_entry(args):
+    """Process pool entry point (must be importable at module level)."""
+    prop, scenarios, seed, assumptions, percentiles = args
+    return prop.get('id'), simulate_deal(prop, scenarios, seed, assumptions, percentiles)
+
+
+def simulate_portfolio(properties, scenarios=100000, seed=None, assumptions=None,
+                       percentiles=DEFAULT_PERCENTILES, workers=None):
+    """Simulate every property, optionally spread across a process pool.
+
+    Properties are reduced to plain dicts of their calculator inputs before being
+    sent to workers. Each property gets its own child seed so results do not
+    depend on the number of workers, which is capped at the CPU count.
+    """
+    rows = []
+    for prop in properties:
+        getter = prop.get if isinstance(prop, dict) else lambda name, p=prop: getattr(p, name, None)
+        row = {field: getter(field) for field in deal_engine.INPUT_FIELDS}
+        row['id'] = getter('id')
+        rows.append(row)
+
+    child_seeds = np.random.SeedSequence(seed).spawn(len(rows))
+    jobs = [(row, scenarios, child, assumptions, percentiles) for row, child in zip(rows, child_seeds)]
+
+    workers = min(workers or 1, os.cpu_count() or 1, len(jobs))
+    if workers > 1:
+        # spawn, not fork: the web workers are gevent-patched
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            results = list(executor.map(_simulate_entry, jobs))
+    else:
+        results = [_simulate_entry(job) for job in jobs]
+
+    return {property_id: result for property_id, result in results}
+
+
+def benchmark(scenarios=1000000, seed=0):
+    """Measure scenarios/second for a single representative deal."""
+    prop = {
+        'initial_cash': 100000, 'purchase_price': 200000, 'rooms': 4, 'monthly_rent': 2000,
+        'valuation_after': 250000, 'renovation_cost': 30000, 'bridging_duration': 6,
+        'mortgage_ltv': 75, 'mortgage_rate': 5.5, 'lender_fee': 1, 'bridging_rate': 1,
+        'arrangement_rate': 2.25, 'broker_rate': 1, 'management_fee': 10,
+    }
+    start = time.perf_counter()
+    simulate_deal(prop, scenarios=scenarios, seed=seed)
+    elapsed = time.perf_counter() - start
+    return {
+        'scenarios': scenarios,
+        'seconds': elapsed,
+        'scenarios_per_second': scenarios / elapsed if elapsed else float('inf'),
+    }
+
+
+if __name__ == '__main__':
+    stats = benchmark()
+    print(f"simulate_deal: {stats['scenarios']} scenarios in {stats['seconds']:.2f} s "
+          f"({stats['scenarios_per_second']:,.0f} scenarios/s)")
@@ -0,0 +1,61 @@
+"""
+Packing extracted legal-pack documents into token-bounded Claude batches.
+
+Each document becomes a headed section; documents too long for one batch are
+split into overlapping parts with chunk_text(). Sections are then packed in
+order into batches of at most max_tokens. This is CPU-bound for large packs,
+so the app runs pack_batches() in the CPU pool; keep the module importable
+without app.py.
+
+Packing uses exact token counts only: a document's count stored with its
+extraction cache entry, or count_tokens() for the parts of a split one. The
+calibrated estimate_tokens() depends on what the process has counted before,
+so batch boundaries (and with them every response cache key) would move
+between runs of the same pack.
+"""
+from token_counting import chunk_text, count_tokens
+
+# Documents longer than a batch are split into overlapping parts
+BATCH_PART_OVERLAP_TOKENS = 200
+BATCH_HEADER_TOKENS = 50
+
+
+def iter_batch_sections(documents_content, max_tokens):
+    """Yield (section, tokens) for each document as a headed section of at most max_tokens.
+
+    Oversized documents are split into overlapping parts. tokens is the exact
+    count of the section's text plus BATCH_HEADER_TOKENS for its header.
+    """
+    for doc in documents_content:
+        content = doc['content'] or ''
+        tokens = doc.get('tokens')
+        if tokens is None:
+            tokens = count_tokens(content)
+        if tokens + BATCH_HEADER_TOKENS <= max_tokens:
+            parts = [(content, tokens)]
+        else:
+            parts = [(part, count_tokens(part))
+                     for part in chunk_text(content, max_tokens - BATCH_HEADER_TOKENS, BATCH_PART_OVERLAP_TOKENS)]
+        for part_num, (part, part_tokens) in enumerate(parts, 1):
+            name = doc['name'] if len(parts) == 1 else f"{doc['name']} (part {part_num} of {len(parts)})"
+            yield f"\n{'='*50}\nDOCUMENT: {name}\n{'='*50}\n{part}", part_tokens + BATCH_HEADER_TOKENS
+
+
+def pack_batches(documents_content, max_tokens):
+    """Group the documents' sections, in order, into batches of at most max_tokens; returns a list of lists."""
+    batches = []
+    current_batch = []
+    current_batch_tokens = 0
+
+    for doc_text, doc_tokens in iter_batch_sections(documents_content, max_tokens):
+        if current_batch and current_batch_tokens + doc_tokens > max_tokens:
+            batches.append(current_batch)
+            current_batch = []
+            current_batch_tokens = 0
+
+        current_batch.append(doc_text)
+        current_batch_tokens += doc_tokens
+
+    if current_batch:
+        batches.append(current_batch)
+    return batches
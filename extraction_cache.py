@@ -0,0 +1,89 @@
+import os
+import json
+import contextlib
+import hashlib
+import logging
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+class ExtractionCache:
+    """Content-addressed cache of extracted document text.
+
+    Entries are keyed by the SHA-256 of the file's bytes plus the extractor
+    version, so re-uploads and documents shared between lots skip extraction
+    and OCR entirely, while a change to the extraction code invalidates old
+    entries. Each entry is a small JSON file under the cache directory.
+    """
+
+    def __init__(self, cache_dir, extractor_version):
+        self.cache_dir = Path(cache_dir)
+        self.extractor_version = str(extractor_version)
+        self.hits = 0
+        self.misses = 0
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def file_digest(file_path, chunk_size=1024 * 1024):
+        """SHA-256 of a file's contents, read in chunks."""
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _entry_path(self, digest):
+        return self.cache_dir / digest[:2] / f"{digest}-v{self.extractor_version}.json"
+
+    def get(self, digest):
+        """Return the cached entry ({'content', 'tokens', ...}) or None."""
+        path = self._entry_path(digest)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            self.hits += 1
+            return entry
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable extraction cache entry {path}: {str(e)}")
+            self.misses += 1
+            return None
+
+    def put(self, digest, content, tokens, source_name=None):
+        """Store extracted text; written atomically so concurrent workers never see partial files."""
+        path = self._entry_path(digest)
+        entry = {
+            'content': content,
+            'tokens': tokens,
+            'extractor_version': self.extractor_version,
+            'source_name': source_name,
+            'created_at': datetime.utcnow().isoformat()
+        }
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(entry, f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+            except BaseException:
+                # Don't leave a half-written temp file behind in the cache directory
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp_path)
+                raise
+        except Exception as e:
+            logger.warning(f"Failed to write extraction cache entry {path}: {str(e)}")
+        return entry
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            'extractor_version': self.extractor_version
+        }
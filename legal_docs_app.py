@@ -45,6 +45,8 @@ from selenium.webdriver.chrome.options import Options
 import time
 import re
 
+import claude_client
+
 # Initialize Flask app with custom template folder
 app = Flask(__name__, 
             template_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
@@ -604,7 +606,8 @@ def analyze_legal_pack():
                         all_content.append(f"Document: {doc.filename}\n\n{content}\n\n")
 
             # Analyze with Claude
-            client = anthropic.Anthropic(api_key=os.getenv('CLAUDE_API_KEY'))
+            client = claude_client.make_client(os.getenv('CLAUDE_API_KEY'))
+            documents_text = '\n'.join(all_content)
             
             prompt = f"""As a conveyancer, please provide a comprehensive analysis of this legal pack for an auction property. 
 
@@ -681,9 +684,12 @@ def analyze_legal_pack():
             If any critical information is missing from the legal pack or requires verification, explicitly state what needs to be checked and why it's important.
 
             Here are the documents to analyze:
-            {'\n'.join(all_content)}"""
+            {documents_text}"""
 
-            completion = client.messages.create(
+            completion = claude_client.create_message(
+                client,
+                model="claude-3-sonnet-20240229",
+                max_tokens=4096,
                 system="You are a conveyancer analyzing legal packs for auction properties.",
                 messages=[{
                     "role": "user",
@@ -0,0 +1,48 @@
+"""add deal metrics table
+
+Revision ID: add_deal_metrics
+Revises: add_legal_pack_documents
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_deal_metrics'
+down_revision = 'add_legal_pack_documents'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('deal_metrics',
+        sa.Column('property_id', sa.Integer(), nullable=False),
+        sa.Column('total_roi', sa.Float(), nullable=True),
+        sa.Column('total_yield', sa.Float(), nullable=True),
+        sa.Column('annual_profit', sa.Float(), nullable=True),
+        sa.Column('cash_left_in_deal', sa.Float(), nullable=True),
+        sa.Column('purchase_price', sa.Float(), nullable=True),
+        sa.Column('bedrooms', sa.Integer(), nullable=True),
+        sa.Column('station_distance', sa.Float(), nullable=True),
+        sa.Column('is_auction', sa.Boolean(), nullable=True),
+        sa.ForeignKeyConstraint(['property_id'], ['property.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('property_id')
+    )
+    op.create_index('ix_deal_metrics_total_roi', 'deal_metrics', ['total_roi'])
+    op.create_index('ix_deal_metrics_total_yield', 'deal_metrics', ['total_yield'])
+    op.create_index('ix_deal_metrics_bedrooms_station', 'deal_metrics', ['bedrooms', 'station_distance'])
+
+    # Backfill from the existing property rows
+    op.execute('''
+        INSERT INTO deal_metrics (property_id, total_roi, total_yield, annual_profit, cash_left_in_deal,
+                                  purchase_price, bedrooms, station_distance, is_auction)
+        SELECT id, total_roi, total_yield, annual_profit, cash_left_in_deal,
+               purchase_price, bedrooms, station_distance, is_auction
+        FROM property
+    ''')
+
+def downgrade():
+    op.drop_index('ix_deal_metrics_bedrooms_station', table_name='deal_metrics')
+    op.drop_index('ix_deal_metrics_total_yield', table_name='deal_metrics')
+    op.drop_index('ix_deal_metrics_total_roi', table_name='deal_metrics')
+    op.drop_table('deal_metrics')
@@ -0,0 +1,27 @@
+"""add legal_pack_index table for retrieval-based follow-up questions
+
+Revision ID: add_legal_pack_index
+Revises: add_legal_pack_jobs
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_legal_pack_index'
+down_revision = 'add_legal_pack_jobs'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('legal_pack_index',
+        sa.Column('property_id', sa.Integer(), nullable=False),
+        sa.Column('content', sa.Text(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['property_id'], ['property.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('property_id')
+    )
+
+def downgrade():
+    op.drop_table('legal_pack_index')
@@ -0,0 +1,21 @@
+"""add analysis_text to legal_pack_jobs for streaming the analysis
+
+Revision ID: add_legal_pack_job_analysis_text
+Revises: add_legal_pack_index
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_legal_pack_job_analysis_text'
+down_revision = 'add_legal_pack_index'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('legal_pack_jobs', sa.Column('analysis_text', sa.Text(), nullable=True))
+
+def downgrade():
+    op.drop_column('legal_pack_jobs', 'analysis_text')
@@ -0,0 +1,21 @@
+"""add attempts to legal_pack_jobs so orphaned jobs can be reclaimed a bounded number of times
+
+Revision ID: add_legal_pack_job_attempts
+Revises: make_property_created_at_not_null
+Create Date: 2026-10-17 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_legal_pack_job_attempts'
+down_revision = 'make_property_created_at_not_null'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('legal_pack_jobs', sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'))
+
+def downgrade():
+    op.drop_column('legal_pack_jobs', 'attempts')
@@ -0,0 +1,44 @@
+"""add legal_pack_jobs table for queued legal pack analysis
+
+Revision ID: add_legal_pack_jobs
+Revises: move_legal_pack_blobs
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_legal_pack_jobs'
+down_revision = 'move_legal_pack_blobs'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('legal_pack_jobs',
+        sa.Column('id', sa.String(length=36), nullable=False),
+        sa.Column('property_id', sa.Integer(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('stage', sa.String(length=50), nullable=True),
+        sa.Column('upload_path', sa.String(length=500), nullable=True),
+        sa.Column('current_file', sa.String(length=255), nullable=True),
+        sa.Column('files_total', sa.Integer(), nullable=True),
+        sa.Column('files_done', sa.Integer(), nullable=True),
+        sa.Column('pages_total', sa.Integer(), nullable=True),
+        sa.Column('pages_done', sa.Integer(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('result', sa.JSON(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['property_id'], ['property.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_legal_pack_jobs_property_id', 'legal_pack_jobs', ['property_id'])
+    op.create_index('ix_legal_pack_jobs_status', 'legal_pack_jobs', ['status'])
+
+def downgrade():
+    op.drop_index('ix_legal_pack_jobs_status', table_name='legal_pack_jobs')
+    op.drop_index('ix_legal_pack_jobs_property_id', table_name='legal_pack_jobs')
+    op.drop_table('legal_pack_jobs')
@@ -0,0 +1,20 @@
+"""add property created_at/id index for keyset pagination
+
+Revision ID: add_property_created_at_index
+Revises: add_deal_metrics
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'add_property_created_at_index'
+down_revision = 'add_deal_metrics'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_index('ix_property_created_at_id', 'property', ['created_at', 'id'])
+
+def downgrade():
+    op.drop_index('ix_property_created_at_id', table_name='property')
@@ -0,0 +1,25 @@
+"""backfill property.created_at and make it NOT NULL for keyset pagination
+
+Revision ID: make_property_created_at_not_null
+Revises: add_legal_pack_job_analysis_text
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'make_property_created_at_not_null'
+down_revision = 'add_legal_pack_job_analysis_text'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # NULLs would drop out of the (created_at, id) < cursor comparison; park them at the epoch (written in the format SQLAlchemy stores DateTime in on SQLite)
+    op.execute("UPDATE property SET created_at = '1970-01-01 00:00:00.000000' WHERE created_at IS NULL")
+    with op.batch_alter_table('property') as batch_op:
+        batch_op.alter_column('created_at', existing_type=sa.DateTime(), nullable=False)
+
+def downgrade():
+    with op.batch_alter_table('property') as batch_op:
+        batch_op.alter_column('created_at', existing_type=sa.DateTime(), nullable=True)
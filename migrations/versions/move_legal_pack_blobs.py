@@ -0,0 +1,48 @@
+"""move legal pack blobs off the property row into side tables
+
+Revision ID: move_legal_pack_blobs
+Revises: add_property_created_at_index
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'move_legal_pack_blobs'
+down_revision = 'add_property_created_at_index'
+branch_labels = None
+depends_on = None
+
+# property column -> side table
+SIDE_TABLES = {
+    'legal_pack_analysis': 'legal_pack_analysis',
+    'legal_pack_qa_history': 'legal_pack_qa_history',
+    'legal_pack_documents': 'legal_pack_documents',
+}
+
+def upgrade():
+    for column, table in SIDE_TABLES.items():
+        op.create_table(table,
+            sa.Column('property_id', sa.Integer(), nullable=False),
+            sa.Column('content', sa.Text(), nullable=True),
+            sa.Column('updated_at', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['property_id'], ['property.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('property_id')
+        )
+        # Backfill, then drop the old wide column
+        op.execute(f'''
+            INSERT INTO {table} (property_id, content, updated_at)
+            SELECT id, {column}, CURRENT_TIMESTAMP FROM property WHERE {column} IS NOT NULL
+        ''')
+        op.drop_column('property', column)
+
+def downgrade():
+    for column, table in SIDE_TABLES.items():
+        op.add_column('property', sa.Column(column, sa.Text(), nullable=True))
+        op.execute(f'''
+            UPDATE property SET {column} = (
+                SELECT content FROM {table} WHERE {table}.property_id = property.id
+            )
+        ''')
+        op.drop_table(table)
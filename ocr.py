@@ -0,0 +1,285 @@
+"""
+OCR backends for rendered page images.
+
+Two engines are available:
+
+* Google Vision, called through batch_annotate_images: page images are
+  grouped into requests of up to VISION_BATCH_SIZE and several requests run
+  concurrently.
+* Local tesseract, run across a process pool with OpenMP threads capped per
+  worker so throughput is predictable and the workers do not oversubscribe
+  the CPU.
+
+OCR_ENGINE selects 'vision', 'tesseract' or 'auto'. In auto mode each page is
+routed on its own: Vision when a client is available and the image is within
+its size limit, tesseract otherwise. Pages whose Vision request fails fall
+back to tesseract, so one bad response does not lose the pages.
+
+StubVisionClient mimics the Vision client with a fixed per-request and
+per-image latency so the batching can be benchmarked offline:
+
+    python ocr.py
+    python ocr.py --tesseract some_scan.pdf
+"""
+import io
+import os
+import sys
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from google.cloud import vision
+
+logger = logging.getLogger(__name__)
+
+OCR_ENGINE = os.environ.get('OCR_ENGINE', 'auto')
+
+# Vision accepts at most 16 images per batch_annotate_images request
+VISION_BATCH_SIZE = min(int(os.environ.get('VISION_BATCH_SIZE', 16)), 16)
+VISION_CONCURRENCY = int(os.environ.get('VISION_CONCURRENCY', 4))
+# Larger images are rejected by Vision, so auto mode sends them to tesseract
+VISION_MAX_IMAGE_BYTES = int(os.environ.get('VISION_MAX_IMAGE_BYTES', 10 * 1024 * 1024))
+
+TESSERACT_WORKERS = int(os.environ.get('TESSERACT_WORKERS', os.cpu_count() or 1))
+TESSERACT_THREADS = int(os.environ.get('TESSERACT_THREADS', 1))
+TESSERACT_LANG = os.environ.get('TESSERACT_LANG', 'eng')
+TESSERACT_CONFIG = os.environ.get('TESSERACT_CONFIG', '--oem 1 --psm 3')
+
+_tesseract_pool = None
+_tesseract_pool_lock = threading.Lock()
+
+
+def _init_tesseract_worker(threads):
+    """Pool initializer: cap tesseract's OpenMP threads (inherited by every tesseract it runs)."""
+    os.environ['OMP_THREAD_LIMIT'] = str(threads)
+
+
+def tesseract_ocr(image_bytes):
+    """OCR one encoded page image with the local tesseract binary."""
+    import pytesseract
+    from PIL import Image
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        return pytesseract.image_to_string(image, lang=TESSERACT_LANG, config=TESSERACT_CONFIG).strip()
+
+
+def get_tesseract_pool():
+    """Return the shared tesseract pool, creating it on first use."""
+    global _tesseract_pool
+    with _tesseract_pool_lock:
+        # A worker killed by the memory ceiling or the OOM killer breaks the pool; start a new one
+        if _tesseract_pool is None or getattr(_tesseract_pool, '_broken', False):
+            _tesseract_pool = ProcessPoolExecutor(
+                max_workers=TESSERACT_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_tesseract_worker,
+                initargs=(TESSERACT_THREADS,),
+            )
+            logger.info(f"Started tesseract pool with {TESSERACT_WORKERS} workers "
+                        f"({TESSERACT_THREADS} thread(s) each)")
+        return _tesseract_pool
+
+
+def pooled_tesseract_ocr(image_bytes):
+    """tesseract_ocr() run in the shared pool; usable as a Vision fallback from any thread."""
+    return get_tesseract_pool().submit(tesseract_ocr, image_bytes).result()
+
+
+def select_engine(image_bytes, client, engine=None):
+    """Pick the OCR engine for one page image."""
+    engine = engine or OCR_ENGINE
+    if engine == 'tesseract' or client is None:
+        return 'tesseract'
+    if engine == 'vision':
+        return 'vision'
+    return 'tesseract' if len(image_bytes) > VISION_MAX_IMAGE_BYTES else 'vision'
+
+
+def _annotate_request(image_bytes):
+    return vision.AnnotateImageRequest(
+        image=vision.Image(content=image_bytes),
+        features=[vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION)],
+    )
+
+
+def _fallback_text(fallback, key, image_bytes):
+    if fallback is None:
+        return ''
+    try:
+        return fallback(image_bytes)
+    except Exception as e:
+        logger.error(f"Fallback OCR failed for page {key}: {str(e)}")
+        return ''
+
+
+def _run_vision_batch(client, batch, fallback):
+    """OCR one batch of (key, image_bytes); returns [(key, text)]."""
+    try:
+        response = client.batch_annotate_images(requests=[_annotate_request(image) for _, image in batch])
+    except Exception as e:
+        logger.error(f"Vision batch of {len(batch)} images failed, falling back to tesseract: {str(e)}")
+        return [(key, _fallback_text(fallback, key, image)) for key, image in batch]
+
+    responses = list(response.responses)
+    if len(responses) != len(batch):
+        logger.warning(f"Vision returned {len(responses)} responses for {len(batch)} images; "
+                       f"falling back to tesseract for the unmatched pages")
+
+    results = []
+    for (key, image), page_response in zip(batch, responses):
+        if page_response.error.message:
+            logger.warning(f"Vision error for page {key}: {page_response.error.message}")
+            results.append((key, _fallback_text(fallback, key, image)))
+        elif page_response.text_annotations:
+            results.append((key, page_response.text_annotations[0].description))
+        else:
+            results.append((key, ''))
+    results.extend((key, _fallback_text(fallback, key, image)) for key, image in batch[len(responses):])
+    return results
+
+
+def ocr_pages(pages, client=None, engine=None, batch_size=None, concurrency=None,
+              fallback=pooled_tesseract_ocr):
+    """OCR an iterable of (key, image_bytes) pairs and return {key: text}.
+
+    Each page is routed by select_engine(). The iterable is consumed lazily:
+    tesseract pages go to the pool immediately and each Vision batch is
+    submitted as soon as it fills, so rendering later pages overlaps with OCR
+    of earlier ones.
+    """
+    batch_size = max(1, min(batch_size or VISION_BATCH_SIZE, 16))
+    concurrency = concurrency or VISION_CONCURRENCY
+
+    texts = {}
+    tesseract_futures = {}
+    vision_futures = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        batch = []
+        for key, image in pages:
+            if select_engine(image, client, engine) == 'tesseract':
+                tesseract_futures[key] = get_tesseract_pool().submit(tesseract_ocr, image)
+                continue
+            batch.append((key, image))
+            if len(batch) == batch_size:
+                vision_futures.append(executor.submit(_run_vision_batch, client, batch, fallback))
+                batch = []
+        if batch:
+            vision_futures.append(executor.submit(_run_vision_batch, client, batch, fallback))
+
+        for future in vision_futures:
+            texts.update(future.result())
+
+    for key, future in tesseract_futures.items():
+        try:
+            texts[key] = future.result()
+        except Exception as e:
+            logger.error(f"Tesseract OCR failed for page {key}: {str(e)}")
+            texts[key] = ''
+    return texts
+
+
+def vision_ocr_pages(client, pages, batch_size=None, concurrency=None, fallback=pooled_tesseract_ocr):
+    """OCR every page through Vision batches (see ocr_pages); without a client pages go to the fallback."""
+    if client is None:
+        return {key: _fallback_text(fallback, key, image) for key, image in pages}
+    return ocr_pages(pages, client, engine='vision', batch_size=batch_size,
+                     concurrency=concurrency, fallback=fallback)
+
+
+class StubVisionClient:
+    """Offline stand-in for vision.ImageAnnotatorClient.
+
+    Each call sleeps request_latency plus image_latency per image and returns
+    a canned text annotation, which is enough to measure request overhead.
+    """
+
+    def __init__(self, request_latency=0.4, image_latency=0.05, fail_batches=False, missing_responses=0):
+        self.request_latency = request_latency
+        self.image_latency = image_latency
+        self.fail_batches = fail_batches
+        self.missing_responses = missing_responses  # Responses left off the end of each batch
+        self.requests = 0
+
+    def _annotate(self, count):
+        self.requests += 1
+        time.sleep(self.request_latency + self.image_latency * count)
+        return [vision.AnnotateImageResponse(text_annotations=[vision.EntityAnnotation(description=f"page text {index}")])
+                for index in range(count)]
+
+    def text_detection(self, image):
+        return self._annotate(1)[0]
+
+    def batch_annotate_images(self, requests):
+        if self.fail_batches:
+            self.requests += 1
+            raise RuntimeError("stub batch failure")
+        responses = self._annotate(len(requests))
+        return vision.BatchAnnotateImagesResponse(responses=responses[:len(responses) - self.missing_responses])
+
+
+def benchmark(pages=50, request_latency=0.4, image_latency=0.05):
+    """Compare per-page text_detection calls with batched requests against the stub."""
+    images = [(page_num, b'\x89PNG stub page %d' % page_num) for page_num in range(pages)]
+
+    # One text_detection call per page, with the same number of requests in flight
+    client = StubVisionClient(request_latency, image_latency)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=VISION_CONCURRENCY) as executor:
+        list(executor.map(lambda page: client.text_detection(image=vision.Image(content=page[1])), images))
+    per_page_seconds = time.perf_counter() - start
+
+    client = StubVisionClient(request_latency, image_latency)
+    start = time.perf_counter()
+    texts = vision_ocr_pages(client, images, fallback=None)
+    batched_seconds = time.perf_counter() - start
+    assert len(texts) == pages
+
+    return {
+        'pages': pages,
+        'per_page_seconds': per_page_seconds,
+        'batched_seconds': batched_seconds,
+        'batched_requests': client.requests,
+        'speedup': per_page_seconds / batched_seconds if batched_seconds else float('inf'),
+    }
+
+
+def benchmark_tesseract(file_path, max_pages=20):
+    """Time serial tesseract against the pool on the first pages of a PDF (needs tesseract and poppler)."""
+    import pdf_extraction
+    pages = list(pdf_extraction.render_pages_for_ocr(file_path, range(min(max_pages, pdf_extraction.page_count(file_path)))))
+
+    start = time.perf_counter()
+    serial = {key: tesseract_ocr(image) for key, image in pages}
+    serial_seconds = time.perf_counter() - start
+
+    # Warm the workers so process start-up is not counted
+    pool = get_tesseract_pool()
+    list(pool.map(len, [b''] * TESSERACT_WORKERS))
+    start = time.perf_counter()
+    pooled = ocr_pages(pages, engine='tesseract')
+    pooled_seconds = time.perf_counter() - start
+    assert pooled == serial
+
+    return {
+        'pages': len(pages),
+        'workers': TESSERACT_WORKERS,
+        'serial_seconds': serial_seconds,
+        'pooled_seconds': pooled_seconds,
+        'pages_per_second': len(pages) / pooled_seconds if pooled_seconds else float('inf'),
+    }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--tesseract':
+        for path in sys.argv[2:]:
+            stats = benchmark_tesseract(path)
+            print(f"{os.path.basename(path)}: {stats['pages']} pages, serial {stats['serial_seconds']:.2f} s, "
+                  f"{stats['workers']} workers {stats['pooled_seconds']:.2f} s "
+                  f"({stats['pages_per_second']:.1f} pages/s)")
+        sys.exit(0)
+
+    stats = benchmark()
+    print(f"{stats['pages']} pages: per-page {stats['per_page_seconds']:.2f} s, "
+          f"batched {stats['batched_seconds']:.2f} s in {stats['batched_requests']} requests "
+          f"({stats['speedup']:.1f}x)")
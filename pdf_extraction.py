@@ -0,0 +1,529 @@
+"""
+Page-parallel PDF text extraction.
+
+Pages are split into small contiguous ranges and fanned out to a bounded
+process pool. Each worker extracts the text layer of its pages and flags the
+ones with too little text for OCR; results are reassembled in page order.
+Workers are started with the spawn method (the web app is gevent-patched and
+holds gRPC clients, neither of which survive a fork), run under an
+address-space ceiling and are recycled periodically so a pathological PDF
+cannot take the web worker down with it.
+
+Before any text is extracted, a cheap pre-pass (classify_page) looks at each
+page's resources and content stream (fonts, text-showing operators, how much
+of the page is covered by images) and routes image-only pages straight to OCR.
+Pages that do go through text extraction are still sent to OCR when the text
+layer turns out to be short or junk. Every decision is returned with its
+signals and counted in routing_stats so the thresholds can be tuned.
+
+Flagged pages are then rasterized together by render_pages_for_ocr(), which
+runs pdftoppm once per run of nearby pages instead of once per page.
+
+This module must stay importable without app.py so spawned workers start fast.
+"""
+import io
+import os
+import re
+import sys
+import json
+import tempfile
+import time
+import logging
+import threading
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+
+import PyPDF2
+from PyPDF2 import PageObject
+from PyPDF2.generic import ArrayObject, IndirectObject, NameObject
+from pdf2image import convert_from_path
+
+logger = logging.getLogger(__name__)
+
+# Pages whose text layer is shorter than this are sent to OCR
+MIN_TEXT_CHARS = 100
+# Pre-pass routing: pages mostly covered by images with little text are scans
+SCAN_IMAGE_COVERAGE = float(os.environ.get('SCAN_IMAGE_COVERAGE', 0.8))
+SCAN_MIN_TEXT_OPS = int(os.environ.get('SCAN_MIN_TEXT_OPS', 25))
+# Extracted text with a smaller share of letters, digits, spaces and common punctuation is junk
+JUNK_TEXT_MIN_RATIO = float(os.environ.get('JUNK_TEXT_MIN_RATIO', 0.6))
+# Optional JSON-lines file recording every routing decision with its signals
+PAGE_ROUTING_LOG = os.environ.get('PAGE_ROUTING_LOG')
+
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', min(4, os.cpu_count() or 1)))
+PDF_WORKER_MEMORY_MB = int(os.environ.get('PDF_WORKER_MEMORY_MB', 1024))
+PDF_PAGES_PER_TASK = int(os.environ.get('PDF_PAGES_PER_TASK', 4))
+PDF_WORKER_MAX_TASKS = int(os.environ.get('PDF_WORKER_MAX_TASKS', 50))
+# Page ranges in flight per document; bounds parent memory however long the PDF is
+PDF_MAX_INFLIGHT = int(os.environ.get('PDF_MAX_INFLIGHT', 2 * PDF_WORKERS))
+OCR_DPI = int(os.environ.get('OCR_DPI', 200))
+# 'gray' (8-bit), 'mono' (1-bit, smallest upload) or 'rgb'
+OCR_COLOR_MODE = os.environ.get('OCR_COLOR_MODE', 'gray')
+# Pages needing OCR that are at most this many pages apart share one pdftoppm pass
+OCR_RENDER_MAX_GAP = int(os.environ.get('OCR_RENDER_MAX_GAP', 3))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Parsed PDFs kept by each worker process, so consecutive page ranges of a document reuse one reader
+READER_CACHE_SIZE = int(os.environ.get('PDF_READER_CACHE_SIZE', 2))
+_readers = OrderedDict()
+_readers_lock = threading.Lock()
+
+# Routing decisions by reason, for the pages extracted by this process
+routing_stats = Counter()
+
+
+def _limit_worker_memory(limit_mb):
+    """Pool initializer: cap the worker's address space so runaway pages fail with MemoryError."""
+    if not limit_mb:
+        return
+    try:
+        import resource
+        limit = limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError):
+        # Not available on this platform; the per-task recycling still applies
+        pass
+
+
+def get_pool():
+    """Return the shared extraction pool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        # A worker killed by the memory ceiling or the OOM killer breaks the pool; start a new one
+        if _pool is None or getattr(_pool, '_broken', False):
+            options = {
+                'max_workers': PDF_WORKERS,
+                'mp_context': multiprocessing.get_context('spawn'),
+                'initializer': _limit_worker_memory,
+                'initargs': (PDF_WORKER_MEMORY_MB,),
+            }
+            if sys.version_info >= (3, 11):
+                options['max_tasks_per_child'] = PDF_WORKER_MAX_TASKS
+            _pool = ProcessPoolExecutor(**options)
+            logger.info(f"Started PDF extraction pool with {PDF_WORKERS} workers "
+                        f"({PDF_WORKER_MEMORY_MB} MB limit each)")
+        return _pool
+
+
+def shutdown_pool():
+    """Stop the shared pool (a new one is started on next use)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
+
+
+_CONTENT_TOKEN = re.compile(rb"\((?:\\.|[^\\)])*\)|<[^<>]*>|/[^\s/\[\]()<>{}%]+|[^\s/\[\]()<>{}%]+")
+_TEXT_SHOW_OPS = {b'Tj', b'TJ', b"'", b'"'}
+_READABLE_CHARS = re.compile(r"[\w\s.,;:'\"()\[\]/&%£$@#*+=?!-]")
+
+
+def _resource(resources, name):
+    value = resources.get(name) if resources else None
+    return value.get_object() if value is not None else {}
+
+
+def _content_data(page):
+    contents = page.get_contents()
+    if contents is None:
+        return b''
+    if isinstance(contents, ArrayObject):
+        return b'\n'.join(stream.get_object().get_data() for stream in contents)
+    return contents.get_data()
+
+
+def _multiply(m, n):
+    a, b, c, d, e, f = m
+    a2, b2, c2, d2, e2, f2 = n
+    return (a * a2 + b * c2, a * b2 + b * d2, c * a2 + d * c2, c * b2 + d * d2,
+            e * a2 + f * c2 + e2, e * b2 + f * d2 + f2)
+
+
+_NUMBER = re.compile(rb"[+-]?(?:\d+\.?\d*|\.\d+)")
+_IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+# Form XObjects nested deeper than this are not inspected
+MAX_FORM_DEPTH = 8
+
+
+def _is_operand(token):
+    return token[:1] in (b'/', b'(', b'<') or token in (b'true', b'false', b'null') or _NUMBER.fullmatch(token)
+
+
+def _object_key(ref):
+    return (ref.idnum, ref.generation) if isinstance(ref, IndirectObject) else id(ref)
+
+
+def page_signals(page):
+    """Cheap facts about a page from its resources and content stream, without extracting text.
+
+    Returns fonts (count in the page's resources and those of the forms it
+    draws), text_ops (text-showing operators), invisible_text_ops (those drawn
+    in render mode 3, e.g. an OCR layer under a scan) and image_coverage (share of the page area covered by
+    image XObjects, using the transformation matrix in force at each Do).
+    Form XObjects drawn by the page are followed, so text and images placed
+    through them count as well.
+    """
+    resources = page.get('/Resources')
+    resources = resources.get_object() if resources is not None else None
+
+    box = page.mediabox
+    page_area = abs(float(box.width) * float(box.height)) or 1.0
+
+    signals = {'fonts': len(_resource(resources, '/Font')), 'text_ops': 0, 'invisible_text_ops': 0, 'image_area': 0.0}
+    _scan_content(_content_data(page), resources, _IDENTITY, 0, signals, set(), ())
+    return {
+        'fonts': signals['fonts'],
+        'text_ops': signals['text_ops'],
+        'invisible_text_ops': signals['invisible_text_ops'],
+        'image_coverage': round(min(signals['image_area'] / page_area, 1.0), 3),
+    }
+
+
+def _scan_content(data, resources, ctm, render_mode, signals, forms_seen, chain):
+    """Add the signals of one content stream (a page's or a Form XObject's) to signals.
+
+    forms_seen holds the forms whose fonts were already counted; chain the forms
+    being drawn around this one, so a form that draws itself is not followed.
+    """
+    xobjects = _resource(resources, '/XObject')
+    images = set()
+    forms = {}
+    for name, ref in xobjects.items():
+        subtype = ref.get_object().get('/Subtype')
+        if subtype == '/Image':
+            images.add(name[1:].encode())
+        elif subtype == '/Form':
+            forms[name[1:].encode()] = ref
+
+    stack = []
+    operands = []
+    for token in _CONTENT_TOKEN.findall(data):
+        if _is_operand(token):
+            operands.append(token)
+            continue
+        if token in _TEXT_SHOW_OPS:
+            signals['text_ops'] += 1
+            if render_mode == 3:
+                signals['invisible_text_ops'] += 1
+        elif token == b'q':
+            stack.append(ctm)
+        elif token == b'Q':
+            ctm = stack.pop() if stack else ctm
+        elif token == b'cm' and len(operands) >= 6:
+            try:
+                ctm = _multiply(tuple(float(v) for v in operands[-6:]), ctm)
+            except ValueError:
+                pass
+        elif token == b'Tr' and operands:
+            render_mode = 3 if operands[-1] == b'3' else 0
+        elif token == b'Do' and operands:
+            name = operands[-1][1:]
+            if name in images:
+                a, b, c, d = ctm[:4]
+                signals['image_area'] += abs(a * d - b * c)
+            elif name in forms and len(chain) < MAX_FORM_DEPTH:
+                key = _object_key(forms[name])
+                if key not in chain:
+                    form = forms[name].get_object()
+                    form_resources = form.get('/Resources')
+                    # A form without its own resources uses those of whatever draws it
+                    form_resources = form_resources.get_object() if form_resources is not None else resources
+                    if key not in forms_seen:
+                        forms_seen.add(key)
+                        signals['fonts'] += len(_resource(form_resources, '/Font'))
+                    try:
+                        matrix = tuple(float(v) for v in form.get('/Matrix', _IDENTITY))
+                    except (TypeError, ValueError):
+                        matrix = _IDENTITY
+                    _scan_content(form.get_data(), form_resources, _multiply(matrix, ctm), render_mode,
+                                  signals, forms_seen, chain + (key,))
+        # Every operator consumes the operands before it
+        operands = []
+
+
+def classify_page(page):
+    """Route a page to 'text' or 'ocr' before extracting it; returns (route, reason, signals)."""
+    try:
+        signals = page_signals(page)
+    except Exception as e:
+        logger.warning(f"Could not inspect page content, extracting text: {str(e)}")
+        return 'text', 'uninspectable', {}
+
+    if signals['fonts'] == 0 or signals['text_ops'] == 0:
+        return 'ocr', 'no_text_layer', signals
+    if signals['image_coverage'] >= SCAN_IMAGE_COVERAGE and signals['text_ops'] < SCAN_MIN_TEXT_OPS:
+        return 'ocr', 'image_page', signals
+    return 'text', 'text_layer', signals
+
+
+def is_junk_text(text):
+    """True when too little of the text is letters, digits, whitespace or ordinary punctuation."""
+    if not text:
+        return False
+    readable = len(_READABLE_CHARS.findall(text))
+    return readable / len(text) < JUNK_TEXT_MIN_RATIO or text.count('(cid:') > 10
+
+
+_INHERITABLE_PAGE_KEYS = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+
+
+def page_refs(file_path):
+    """(object number, generation) of every page, in order; cheap to send to workers."""
+    with open(file_path, 'rb') as f:
+        reader = PyPDF2.PdfReader(f)
+        return [(page.indirect_reference.idnum, page.indirect_reference.generation) for page in reader.pages]
+
+
+def _load_page(reader, ref):
+    """Load one page by reference without flattening the whole page tree.
+
+    reader.pages reads every page object on first access, which makes each
+    worker task O(total pages); here only the page and its /Parent chain (for
+    inherited attributes) are read.
+    """
+    reference = IndirectObject(ref[0], ref[1], reader)
+    page = PageObject(reader, reference)
+    page.update(reference.get_object())
+    parent = page.get('/Parent')
+    while parent is not None and any(key not in page for key in _INHERITABLE_PAGE_KEYS):
+        parent = parent.get_object()
+        for key in _INHERITABLE_PAGE_KEYS:
+            if key not in page and key in parent:
+                page[NameObject(key)] = parent[key]
+        parent = parent.get('/Parent')
+    return page
+
+
+def shared_reader(file_path):
+    """The PdfReader for file_path cached in this process, opened on first use.
+
+    Entries are keyed on the file's mtime and size as well, so a file replaced
+    in place is parsed again; at most READER_CACHE_SIZE readers are kept.
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+    with _readers_lock:
+        reader = _readers.get(key)
+        if reader is not None:
+            _readers.move_to_end(key)
+            return reader
+    reader = PyPDF2.PdfReader(file_path)
+    with _readers_lock:
+        _readers[key] = reader
+        while len(_readers) > max(1, READER_CACHE_SIZE):
+            _readers.popitem(last=False)
+    return reader
+
+
+def extract_page_range(file_path, start, end, refs=None):
+    """Worker entry point: extract the text layer of pages [start, end) of a PDF.
+
+    refs, when given, are the page_refs() entries for those pages, which lets
+    the worker open just its pages. Returns one dict per page with 'page'
+    (0-based), 'text', 'needs_ocr', and the routing 'reason' and 'signals'.
+    Pages classified as scans skip text extraction entirely; extracted pages
+    still go to OCR when their text is shorter than MIN_TEXT_CHARS or junk.
+    The reader is shared with the other tasks this worker runs for the same file.
+    """
+    reader = shared_reader(file_path)
+    pages = []
+    for page_num in range(start, end):
+        page = _load_page(reader, refs[page_num - start]) if refs else reader.pages[page_num]
+        route, reason, signals = classify_page(page)
+
+        text = ''
+        if route == 'text':
+            try:
+                text = (page.extract_text() or '').strip()
+            except Exception as e:
+                logger.warning(f"Text extraction failed for page {page_num + 1} of {file_path}: {str(e)}")
+            if len(text) < MIN_TEXT_CHARS:
+                reason = 'short_text'
+            elif is_junk_text(text):
+                reason = 'junk_text'
+
+        pages.append({
+            'page': page_num,
+            'text': text,
+            'needs_ocr': route == 'ocr' or reason in ('short_text', 'junk_text'),
+            'reason': reason,
+            'signals': signals,
+        })
+    return pages
+
+
+def record_routing(file_path, pages):
+    """Count routing decisions and append them to PAGE_ROUTING_LOG when it is set."""
+    routing_stats.update(page['reason'] for page in pages)
+    if not PAGE_ROUTING_LOG:
+        return
+    try:
+        with open(PAGE_ROUTING_LOG, 'a', encoding='utf-8') as f:
+            for page in pages:
+                f.write(json.dumps({
+                    'file': os.path.basename(file_path),
+                    'page': page['page'] + 1,
+                    'reason': page['reason'],
+                    'needs_ocr': page['needs_ocr'],
+                    'text_chars': len(page['text']),
+                    **page['signals'],
+                }) + '\n')
+    except OSError as e:
+        logger.warning(f"Could not write page routing log: {str(e)}")
+
+
+def render_runs(page_numbers, max_gap=None):
+    """Group 0-based page numbers into (first, last) runs for a single pdftoppm pass each.
+
+    Pages up to max_gap apart are merged; the pages in between are rendered and
+    discarded, which is cheaper than starting another pdftoppm and re-parsing
+    the PDF.
+    """
+    max_gap = OCR_RENDER_MAX_GAP if max_gap is None else max_gap
+    runs = []
+    for page_num in sorted(set(page_numbers)):
+        if runs and page_num - runs[-1][1] <= max_gap + 1:
+            runs[-1][1] = page_num
+        else:
+            runs.append([page_num, page_num])
+    return [tuple(run) for run in runs]
+
+
+def render_pages_for_ocr(file_path, page_numbers, dpi=None, color_mode=None, max_gap=None):
+    """Yield (page_num, png_bytes) for each requested page, in page order.
+
+    pdftoppm writes PNGs straight to a temporary directory, one invocation per
+    run of nearby pages, so only one page image is held in memory at a time.
+    """
+    dpi = dpi or OCR_DPI
+    color_mode = color_mode or OCR_COLOR_MODE
+    wanted = set(page_numbers)
+
+    with tempfile.TemporaryDirectory(prefix='ocr_render_') as output_folder:
+        for first, last in render_runs(wanted, max_gap):
+            paths = convert_from_path(
+                file_path, dpi=dpi, first_page=first + 1, last_page=last + 1,
+                output_folder=output_folder, fmt='png', paths_only=True,
+                grayscale=color_mode in ('gray', 'mono'),
+            )
+            for page_num, path in zip(range(first, last + 1), sorted(paths)):
+                if page_num in wanted:
+                    if color_mode == 'mono':
+                        yield page_num, _to_mono_png(path)
+                    else:
+                        with open(path, 'rb') as f:
+                            yield page_num, f.read()
+                os.remove(path)
+
+
+def _to_mono_png(path):
+    from PIL import Image
+    with Image.open(path) as image, io.BytesIO() as bio:
+        image.convert('1').save(bio, format='PNG')
+        return bio.getvalue()
+
+
+def page_count(file_path):
+    with open(file_path, 'rb') as f:
+        return len(PyPDF2.PdfReader(f).pages)
+
+
+def iter_pdf_pages(file_path, max_pages=None, pages_per_task=None, pool=None):
+    """Yield page results (see extract_page_range) in page order.
+
+    Up to PDF_MAX_INFLIGHT page ranges are in the pool at once and results are
+    consumed in order, so early pages are available while later ones are still
+    being extracted and memory stays flat however many pages the PDF has.
+    With PDF_WORKERS <= 1 everything runs in-process.
+    """
+    refs = page_refs(file_path)
+    total_pages = len(refs) if max_pages is None else min(len(refs), max_pages)
+    step = max(1, pages_per_task or PDF_PAGES_PER_TASK)
+    tasks = [(file_path, start, min(start + step, total_pages), refs[start:start + step])
+             for start in range(0, total_pages, step)]
+
+    if PDF_WORKERS <= 1 and pool is None:
+        for task in tasks:
+            pages = extract_page_range(*task)
+            record_routing(file_path, pages)
+            yield from pages
+        return
+
+    executor = pool or get_pool()
+    pending = deque()
+    remaining = iter(tasks)
+    try:
+        for task in islice(remaining, max(1, PDF_MAX_INFLIGHT)):
+            pending.append(executor.submit(extract_page_range, *task))
+        while pending:
+            pages = pending.popleft().result()
+            for task in islice(remaining, 1):
+                pending.append(executor.submit(extract_page_range, *task))
+            record_routing(file_path, pages)
+            yield from pages
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def benchmark(file_path, workers=None, pages_per_task=None):
+    """Compare serial extraction with the pool for one PDF, and per-page with batched OCR rendering."""
+    total_pages = page_count(file_path)
+
+    start = time.perf_counter()
+    serial = extract_page_range(file_path, 0, total_pages)
+    serial_seconds = time.perf_counter() - start
+
+    pool = ProcessPoolExecutor(max_workers=workers or PDF_WORKERS,
+                               mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_limit_worker_memory, initargs=(PDF_WORKER_MEMORY_MB,))
+    try:
+        # Warm the workers so process start-up is not counted
+        list(pool.map(page_count, [file_path] * (workers or PDF_WORKERS)))
+        start = time.perf_counter()
+        parallel = list(iter_pdf_pages(file_path, pages_per_task=pages_per_task, pool=pool))
+        parallel_seconds = time.perf_counter() - start
+    finally:
+        pool.shutdown()
+
+    assert [p['text'] for p in parallel] == [p['text'] for p in serial]
+    stats = {
+        'pages': total_pages,
+        'ocr_pages': sum(1 for p in serial if p['needs_ocr']),
+        'serial_seconds': serial_seconds,
+        'parallel_seconds': parallel_seconds,
+        'speedup': serial_seconds / parallel_seconds if parallel_seconds else float('inf'),
+    }
+
+    ocr_pages = [p['page'] for p in serial if p['needs_ocr']]
+    if ocr_pages:
+        # What extraction used to do: one pdftoppm run (and PDF parse) per page, decoded in Python
+        start = time.perf_counter()
+        for page_num in ocr_pages:
+            images = convert_from_path(file_path, first_page=page_num + 1, last_page=page_num + 1)
+            with io.BytesIO() as bio:
+                images[0].save(bio, format='PNG')
+        stats['render_per_page_seconds'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in render_pages_for_ocr(file_path, ocr_pages):
+            pass
+        stats['render_batched_seconds'] = time.perf_counter() - start
+    return stats
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    for path in sys.argv[1:]:
+        stats = benchmark(path)
+        print(f"{os.path.basename(path)}: {stats['pages']} pages ({stats['ocr_pages']} need OCR), "
+              f"serial {stats['serial_seconds']:.2f} s, pool {stats['parallel_seconds']:.2f} s "
+              f"({stats['speedup']:.1f}x)")
+        if 'render_batched_seconds' in stats:
+            print(f"  OCR rendering: per page {stats['render_per_page_seconds']:.2f} s, "
+                  f"batched {stats['render_batched_seconds']:.2f} s")
@@ -0,0 +1,182 @@
+"""
+Cross-process rate limiting for outbound Claude calls.
+
+Every gunicorn worker shares one pair of token buckets, requests per minute
+and input tokens per minute, kept in a small JSON state file guarded by an
+exclusive flock. A call waits until both buckets can cover it, so concurrent
+uploads queue up instead of tripping 429s and failing whole analyses.
+
+Calls are made in one of two lanes. 'interactive' calls (follow-up questions
+a user is waiting on) may drain the buckets completely. 'bulk' calls (legal
+pack batches) must leave INTERACTIVE_RESERVE of each bucket untouched and
+also hold back while any interactive call is waiting, so a question never
+queues behind a pack. A 429 from the API pauses every process until its
+retry-after has passed.
+"""
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import tempfile
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:  # Not on POSIX: limits apply per process only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+CLAUDE_REQUESTS_PER_MINUTE = float(os.environ.get('CLAUDE_REQUESTS_PER_MINUTE', 50))
+CLAUDE_TOKENS_PER_MINUTE = float(os.environ.get('CLAUDE_TOKENS_PER_MINUTE', 40000))
+CLAUDE_RATE_LIMIT_FILE = os.environ.get(
+    'CLAUDE_RATE_LIMIT_FILE', os.path.join(tempfile.gettempdir(), 'claude_rate_limit.json'))
+# Share of each bucket that bulk calls may not use
+INTERACTIVE_RESERVE = float(os.environ.get('CLAUDE_INTERACTIVE_RESERVE', 0.2))
+# How long a waiting interactive call holds back bulk calls without checking in again
+WAITER_TTL_SECONDS = 5.0
+MAX_POLL_SECONDS = 1.0
+# The state file lock is polled rather than waited on: gevent does not patch flock(), so a
+# blocking call would stall every greenlet in the worker while another process holds it
+LOCK_POLL_SECONDS = 0.005
+LOCK_TIMEOUT_SECONDS = 10.0
+
+
+class TokenBucketScheduler:
+    """Requests/min and tokens/min token buckets shared through a locked state file."""
+
+    def __init__(self, state_path, requests_per_minute, tokens_per_minute, interactive_reserve=INTERACTIVE_RESERVE):
+        self.state_path = state_path
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.interactive_reserve = interactive_reserve
+        self._thread_lock = threading.Lock()
+        self.granted = {INTERACTIVE: 0, BULK: 0}
+        self.waited_seconds = {INTERACTIVE: 0.0, BULK: 0.0}
+
+    @staticmethod
+    def _flock(fd):
+        """Take an exclusive flock on fd, sleeping (a gevent yield once patched) while it is held elsewhere."""
+        deadline = time.monotonic() + LOCK_TIMEOUT_SECONDS
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError("Timed out waiting for the rate limit state lock")
+                time.sleep(LOCK_POLL_SECONDS)
+
+    @contextlib.contextmanager
+    def _locked_state(self):
+        """Yield the refilled bucket state under the cross-process lock; changes are written back."""
+        # Each open() gets its own flock, so the file lock also serialises threads and greenlets of this
+        # process. The thread lock is only needed without fcntl; it is a real OS lock (created before
+        # gevent patches threading) and must not be held across the polling sleep.
+        with (self._thread_lock if fcntl is None else contextlib.nullcontext()):
+            fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                if fcntl is not None:
+                    self._flock(fd)
+                with os.fdopen(os.dup(fd), 'r+') as f:
+                    try:
+                        state = json.loads(f.read() or '{}')
+                    except ValueError:
+                        state = {}
+                    now = time.time()
+                    elapsed = max(0.0, now - state.get('updated', now))
+                    state['requests'] = min(self.requests_per_minute,
+                                            state.get('requests', self.requests_per_minute)
+                                            + elapsed * self.requests_per_minute / 60)
+                    state['tokens'] = min(self.tokens_per_minute,
+                                          state.get('tokens', self.tokens_per_minute)
+                                          + elapsed * self.tokens_per_minute / 60)
+                    state['updated'] = now
+                    state['waiters'] = {key: expires for key, expires in state.get('waiters', {}).items()
+                                        if expires > now}
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+            finally:
+                os.close(fd)  # Also releases the flock
+
+    def _wait_seconds(self, state, tokens, priority):
+        """Seconds until this call could go ahead, or 0 if it can go now."""
+        now = time.time()
+        if state.get('paused_until', 0) > now:
+            return state['paused_until'] - now
+        reserve = 0.0 if priority == INTERACTIVE else self.interactive_reserve
+        if priority != INTERACTIVE and state['waiters']:
+            return MAX_POLL_SECONDS
+        request_gap = 1 + reserve * self.requests_per_minute - state['requests']
+        token_gap = tokens + reserve * self.tokens_per_minute - state['tokens']
+        return max(0.0,
+                   request_gap * 60 / self.requests_per_minute,
+                   token_gap * 60 / self.tokens_per_minute)
+
+    def acquire(self, tokens, priority=BULK):
+        """Block until a call of about `tokens` input tokens may be made; returns seconds waited."""
+        # A call bigger than the whole bucket could never be granted; let it through when the bucket is full
+        tokens = min(tokens, self.tokens_per_minute * (1 - self.interactive_reserve))
+        waiter = uuid.uuid4().hex
+        start = time.monotonic()
+        try:
+            while True:
+                with self._locked_state() as state:
+                    wait = self._wait_seconds(state, tokens, priority)
+                    if wait <= 0:
+                        state['requests'] -= 1
+                        state['tokens'] -= tokens
+                        state['waiters'].pop(waiter, None)
+                        break
+                    if priority == INTERACTIVE:
+                        state['waiters'][waiter] = time.time() + WAITER_TTL_SECONDS
+                time.sleep(min(wait, MAX_POLL_SECONDS) * random.uniform(0.8, 1.0))
+        except OSError as e:
+            # The limiter must never take the app down; fall through unthrottled
+            logger.error(f"Rate limiter unavailable, calling Claude unthrottled: {str(e)}")
+        waited = time.monotonic() - start
+        self.granted[priority] += 1
+        self.waited_seconds[priority] += waited
+        if waited >= 1:
+            logger.info(f"Waited {waited:.1f}s for Claude rate limit ({priority})")
+        return waited
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Correct the tokens bucket once the real input token count is known."""
+        try:
+            with self._locked_state() as state:
+                state['tokens'] += estimated_tokens - actual_tokens
+        except OSError as e:
+            logger.error(f"Rate limiter unavailable: {str(e)}")
+
+    def pause(self, seconds):
+        """Hold back every process's calls for `seconds` (after a 429)."""
+        try:
+            with self._locked_state() as state:
+                state['paused_until'] = max(state.get('paused_until', 0), time.time() + seconds)
+        except OSError as e:
+            logger.error(f"Rate limiter unavailable: {str(e)}")
+
+    def stats(self):
+        try:
+            with self._locked_state() as state:
+                snapshot = dict(state)
+        except OSError:
+            snapshot = {}
+        return {
+            'requests_per_minute': self.requests_per_minute,
+            'tokens_per_minute': self.tokens_per_minute,
+            'requests_available': round(snapshot.get('requests', 0), 2),
+            'tokens_available': round(snapshot.get('tokens', 0)),
+            'interactive_waiting': len(snapshot.get('waiters', {})),
+            'granted': dict(self.granted),
+            'waited_seconds': {lane: round(seconds, 2) for lane, seconds in self.waited_seconds.items()},
+        }
@@ -0,0 +1,21 @@
+import argparse
+import json
+from app import app, recompute_portfolio
+from deal_engine import PERCENT_FIELDS
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-price every property under new rate assumptions")
+    for field in PERCENT_FIELDS:
+        parser.add_argument(f"--{field.replace('_', '-')}", type=float, dest=field,
+                            help=f"New {field.replace('_', ' ')} (%%) applied to every property")
+    parser.add_argument('--chunk-size', type=int, default=500, help="Rows per UPDATE batch")
+    args = parser.parse_args()
+
+    rate_overrides = {field: getattr(args, field) for field in PERCENT_FIELDS if getattr(args, field) is not None}
+
+    with app.app_context():
+        stats = recompute_portfolio(rate_overrides=rate_overrides, chunk_size=args.chunk_size)
+    print(json.dumps(stats, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import os
+import json
+import contextlib
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+class ResponseCache:
+    """Persistent cache of Claude responses.
+
+    Entries are keyed by a hash of everything that determines the answer
+    (model, system prompt, messages and sampling settings), so re-uploads and
+    re-runs after a crash reuse batches that already finished instead of
+    paying for them again. Entries older than ttl_seconds are treated as
+    misses. Once the cache grows past max_bytes, the least recently used
+    entries are deleted until it is back under 90% of the limit.
+    """
+
+    def __init__(self, cache_dir, ttl_seconds, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._total_bytes = sum(size for _, size, _ in self._entries())
+
+    @staticmethod
+    def key(model, system, messages, **settings):
+        """Hash of the request fields that determine the response."""
+        payload = json.dumps({'model': model, 'system': system, 'messages': messages, 'settings': settings},
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def _entries(self):
+        """(path, size, last_used) for every entry on disk."""
+        for path in self.cache_dir.glob('*/*.json'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key):
+        """Return the cached response text, or None on a miss or an expired entry."""
+        path = self._entry_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable response cache entry {path}: {str(e)}")
+            self.misses += 1
+            return None
+
+        if time.time() - entry.get('created', 0) > self.ttl_seconds:
+            self.expired += 1
+            self.misses += 1
+            self._remove(path)
+            return None
+
+        # mtime records the last use, which is what eviction orders by
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry['response']
+
+    def put(self, key, response, model=None):
+        """Store a response atomically, then evict if the cache is over its size limit."""
+        path = self._entry_path(key)
+        entry = {
+            'response': response,
+            'model': model,
+            'created': time.time(),
+            'created_at': datetime.utcnow().isoformat()
+        }
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(entry, f, ensure_ascii=False)
+                size = os.path.getsize(tmp_path)
+                os.replace(tmp_path, path)
+            except BaseException:
+                # Don't leave a half-written temp file behind in the cache directory
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp_path)
+                raise
+        except Exception as e:
+            logger.warning(f"Failed to write response cache entry {path}: {str(e)}")
+            return
+
+        with self._lock:
+            self._total_bytes += size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _remove(self, path):
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._total_bytes -= size
+
+    def _evict(self):
+        """Delete least recently used entries until the cache is under 90% of max_bytes (lock held)."""
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        # Re-sync with the disk; other processes share the directory
+        self._total_bytes = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for path, size, _ in entries:
+            if self._total_bytes <= target:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            self._total_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            'size_bytes': self._total_bytes,
+            'max_bytes': self.max_bytes
+        }
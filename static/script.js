@@ -102,17 +102,19 @@ document.addEventListener('DOMContentLoaded', function() {
         `;
     }
 
-    async function loadProperties() {
+    async function loadProperties(more = false) {
         try {
-            const response = await fetch('/api/properties');
-            const properties = await response.json();
+            const properties = await fetchPropertyPage(more ? nextPropertyCursor : null);
             
-            propertyList.innerHTML = ''; // Clear existing list
+            if (!more) {
+                propertyList.innerHTML = ''; // Clear existing list
+            }
             
             properties.forEach(property => {
                 const propertyCard = createPropertyCard(property);
                 propertyList.appendChild(propertyCard);
             });
+            showLoadMoreButton(propertyList, () => loadProperties(true));
         } catch (error) {
             console.error('Error loading properties:', error);
         }
@@ -248,13 +250,43 @@ function formatCurrency(amount) {
     }).format(amount);
 }
 
-async function loadProperties() {
+const PROPERTY_PAGE_SIZE = 50;
+let nextPropertyCursor = null; // X-Next-Cursor of the last page loaded
+
+// One page of the property list, newest first
+async function fetchPropertyPage(cursor) {
+    const url = `/api/properties?limit=${PROPERTY_PAGE_SIZE}` + (cursor ? `&cursor=${encodeURIComponent(cursor)}` : '');
+    const response = await fetch(url);
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    const properties = await response.json();
+    nextPropertyCursor = response.headers.get('X-Next-Cursor');
+    return properties;
+}
+
+// A "Load more" button after the list while older properties remain
+function showLoadMoreButton(propertyList, onClick) {
+    let button = document.getElementById('loadMoreProperties');
+    if (!button) {
+        button = document.createElement('button');
+        button.id = 'loadMoreProperties';
+        button.className = 'btn btn-outline-secondary mb-4';
+        button.textContent = 'Load more';
+        propertyList.after(button);
+    }
+    button.onclick = onClick;
+    button.classList.toggle('d-none', !nextPropertyCursor);
+}
+
+async function loadProperties(more = false) {
     try {
-        const response = await fetch('/api/properties');
-        const properties = await response.json();
+        const properties = await fetchPropertyPage(more ? nextPropertyCursor : null);
         
         const propertyList = document.getElementById('propertyList');
-        propertyList.innerHTML = '';
+        if (!more) {
+            propertyList.innerHTML = '';
+        }
         
         properties.forEach(property => {
             const card = document.createElement('div');
@@ -276,6 +308,7 @@ async function loadProperties() {
             `;
             propertyList.appendChild(card);
         });
+        showLoadMoreButton(propertyList, () => loadProperties(true));
     } catch (error) {
         console.error('Error loading properties:', error);
     }
@@ -0,0 +1,187 @@
+import os
+import json
+import shutil
+import subprocess
+import numpy as np
+import pytest
+from deal_engine import (calculate_deal, calculate_properties, calculate_stamp_duty,
+                         deal_inputs_from_properties, max_purchase_price, sensitivity_grid)
+
+CALCULATOR_JS = os.path.join(os.path.dirname(__file__), 'static', 'js', 'propertyCalculator.js')
+
+# Runs the same chain as updateCalculations() in calculator_test.html for every case
+NODE_SCRIPT = """
+const fs = require('fs');
+const PropertyCalculator = new Function(fs.readFileSync(process.argv[1], 'utf8') + '; return PropertyCalculator;')();
+const calculator = new PropertyCalculator();
+const cases = JSON.parse(fs.readFileSync(0, 'utf8'));
+const results = cases.map(c => {
+    const stampDuty = calculator.calculateStampDuty(c.purchase_price);
+    const totalPurchaseFees = calculator.calculateTotalPurchaseFees(stampDuty, c.extra_fees);
+    const totalMoneyNeeded = calculator.calculateTotalMoneyNeeded(totalPurchaseFees, c.purchase_price);
+    const bridging = calculator.calculateBridgingLoan({
+        initialCash: c.initial_cash, totalMoneyNeeded, renovationCost: c.renovation_cost,
+        bridgingRate: c.bridging_rate, arrangementRate: c.arrangement_rate,
+        brokerRate: c.broker_rate, bridgingDuration: c.bridging_duration
+    });
+    const mortgage = calculator.calculateMortgage({
+        mortgageLtv: c.mortgage_ltv, valuationAfter: c.valuation_after,
+        lenderFee: c.lender_fee, mortgageRate: c.mortgage_rate
+    });
+    const rental = calculator.calculateRental({
+        monthlyRent: c.monthly_rent, rooms: c.rooms, managementFee: c.management_fee
+    });
+    const profit = calculator.calculateProfit({
+        rentalIncome: rental.rentalIncome, annualMortgageInterest: mortgage.annualMortgageInterest,
+        totalMoneyNeeded, bridgingCost: bridging.bridgingCost, renovationCost: c.renovation_cost,
+        arrangementFees: bridging.arrangementFees, brokerFees: bridging.brokerFees,
+        mortgageAmount: mortgage.mortgageAmount, valuationAfter: c.valuation_after
+    });
+    const flip = calculator.calculateFlipProfit({
+        valuationAfter: c.valuation_after, totalMoneyNeeded, renovationCost: c.renovation_cost,
+        bridgingCost: bridging.bridgingCost, arrangementFees: bridging.arrangementFees,
+        brokerFees: bridging.brokerFees
+    });
+    return {
+        stamp_duty: stampDuty,
+        total_purchase_fees: totalPurchaseFees,
+        total_money_needed: totalMoneyNeeded,
+        bridging_needed: bridging.bridgingNeeded,
+        bridging_cost: bridging.bridgingCost,
+        broker_fees: bridging.brokerFees,
+        mortgage_amount: mortgage.mortgageAmount,
+        annual_mortgage_interest: mortgage.annualMortgageInterest,
+        rental_income: rental.rentalIncome,
+        annual_profit: profit.annualProfit,
+        cash_left_in_deal: profit.cashLeftInDeal,
+        total_roi: profit.totalROI,
+        total_yield: profit.totalYield,
+        flip_profit_before_tax: flip.flipProfitBeforeTax,
+        flip_profit_after_tax: flip.flipProfitAfterTax
+    };
+});
+process.stdout.write(JSON.stringify(results));
+"""
+
+def random_cases(count=500, seed=42):
+    """Random deals covering every stamp duty band, plus a few hand-picked edge cases"""
+    rng = np.random.default_rng(seed)
+    cases = []
+    for _ in range(count):
+        cases.append({
+            'initial_cash': float(rng.uniform(0, 600000)),
+            'purchase_price': float(rng.uniform(20000, 2500000)),
+            'extra_fees': float(rng.uniform(0, 5000)),
+            'rooms': int(rng.integers(0, 8)),
+            'monthly_rent': float(rng.uniform(0, 9000)),
+            'valuation_after': float(rng.uniform(30000, 3000000)),
+            'renovation_cost': float(rng.uniform(0, 200000)),
+            'bridging_duration': int(rng.integers(1, 24)),
+            'mortgage_ltv': float(rng.uniform(0, 0.9)),
+            'mortgage_rate': float(rng.uniform(0, 0.1)),
+            'lender_fee': float(rng.uniform(0, 0.03)),
+            'bridging_rate': float(rng.uniform(0, 0.02)),
+            'arrangement_rate': float(rng.uniform(0, 0.03)),
+            'broker_rate': float(rng.uniform(0, 0.02)),
+            'management_fee': float(rng.uniform(0, 0.2)),
+        })
+    for price in [125000, 125001, 925000, 925001, 1500000, 1500001]:
+        edge = dict(cases[0])
+        edge['purchase_price'] = float(price)
+        cases.append(edge)
+    return cases
+
+def run_js_calculator(cases):
+    completed = subprocess.run(
+        ['node', '-e', NODE_SCRIPT, CALCULATOR_JS],
+        input=json.dumps(cases), capture_output=True, text=True, check=True
+    )
+    return json.loads(completed.stdout)
+
+def test_parity_with_js_calculator():
+    """Every metric matches PropertyCalculator in propertyCalculator.js"""
+    if not shutil.which('node'):
+        pytest.skip("node is required to run the JS calculator")
+
+    cases = random_cases()
+    expected = run_js_calculator(cases)
+    inputs = {key: np.array([c[key] for c in cases], dtype=float) for key in cases[0]}
+    results = calculate_deal(**inputs)
+
+    for key in expected[0]:
+        js_values = np.array([row[key] for row in expected], dtype=float)
+        np.testing.assert_allclose(results[key], js_values, rtol=1e-9, atol=1e-6, err_msg=key)
+
+def test_stamp_duty_bands():
+    prices = np.array([100000, 125000, 300000, 925000, 1000000, 2000000])
+    expected = [5000, 6250, 20250, 70250, 80000, 220000]
+    np.testing.assert_allclose(calculate_stamp_duty(prices), expected)
+
+def test_inputs_from_properties_convert_percentages():
+    """Stored percentages are divided by 100 and missing values count as 0"""
+    inputs = deal_inputs_from_properties([
+        {'purchase_price': 200000, 'mortgage_rate': 5.5, 'rooms': None},
+    ])
+    assert inputs['purchase_price'][0] == 200000
+    assert inputs['mortgage_rate'][0] == pytest.approx(0.055)
+    assert inputs['rooms'][0] == 0
+    assert inputs['initial_cash'][0] == 0
+
+def test_sensitivity_grid_matches_single_deal():
+    """Each grid point equals pricing the property with those inputs directly"""
+    prop = {'purchase_price': 200000, 'initial_cash': 100000, 'mortgage_rate': 5.5, 'mortgage_ltv': 75,
+            'valuation_after': 250000, 'monthly_rent': 2000, 'rooms': 4, 'bridging_duration': 6}
+    axes = {
+        'purchase_price': np.linspace(150000, 250000, 5),
+        'mortgage_rate': np.linspace(4.0, 7.0, 4),
+        'monthly_rent': np.linspace(1500, 2500, 3),
+    }
+    grid = sensitivity_grid(prop, axes)
+    assert grid['total_roi'].shape == (5, 4, 3)
+
+    point = dict(prop, purchase_price=axes['purchase_price'][3], mortgage_rate=axes['mortgage_rate'][1],
+                 monthly_rent=axes['monthly_rent'][2])
+    single = calculate_properties([point])
+    assert grid['total_roi'][3, 1, 2] == pytest.approx(single['total_roi'][0])
+    assert grid['total_yield'][3, 1, 2] == pytest.approx(single['total_yield'][0])
+
+def test_simulation_without_uncertainty_matches_deterministic_deal():
+    """With every distribution collapsed, all scenarios equal the plain calculator result"""
+    from deal_simulation import simulate_deal
+    prop = {'purchase_price': 200000, 'initial_cash': 100000, 'mortgage_rate': 5.5, 'mortgage_ltv': 75,
+            'valuation_after': 250000, 'monthly_rent': 2000, 'rooms': 4, 'bridging_duration': 6,
+            'renovation_cost': 20000, 'bridging_rate': 1}
+    assumptions = {'rent_sd': 0, 'void_months_mean': 0, 'refurb_overrun_low': 1, 'refurb_overrun_mode': 1,
+                   'refurb_overrun_high': 1, 'valuation_sd': 0, 'mortgage_rate_shock_sd': 0,
+                   'bridging_rate_shock_sd': 0}
+    expected = calculate_properties([prop])
+    result = simulate_deal(prop, scenarios=1000, seed=1, assumptions=assumptions)
+    for metric, stats in result['metrics'].items():
+        for value in stats['percentiles'].values():
+            assert value == pytest.approx(expected[metric][0], abs=0.01)
+
+def test_max_purchase_price_is_highest_price_meeting_target():
+    props = [
+        {'initial_cash': 100000, 'monthly_rent': 2000, 'valuation_after': 250000, 'renovation_cost': 20000,
+         'bridging_duration': 6, 'mortgage_ltv': 75, 'mortgage_rate': 5.5, 'bridging_rate': 1, 'rooms': 4},
+        {'initial_cash': 1000000, 'monthly_rent': 10000, 'valuation_after': 2000000, 'mortgage_ltv': 75,
+         'mortgage_rate': 5.5, 'rooms': 2},
+        {'monthly_rent': 0},
+    ]
+    max_bids = max_purchase_price(deal_inputs_from_properties(props), target_roi=10)
+
+    assert np.isnan(max_bids[2])
+    for prop, bid in zip(props[:2], max_bids[:2]):
+        assert calculate_properties([dict(prop, purchase_price=bid)])['total_roi'][0] >= 10
+        assert calculate_properties([dict(prop, purchase_price=bid + 2)])['total_roi'][0] < 10
+
+
+def test_max_purchase_price_rejects_loss_making_deals():
+    # A loss over negative cash left in the deal gives a huge positive raw ROI
+    prop = {'initial_cash': 0, 'monthly_rent': 500, 'valuation_after': 300000, 'mortgage_ltv': 75,
+            'mortgage_rate': 15, 'rooms': 3, 'bridging_duration': 6}
+    assert calculate_properties([prop])['annual_profit'][0] < 0
+
+    max_bids = max_purchase_price(deal_inputs_from_properties([prop]), target_roi=10)
+
+    assert np.isnan(max_bids[0])
@@ -2,8 +2,11 @@ import os
 import zipfile
 import tempfile
 import logging
+import re
 import json
+import contextlib
 from datetime import datetime
+from unittest import mock
 from app import process_zip_file, process_document
 import shutil
 
@@ -55,6 +58,21 @@ def save_processing_results(documents):
     logger.info(f"Results saved to {filepath}")
     return filepath
 
+@contextlib.contextmanager
+def in_memory_db():
+    """Point the app at a fresh in-memory SQLite database (shared across threads) for the block"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import StaticPool
+    from app import app, db
+    engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+    with app.app_context(), mock.patch.dict(db.engines, {None: engine}, clear=True):
+        try:
+            db.create_all()
+            yield app, db
+        finally:
+            db.session.remove()
+            engine.dispose()
+
 def test_process_documents():
     """Test processing each document individually"""
     source_dir = os.path.join(os.path.dirname(__file__), 'Lot_62_DocumentArchive (1)')
@@ -117,6 +135,407 @@ def test_zip_processing():
         if os.path.exists(zip_path):
             os.remove(zip_path)
 
+def test_zip_document_count_includes_nested_archives():
+    """files_total counts the documents inside nested ZIPs, stored or compressed, like iter_zip_members"""
+    import io
+    from app import count_zip_documents, iter_zip_members
+
+    def archive(members, compression=zipfile.ZIP_DEFLATED):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', compression) as zipf:
+            for name, data in members.items():
+                zipf.writestr(name, data)
+        return buffer.getvalue()
+
+    inner = archive({'plan.pdf': b'%PDF', 'search.pdf': b'%PDF'})
+    outer = archive({
+        'lease.pdf': b'%PDF',
+        '__MACOSX/._lease.pdf': b'',
+        'stored.zip': archive({'title.pdf': b'%PDF', 'deeper.zip': inner}, zipfile.ZIP_STORED),
+        'compressed.zip': inner,
+    })
+    names = [name for name, _, _ in iter_zip_members(io.BytesIO(outer))]
+    assert len(names) == 6
+    assert count_zip_documents(io.BytesIO(outer)) == len(names)
+
+def test_extraction_cache_round_trip():
+    """Cached text is keyed by file content and extractor version"""
+    from extraction_cache import ExtractionCache
+    cache_dir = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(cache_dir, 'doc.txt')
+        with open(file_path, 'w') as f:
+            f.write('Special conditions of sale')
+
+        cache = ExtractionCache(os.path.join(cache_dir, 'cache'), extractor_version=1)
+        digest = cache.file_digest(file_path)
+        assert cache.get(digest) is None
+        cache.put(digest, 'Special conditions of sale', 5, source_name='doc.txt')
+        assert cache.get(digest)['tokens'] == 5
+        assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+        # A new extractor version does not reuse old entries
+        assert ExtractionCache(os.path.join(cache_dir, 'cache'), extractor_version=2).get(digest) is None
+
+        # A failed write leaves no temp file behind
+        cache.put('ab' * 32, object(), 1)
+        assert not [name for name in os.listdir(os.path.join(cache_dir, 'cache', 'ab')) if name.endswith('.tmp')]
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_response_cache_expiry_and_eviction():
+    """Claude responses are reused until they expire or the cache outgrows its size limit"""
+    from response_cache import ResponseCache
+    cache_dir = tempfile.mkdtemp()
+    try:
+        request = dict(model='claude', system='conveyancer', messages=[{'role': 'user', 'content': 'batch'}],
+                       max_tokens=10, temperature=0)
+        key = ResponseCache.key(**request)
+        assert key != ResponseCache.key(**dict(request, model='other'))
+
+        cache = ResponseCache(cache_dir, ttl_seconds=3600, max_bytes=2000)
+        assert cache.get(key) is None
+        cache.put(key, 'analysis')
+        assert cache.get(key) == 'analysis'
+        assert ResponseCache(cache_dir, ttl_seconds=0, max_bytes=2000).get(key) is None
+
+        for n in range(20):
+            cache.put(ResponseCache.key(**dict(request, max_tokens=n)), 'x' * 200)
+        assert cache.stats()['evictions'] > 0 and cache.stats()['size_bytes'] <= 2000
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_render_runs_merge_nearby_pages():
+    """Pages needing OCR are grouped so each pdftoppm pass covers a run of nearby pages"""
+    from pdf_extraction import render_runs
+    assert render_runs([0, 1, 2, 7, 8, 20, 22], max_gap=3) == [(0, 2), (7, 8), (20, 22)]
+    assert render_runs([3, 1], max_gap=0) == [(1, 1), (3, 3)]
+
+def test_vision_batches_fall_back_to_local_ocr():
+    """Pages are sent in batches of 16 and a failed batch, or pages missing from a response, are OCR'd by the fallback"""
+    from ocr import StubVisionClient, vision_ocr_pages
+    pages = [(page_num, b'page') for page_num in range(20)]
+
+    client = StubVisionClient(request_latency=0, image_latency=0)
+    texts = vision_ocr_pages(client, pages, fallback=None)
+    assert client.requests == 2
+    assert sorted(texts) == list(range(20))
+
+    failing = StubVisionClient(request_latency=0, image_latency=0, fail_batches=True)
+    texts = vision_ocr_pages(failing, pages, fallback=lambda image: 'tesseract text')
+    assert set(texts.values()) == {'tesseract text'}
+
+    # Pages Vision returns no response for are OCR'd by the fallback too
+    short = StubVisionClient(request_latency=0, image_latency=0, missing_responses=2)
+    texts = vision_ocr_pages(short, pages, fallback=lambda image: 'tesseract text')
+    assert sorted(texts) == list(range(20))
+    assert sorted(key for key, text in texts.items() if text == 'tesseract text') == [14, 15, 18, 19]
+
+def test_ocr_engine_selection():
+    """Auto mode uses Vision when it can and tesseract otherwise"""
+    from ocr import StubVisionClient, VISION_MAX_IMAGE_BYTES, select_engine
+    client = StubVisionClient()
+    assert select_engine(b'page', None, 'auto') == 'tesseract'
+    assert select_engine(b'page', client, 'auto') == 'vision'
+    assert select_engine(b'x' * (VISION_MAX_IMAGE_BYTES + 1), client, 'auto') == 'tesseract'
+    assert select_engine(b'page', client, 'tesseract') == 'tesseract'
+
+def test_scanned_pages_skip_text_extraction():
+    """The pre-pass sends image-only pages to OCR and keeps real text layers"""
+    from pdf_extraction import extract_page_range
+    source_dir = os.path.join(os.path.dirname(__file__), 'Lot_62_DocumentArchive (1)')
+
+    scan = extract_page_range(os.path.join(source_dir, 'Lot_62_10603380 Certified Copy Death Certificate.pdf'), 0, 1)[0]
+    assert scan['needs_ocr'] and scan['reason'] == 'no_text_layer' and scan['text'] == ''
+    assert scan['signals']['image_coverage'] == 1.0
+
+    text_page = extract_page_range(os.path.join(source_dir, 'Lot_62_TR1.pdf'), 0, 1)[0]
+    assert not text_page['needs_ocr'] and text_page['reason'] == 'text_layer'
+
+def test_form_xobject_text_is_not_sent_to_ocr():
+    """Text drawn through a Form XObject counts as a text layer"""
+    from pdf_extraction import extract_page_range
+    lines = ' '.join(f"0 -14 Td (Clause {n}: the lessee shall keep the premises in good repair.) Tj" for n in range(6))
+    form = f"BT /F1 10 Tf 72 720 Td {lines} ET".encode()
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /XObject << /Fm0 4 0 R >> >> "
+        b"/Contents 5 0 R >>",
+        b"<< /Type /XObject /Subtype /Form /BBox [0 0 612 792] /Resources << /Font << /F1 6 0 R >> >> "
+        b"/Length %d >>\nstream\n%s\nendstream" % (len(form), form),
+        b"<< /Length 20 >>\nstream\nq /Fm0 Do Q 1 0 0 rg\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+
+    fd, path = tempfile.mkstemp(suffix='.pdf')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pdf)
+        page = extract_page_range(path, 0, 1)[0]
+        assert page['reason'] == 'text_layer' and not page['needs_ocr']
+        assert page['signals']['fonts'] == 1 and page['signals']['text_ops'] == 6
+        assert 'good repair' in page['text']
+    finally:
+        os.remove(path)
+
+def test_chunk_index_retrieves_relevant_passages():
+    """Follow-ups get the passages that match the question, and the index survives a JSON round trip"""
+    from chunk_index import ChunkIndex
+    documents = [
+        {'name': 'Lease', 'content': 'The ground rent is 250 pounds per annum, doubling every 25 years.\n\n' + 'Filler clause. ' * 200},
+        {'name': 'Searches', 'content': 'The local authority search shows no planning enforcement notices.'},
+        {'name': 'Title', 'content': 'A restrictive covenant prevents use of the property as a shop.'},
+    ]
+    index = ChunkIndex.from_json(ChunkIndex.build(documents, max_tokens=120).to_json())
+    assert len(index.chunks) > len(documents)
+    assert index.search('What is the ground rent?', k=1)[0][1]['document'] == 'Lease'
+    assert index.search('Are there any restrictive covenants?', k=1)[0][1]['document'] == 'Title'
+    assert index.search('zebra crossing') == []
+
+def test_token_counts_are_memoized_and_calibrate_the_estimator():
+    """Repeated counts hit the memo and the estimator adopts the observed chars-per-token ratio"""
+    import token_counting
+    saved = token_counting._encoder, token_counting._encoder_failed
+    token_counting._encoder, token_counting._encoder_failed = token_counting._stand_in_encoder(), False
+    try:
+        text = 'Ground rent is payable quarterly in advance. ' * 500
+        tokens = token_counting.count_tokens(text)
+        hits = token_counting.stats()['hits']
+        assert token_counting.count_tokens(text) == tokens
+        assert token_counting.stats()['hits'] == hits + 1
+        assert abs(token_counting.estimate_tokens(text) - tokens) < tokens * 0.2
+    finally:
+        token_counting._encoder, token_counting._encoder_failed = saved
+
+def test_chunk_text_bounds_chunks_and_snaps_to_sentences():
+    """Chunks never exceed the token limit, end on sentence boundaries, and split text with no boundaries"""
+    import token_counting
+    saved = token_counting._encoder, token_counting._encoder_failed
+    encoder = token_counting._stand_in_encoder()
+    token_counting._encoder, token_counting._encoder_failed = encoder, False
+    try:
+        text = ('The lessee shall keep the premises in repair. ' * 30 + '\n\n') * 10
+        chunks = token_counting.chunk_text(text, 400, overlap_tokens=40)
+        assert all(len(encoder.encode(chunk)) <= 400 for chunk in chunks)
+        assert all(chunk.endswith('repair.') for chunk in chunks)
+        assert chunks[1][:40] in chunks[0]
+
+        blob = token_counting.chunk_text('X' * 5000, 400)
+        assert len(blob) == 13 and ''.join(blob) == 'X' * 5000
+    finally:
+        token_counting._encoder, token_counting._encoder_failed = saved
+
+def test_batch_packing_does_not_depend_on_estimator_calibration():
+    """Batches are packed from stored exact counts, so response cache keys survive a restart"""
+    import token_counting
+    from document_batches import pack_batches
+    documents = [{'name': f'Doc {n}', 'content': 'Clause. ' * 500, 'tokens': 1000 + 700 * (n % 3)} for n in range(12)]
+    saved = token_counting._calibration_chars, token_counting._calibration_tokens
+    try:
+        token_counting._calibration_chars, token_counting._calibration_tokens = 0, 0
+        fresh = pack_batches(documents, 4000)
+        token_counting._calibration_chars, token_counting._calibration_tokens = 100000, 50000
+        calibrated = pack_batches(documents, 4000)
+    finally:
+        token_counting._calibration_chars, token_counting._calibration_tokens = saved
+    assert fresh == calibrated and len(fresh) == 8
+
+def test_followup_request_caches_the_stable_prefix():
+    """Earlier Q&A pairs are replayed as turns, so each call's cached prefix is a prefix of the next call"""
+    from app import followup_request
+    passages = [{'document': 'Lease', 'text': 'Ground rent is 250 pounds.'}]
+    history = [{'question': 'Any covenants?', 'answer': 'No shop use.'}]
+    first = followup_request('What is the ground rent?', passages, 'Initial analysis', history)
+    second = followup_request('Who is the freeholder?', [], 'Initial analysis',
+                              history + [{'question': 'What is the ground rent?', 'answer': '250 pounds.'}])
+
+    def breakpoints(request):
+        return [(turn, block) for turn, message in enumerate(request['messages'])
+                for block, content in enumerate(message['content']) if content.get('cache_control')]
+
+    def plain(messages):
+        return [[{'type': 'text', 'text': block['text']} for block in message['content']] for message in messages]
+
+    assert [message['role'] for message in second['messages']] == ['user', 'assistant', 'user', 'assistant', 'user']
+    assert breakpoints(first) == [(0, 0), (1, 0)]
+    assert breakpoints(second) == [(0, 0), (3, 0)]
+    assert first['messages'][-1]['content'][-1]['text'] == 'Question: What is the ground rent?'
+    # Everything up to the first call's last breakpoint is sent unchanged by the second
+    assert plain(first['messages'][:2]) == plain(second['messages'][:2]) and first['system'] == second['system']
+
+def test_claude_batches_retry_rate_limits_and_keep_order():
+    """Concurrent batch calls retry 429s and return results in batch order"""
+    from claude_client import StubAnthropicClient, create_message, map_concurrently
+    client = StubAnthropicClient(latency=0.01, rate_limited_calls=2)
+    prompts = ['a' * n for n in range(1, 6)]
+    responses = map_concurrently(
+        lambda prompt: create_message(client, model='stub', max_tokens=10,
+                                      messages=[{'role': 'user', 'content': prompt}]),
+        prompts, concurrency=3)
+    assert [r.content[0].text for r in responses] == [f"Analysis of {n} characters" for n in range(1, 6)]
+    assert client.calls == len(prompts) + 2
+
+def test_stream_message_retries_before_first_token():
+    """Streaming retries a rate limit that arrives before any text and reports the final usage"""
+    from claude_client import StubAnthropicClient, stream_message
+    client = StubAnthropicClient(latency=0.01, rate_limited_calls=1)
+    messages = []
+    parts = list(stream_message(client, on_message=messages.append, model='stub', max_tokens=10,
+                                messages=[{'role': 'user', 'content': 'abc'}]))
+    assert ''.join(parts) == 'Analysis of 3 characters' and len(parts) > 1
+    assert client.calls == 2 and messages[0].usage.output_tokens == 10
+
+def test_rate_limiter_keeps_a_reserve_for_interactive_calls():
+    """Bulk calls stop short of the interactive reserve; interactive calls may use it"""
+    from rate_limiter import TokenBucketScheduler, INTERACTIVE, BULK
+    state_dir = tempfile.mkdtemp()
+    try:
+        scheduler = TokenBucketScheduler(os.path.join(state_dir, 'limits.json'), requests_per_minute=10,
+                                         tokens_per_minute=100000, interactive_reserve=0.2)
+        for _ in range(8):
+            assert scheduler.acquire(1000, BULK) < 0.5
+        with scheduler._locked_state() as state:
+            assert scheduler._wait_seconds(state, 1000, BULK) > 0
+            assert scheduler._wait_seconds(state, 1000, INTERACTIVE) == 0
+        assert scheduler.acquire(1000, INTERACTIVE) < 0.5
+
+        # Another process sharing the file sees the same buckets, and a 429 pauses everyone
+        other = TokenBucketScheduler(os.path.join(state_dir, 'limits.json'), requests_per_minute=10,
+                                     tokens_per_minute=100000)
+        scheduler.pause(30)
+        with other._locked_state() as state:
+            assert state['requests'] < 2
+            assert other._wait_seconds(state, 1, INTERACTIVE) > 25
+    finally:
+        shutil.rmtree(state_dir)
+
+def test_property_update_does_not_load_legal_pack_blobs():
+    """Plain property reads and updates never touch the legal pack side tables"""
+    from sqlalchemy import event
+    from app import Property
+    with in_memory_db() as (app, db):
+        prop = Property(purchase_price=100000, monthly_rent=900, rooms=3)
+        prop.legal_pack_analysis = 'Analysis'
+        prop.legal_pack_documents = json.dumps([{'name': 'Lease', 'content': 'Text'}])
+        db.session.add(prop)
+        db.session.commit()
+        property_id = prop.id
+        db.session.remove()
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args: statements.append(statement))
+        client = app.test_client()
+        updated = client.put(f'/api/properties/{property_id}', json={'purchase_price': 120000, 'monthly_rent': 900})
+        fetched = client.get(f'/api/properties/{property_id}')
+
+        assert updated.status_code == 200 and fetched.status_code == 200
+        assert updated.get_json()['purchase_price'] == 120000
+        assert 'legal_pack_analysis' not in fetched.get_json()
+        assert not [statement for statement in statements
+                    if re.search(r'\b(FROM|JOIN|INTO|UPDATE) legal_pack_', statement)]
+        with app.test_request_context():
+            assert db.session.get(Property, property_id).to_dict(include_legal_pack=True)['legal_pack_analysis'] == 'Analysis'
+
+def _add_legal_pack_job(db, upload_dir, **fields):
+    """Add a property and a legal pack job for it, with an empty upload ZIP; returns the job id"""
+    import uuid
+    from app import LegalPackJob, Property
+    prop = Property(purchase_price=100000)
+    db.session.add(prop)
+    db.session.flush()
+    job_id = str(uuid.uuid4())
+    upload_path = os.path.join(upload_dir, f'{job_id}.zip')
+    zipfile.ZipFile(upload_path, 'w').close()
+    db.session.add(LegalPackJob(id=job_id, property_id=prop.id, upload_path=upload_path, **fields))
+    db.session.commit()
+    return job_id
+
+def test_legal_pack_job_is_claimed_once():
+    """The conditional UPDATE hands a queued job to exactly one claimer"""
+    from app import LegalPackJob, _claim_legal_pack_job
+    upload_dir = tempfile.mkdtemp()
+    try:
+        with in_memory_db() as (app, db):
+            job_id = _add_legal_pack_job(db, upload_dir)
+            assert _claim_legal_pack_job() == job_id
+            assert _claim_legal_pack_job() is None
+            assert _claim_legal_pack_job(job_id) is None
+            job = db.session.get(LegalPackJob, job_id)
+            db.session.refresh(job)
+            assert job.status == 'running' and job.attempts == 1
+    finally:
+        shutil.rmtree(upload_dir)
+
+def test_stale_legal_pack_job_is_reclaimed_until_attempts_run_out():
+    """A running job whose heartbeat stopped is claimed again; at the attempt cap it fails and its upload goes"""
+    from datetime import timedelta
+    from app import LegalPackJob, LEGAL_PACK_MAX_ATTEMPTS, LEGAL_PACK_STALE_SECONDS, _claim_legal_pack_job
+    upload_dir = tempfile.mkdtemp()
+    try:
+        with in_memory_db() as (app, db):
+            stale = datetime.utcnow() - timedelta(seconds=LEGAL_PACK_STALE_SECONDS + 60)
+            live_id = _add_legal_pack_job(db, upload_dir, status='running', attempts=1, updated_at=datetime.utcnow())
+            stale_id = _add_legal_pack_job(db, upload_dir, status='running', attempts=1, updated_at=stale)
+            spent_id = _add_legal_pack_job(db, upload_dir, status='running', attempts=LEGAL_PACK_MAX_ATTEMPTS,
+                                           updated_at=stale)
+            spent_upload = db.session.get(LegalPackJob, spent_id).upload_path
+
+            assert _claim_legal_pack_job() == stale_id
+            assert _claim_legal_pack_job() is None
+            db.session.expire_all()
+            live, reclaimed, spent = (db.session.get(LegalPackJob, job_id) for job_id in (live_id, stale_id, spent_id))
+            assert live.status == 'running' and live.attempts == 1
+            assert reclaimed.status == 'running' and reclaimed.attempts == 2 and reclaimed.updated_at > stale
+            assert spent.status == 'failed' and spent.error and spent.finished_at
+            assert not os.path.exists(spent_upload)
+    finally:
+        shutil.rmtree(upload_dir)
+
+def test_failed_legal_pack_job_records_the_error():
+    """An exception while processing the pack leaves the job failed with the error and removes the upload"""
+    from app import LegalPackJob, run_legal_pack_job
+    upload_dir = tempfile.mkdtemp()
+    try:
+        with in_memory_db() as (app, db):
+            job_id = _add_legal_pack_job(db, upload_dir)
+            upload_path = db.session.get(LegalPackJob, job_id).upload_path
+            with mock.patch('app.process_zip_file', side_effect=ValueError('Corrupt archive')):
+                assert run_legal_pack_job(job_id) == job_id
+            db.session.expire_all()
+            job = db.session.get(LegalPackJob, job_id)
+            assert job.status == 'failed' and job.error == 'Corrupt archive'
+            assert job.finished_at is not None and job.attempts == 1
+            assert not os.path.exists(upload_path)
+    finally:
+        shutil.rmtree(upload_dir)
+
+def test_failed_claude_batch_fails_the_analysis():
+    """A batch that exhausts its retries fails the analysis instead of consolidating a partial pack"""
+    import pytest
+    import app as app_module
+    documents = [{'name': f'Doc {n}', 'content': 'Clause. ' * 4000} for n in range(3)]
+
+    def process_document_batch(batch, client):
+        return None if 'DOCUMENT: Doc 1' in ''.join(batch) else 'Analysis'
+
+    with mock.patch.dict(os.environ, {'CLAUDE_API_KEY': 'test'}), \
+            mock.patch.object(app_module, 'process_document_batch', process_document_batch), \
+            mock.patch.object(app_module.claude_client, 'create_message') as create_message:
+        with pytest.raises(ValueError, match=r'1 of 3 document batches \(batch 2\)'):
+            app_module.analyze_with_claude(documents)
+    create_message.assert_not_called()
+
 if __name__ == "__main__":
     logger.info("Starting document processing tests")
     test_process_documents()
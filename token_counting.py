@@ -0,0 +1,263 @@
+"""
+Token accounting for Claude requests.
+
+count_tokens() gives an exact cl100k_base count. It loads the encoder once
+per process and memoizes counts by content hash, because the same text is
+counted again at extraction, when batches are packed and when token usage is
+reported. If the encoder cannot be loaded (its BPE file is downloaded on first
+use), the failure is logged once and counts fall back to the estimator.
+
+estimate_tokens() divides character length by a chars-per-token ratio. The
+ratio is calibrated from the exact counts seen so far, so it follows the text
+the app actually processes. Use it where an approximate figure will do, such
+as rate-limit accounting. Because the ratio changes with what the process
+has counted, never let it decide anything that ends up in a cache key (Claude
+batch boundaries, for example).
+
+chunk_text() splits a document into chunks of a bounded token size, snapping
+cuts to paragraph and sentence boundaries, for Claude batches and the
+follow-up passage index.
+
+    python token_counting.py
+"""
+import os
+import re
+import math
+import bisect
+import itertools
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+TOKEN_ENCODING = os.environ.get('TOKEN_ENCODING', 'cl100k_base')
+TOKEN_CACHE_ENTRIES = int(os.environ.get('TOKEN_CACHE_ENTRIES', 10000))
+# Starting ratio for English prose; replaced by the observed ratio once enough text has been counted
+DEFAULT_CHARS_PER_TOKEN = float(os.environ.get('CHARS_PER_TOKEN', 4.0))
+CALIBRATION_MIN_CHARS = 20000
+# tiktoken is encoded in slices so a huge document cannot blow the recursion/regex limits
+ENCODE_SLICE_CHARS = 100000
+
+_lock = threading.Lock()
+_encoder = None
+_encoder_failed = False
+_counts = OrderedDict()
+_hits = 0
+_misses = 0
+_calibration_chars = 0
+_calibration_tokens = 0
+
+
+def get_encoder():
+    """The shared tiktoken encoding, or None if it could not be loaded."""
+    global _encoder, _encoder_failed
+    if _encoder is not None or _encoder_failed:
+        return _encoder
+    with _lock:
+        if _encoder is None and not _encoder_failed:
+            try:
+                _encoder = tiktoken.get_encoding(TOKEN_ENCODING)
+            except Exception as e:
+                _encoder_failed = True
+                logger.error(f"Could not load {TOKEN_ENCODING} encoder, estimating token counts instead: {str(e)}")
+    return _encoder
+
+
+def encode_count(encoder, text):
+    """Exact token count of text with the given encoder."""
+    return sum(len(encoder.encode(text[i:i + ENCODE_SLICE_CHARS], disallowed_special=()))
+               for i in range(0, len(text), ENCODE_SLICE_CHARS))
+
+
+def chars_per_token():
+    """Calibrated characters-per-token ratio used by estimate_tokens()."""
+    if _calibration_chars >= CALIBRATION_MIN_CHARS and _calibration_tokens:
+        return _calibration_chars / _calibration_tokens
+    return DEFAULT_CHARS_PER_TOKEN
+
+
+def estimate_tokens(text):
+    """Fast token estimate from character length."""
+    text = str(text)
+    return math.ceil(len(text) / chars_per_token()) if text else 0
+
+
+def count_tokens(text):
+    """Exact token count, memoized by content hash."""
+    global _hits, _misses, _calibration_chars, _calibration_tokens
+    text = str(text)
+    if not text:
+        return 0
+    key = hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+    with _lock:
+        tokens = _counts.get(key)
+        if tokens is not None:
+            _counts.move_to_end(key)
+            _hits += 1
+            return tokens
+        _misses += 1
+
+    encoder = get_encoder()
+    if encoder is None:
+        return estimate_tokens(text)
+
+    tokens = encode_count(encoder, text)
+    with _lock:
+        _counts[key] = tokens
+        if len(_counts) > TOKEN_CACHE_ENTRIES:
+            _counts.popitem(last=False)
+        _calibration_chars += len(text)
+        _calibration_tokens += tokens
+    return tokens
+
+
+_PARAGRAPH_BREAK = re.compile(r'\n[ \t]*\n')
+_SENTENCE_END = re.compile(r'[.!?;:](?=\s)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _token_offsets(text):
+    """Character offset at which each token of text starts (one encode pass, sliced like encode_count)."""
+    encoder = get_encoder()
+    if encoder is None:
+        # No encoder: treat each chars_per_token() run of characters as one token
+        step = chars_per_token()
+        return [int(i * step) for i in range(math.ceil(len(text) / step))]
+    offsets = []
+    for base in range(0, len(text), ENCODE_SLICE_CHARS):
+        piece = text[base:base + ENCODE_SLICE_CHARS]
+        tokens = encoder.encode(piece, disallowed_special=())
+        if piece.isascii():
+            # Byte offsets are character offsets; much cheaper than decode_with_offsets
+            lengths = map(len, encoder.decode_tokens_bytes(tokens))
+            offsets.extend(itertools.accumulate(lengths, initial=base))
+            offsets.pop()
+        else:
+            offsets.extend(base + offset for offset in encoder.decode_with_offsets(tokens)[1])
+    return offsets
+
+
+def chunk_text(text, max_tokens, overlap_tokens=0):
+    """Split text into chunks of at most max_tokens tokens, optionally overlapping.
+
+    The text is encoded once and cut on token offsets. Each cut snaps back to
+    the last paragraph break in the window, else the last sentence end, else
+    the last whitespace, provided that keeps the chunk at least half full;
+    text with no boundaries at all is cut at exactly max_tokens. Cost is linear
+    in the length of the text.
+    """
+    text = str(text)
+    max_tokens = max(1, int(max_tokens))
+    overlap_tokens = max(0, min(int(overlap_tokens), max_tokens // 2))
+    offsets = _token_offsets(text)
+    total = len(offsets)
+    if total <= max_tokens:
+        return [text.strip()] if text.strip() else []
+
+    boundaries = [
+        [m.start() for m in _PARAGRAPH_BREAK.finditer(text)],
+        [m.end() for m in _SENTENCE_END.finditer(text)],
+        [m.start() for m in _WHITESPACE.finditer(text)],
+    ]
+    chunks = []
+    start = 0
+    while start < total:
+        end = min(start + max_tokens, total)
+        if end < total:
+            limit = offsets[end]
+            floor = offsets[start + max_tokens // 2]
+            for positions in boundaries:
+                i = bisect.bisect_right(positions, limit) - 1
+                if i >= 0 and positions[i] > floor:
+                    cut = bisect.bisect_left(offsets, positions[i], start + 1, end)
+                    if cut > start:
+                        end = cut
+                    break
+        chunk_end = offsets[end] if end < total else len(text)
+        chunk = text[offsets[start]:chunk_end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= total:
+            break
+        start = max(end - overlap_tokens, start + 1)
+    return chunks
+
+
+def stats():
+    total = _hits + _misses
+    return {
+        'encoding': TOKEN_ENCODING,
+        'encoder_loaded': _encoder is not None,
+        'cached_counts': len(_counts),
+        'hits': _hits,
+        'misses': _misses,
+        'hit_rate': round(_hits / total, 4) if total else 0.0,
+        'chars_per_token': round(chars_per_token(), 3)
+    }
+
+
+def _stand_in_encoder():
+    """Byte-level BPE encoding used by the benchmark when cl100k_base cannot be downloaded."""
+    return tiktoken.Encoding(
+        name='byte_level_stand_in',
+        pat_str=r"""'s|'t|'re|'ve|'m|'ll|'d| ?\w+| ?\d+| ?[^\s\w]+|\s+(?!\S)|\s+""",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={},
+    )
+
+
+def benchmark(documents=40, document_chars=20000):
+    """Time the old per-call counting pattern of one legal pack against the cached service.
+
+    Per pack the app counts each document at extraction, again with its header
+    while packing batches, and once per sentence when a large document is split.
+    """
+    global _encoder, _encoder_failed
+    sentence = "The lessee covenants to pay the ground rent of 250 pounds per annum without deduction. "
+    pack = [(f"Document {n}", (f"Clause {n}. " + sentence) * (document_chars // len(sentence)))
+            for n in range(documents)]
+
+    encoder = get_encoder()
+    stand_in = encoder is None
+    if stand_in:
+        encoder = _stand_in_encoder()
+
+    start = time.perf_counter()
+    for name, content in pack:
+        encode_count(encoder, content)
+        encode_count(encoder, f"\n{'=' * 50}\nDOCUMENT: {name}\n{'=' * 50}\n{content}")
+        for piece in content.split('. '):
+            encode_count(encoder, piece)
+    old_seconds = time.perf_counter() - start
+
+    saved = (_encoder, _encoder_failed)
+    _encoder, _encoder_failed = encoder, False
+    try:
+        start = time.perf_counter()
+        for name, content in pack:
+            count_tokens(content)
+            estimate_tokens(f"\n{'=' * 50}\nDOCUMENT: {name}\n{'=' * 50}\n{content}")
+            for piece in content.split('. '):
+                estimate_tokens(piece)
+        new_seconds = time.perf_counter() - start
+    finally:
+        _encoder, _encoder_failed = saved
+
+    return {
+        'documents': documents,
+        'encoder': 'byte-level stand-in' if stand_in else TOKEN_ENCODING,
+        'old_seconds': old_seconds,
+        'new_seconds': new_seconds,
+        'speedup': old_seconds / new_seconds if new_seconds else float('inf'),
+    }
+
+
+if __name__ == '__main__':
+    stats = benchmark()
+    print(f"{stats['documents']} documents ({stats['encoder']}): per-call counting {stats['old_seconds']:.2f} s, "
+          f"cached + estimated {stats['new_seconds']:.2f} s ({stats['speedup']:.1f}x)")
@@ -23,9 +23,26 @@ class Property(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     address = db.Column(db.String(500), nullable=True)
     purchase_price = db.Column(db.Float)
-    legal_pack_analysis = db.Column(db.Text, nullable=True)
-    legal_pack_qa_history = db.Column(db.Text, nullable=True)
-    legal_pack_documents = db.Column(db.Text, nullable=True)
+
+# Legal pack blobs live in side tables keyed by property_id
+class LegalPackAnalysis(db.Model):
+    __tablename__ = 'legal_pack_analysis'
+    property_id = db.Column(db.Integer, primary_key=True)
+    content = db.Column(db.Text, nullable=True)
+
+class LegalPackQAHistory(db.Model):
+    __tablename__ = 'legal_pack_qa_history'
+    property_id = db.Column(db.Integer, primary_key=True)
+    content = db.Column(db.Text, nullable=True)
+
+class LegalPackDocuments(db.Model):
+    __tablename__ = 'legal_pack_documents'
+    property_id = db.Column(db.Integer, primary_key=True)
+    content = db.Column(db.Text, nullable=True)
+
+def legal_pack_blob(model, property_id):
+    record = model.query.get(property_id)
+    return record.content if record else None
 
 def view_properties():
     with app.app_context():
@@ -33,22 +50,26 @@ def view_properties():
         print(f"\nFound {len(properties)} properties in database:")
         
         for prop in properties:
+            legal_pack_analysis = legal_pack_blob(LegalPackAnalysis, prop.id)
+            legal_pack_qa_history = legal_pack_blob(LegalPackQAHistory, prop.id)
+            legal_pack_documents = legal_pack_blob(LegalPackDocuments, prop.id)
+
             print("\n" + "="*80)
             print(f"Property ID: {prop.id}")
             print(f"Address: {prop.address}")
             print(f"Purchase Price: £{prop.purchase_price:,.2f}" if prop.purchase_price else "Purchase Price: Not set")
-            print(f"Legal Pack Analysis Available: {'Yes' if prop.legal_pack_analysis else 'No'}")
-            print(f"Legal Pack Documents Available: {'Yes' if prop.legal_pack_documents else 'No'}")
+            print(f"Legal Pack Analysis Available: {'Yes' if legal_pack_analysis else 'No'}")
+            print(f"Legal Pack Documents Available: {'Yes' if legal_pack_documents else 'No'}")
             
-            if prop.legal_pack_qa_history:
-                qa_history = json.loads(prop.legal_pack_qa_history)
+            if legal_pack_qa_history:
+                qa_history = json.loads(legal_pack_qa_history)
                 print(f"\nQ&A History ({len(qa_history)} questions):")
                 for i, qa in enumerate(qa_history, 1):
                     print(f"\nQ{i}: {qa['question']}")
                     print(f"A{i}: {qa['answer'][:200]}..." if len(qa['answer']) > 200 else f"A{i}: {qa['answer']}")
 
-            if prop.legal_pack_documents:
-                docs = json.loads(prop.legal_pack_documents)
+            if legal_pack_documents:
+                docs = json.loads(legal_pack_documents)
                 print(f"\nStored Documents ({len(docs)}):")
                 for doc in docs:
                     print(f"- {doc['name']} ({len(doc['content'])} chars)")